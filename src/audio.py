@@ -0,0 +1,222 @@
+import audioop
+import itertools
+import os
+import Queue
+from subprocess import Popen, PIPE
+import threading
+import wave
+
+from cache import TTLCache
+from console import log
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+DEVNULL = open('/dev/null', 'w')
+
+
+class AplaySink(object):
+    '''AplaySink is a persistent aplay process playing raw PCM
+    written to its stdin.'''
+    def __init__(self, rate=22050, channels=1, width=2, buffer_time=0.1):
+        self.rate = rate
+        self.channels = channels
+        self.width = width
+        self._buffer_time = buffer_time
+        self._process = None
+
+    def write(self, data):
+        if self._process is None or self._process.poll() is not None:
+            self._open()
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except IOError as e:
+            log('aplay died: {}'.format(e))
+            self._process = None
+
+    def close(self):
+        if self._process is None:
+            return
+        self._process.stdin.close()
+        self._process.wait()
+        self._process = None
+
+    def _open(self):
+        cmd = ['aplay', '-q', '-t', 'raw',
+               '-f', 'S{}_LE'.format(self.width * 8),
+               '-r', str(self.rate), '-c', str(self.channels),
+               '--buffer-time', str(int(self._buffer_time * 1000000))]
+        self._process = Popen(cmd, stdin=PIPE, stderr=DEVNULL, close_fds=True)
+
+
+class Clip(object):
+    '''Clip is a handle of a WAV file scheduled by AudioScheduler.'''
+    def __init__(self, wav_path, priority, owner=None):
+        self.wav_path = wav_path
+        self.priority = priority
+        self.owner = owner
+        self.cancelled = False
+        self._done = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        '''wait waits until the clip has been played or dropped.'''
+        return self._done.wait(timeout)
+
+
+class AudioScheduler(object):
+    '''AudioScheduler plays clips one by one in a background thread.
+
+    Clips with a smaller priority value are played first, and one
+    preempts the playing clip of the same owner if it has a larger
+    priority value. flush() drops the queued clips and stops the playing
+    one, which is used when prompts become stale, e.g. when the next card
+    is touched. Stations sharing the scheduler play through channel(),
+    so that a station flushes only its own clips.
+    '''
+    def __init__(self, sink=None, chunk_time=0.05):
+        self._sink = sink or AplaySink()
+        self._chunk_size = int(self._sink.rate * chunk_time) * (
+            self._sink.channels * self._sink.width)
+        self._queue = Queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._current = None
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._pcm_cache = TTLCache(16)
+        self._thread = None
+
+    def channel(self, owner):
+        '''channel returns an AudioChannel playing clips owned by owner.'''
+        return AudioChannel(self, owner)
+
+    def play(self, wav_path, priority=PRIORITY_NORMAL, owner=None):
+        clip = Clip(wav_path, priority, owner)
+        with self._lock:
+            self._idle.clear()
+            current = self._current
+            if (current is not None and current.owner == owner and
+                    current.priority > priority):
+                current.cancel()
+            self._queue.put((priority, next(self._seq), clip))
+        return clip
+
+    def flush(self, owner=None):
+        '''flush drops the clips of owner, or all clips if owner is None.'''
+        with self._lock:
+            kept = []
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except Queue.Empty:
+                    break
+                clip = item[2]
+                # keep the stop request and the clips of other owners
+                if clip is None or owner is not None and clip.owner != owner:
+                    kept.append(item)
+                    continue
+                clip.cancel()
+                clip._done.set()
+            for item in kept:
+                self._queue.put(item)
+            if self._current is not None:
+                if owner is None or self._current.owner == owner:
+                    self._current.cancel()
+            elif self._queue.empty():
+                self._idle.set()
+
+    def wait_idle(self, timeout=None):
+        '''wait_idle waits until all scheduled clips have been played.'''
+        return self._idle.wait(timeout)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''stop plays the scheduled clips and stops the thread.'''
+        self._queue.put((PRIORITY_LOW + 1, next(self._seq), None))
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._sink.close()
+
+    def _run(self):
+        while True:
+            _, _, clip = self._queue.get()
+            if clip is None:
+                return
+
+            with self._lock:
+                self._current = clip
+            try:
+                if not clip.cancelled:
+                    self._play(clip)
+            except Exception as e:
+                log('failed to play {}: {}'.format(clip.wav_path, e))
+            finally:
+                with self._lock:
+                    self._current = None
+                    if self._queue.empty():
+                        self._idle.set()
+                clip._done.set()
+
+    def _play(self, clip):
+        pcm = self._load(clip.wav_path)
+        for i in xrange(0, len(pcm), self._chunk_size):
+            if clip.cancelled:
+                return
+            self._sink.write(pcm[i:i+self._chunk_size])
+
+    def _load(self, wav_path):
+        key = (wav_path, os.path.getmtime(wav_path))
+        pcm = self._pcm_cache.get(key)
+        if pcm is None:
+            pcm = self._convert(wav_path)
+            self._pcm_cache.put(key, pcm)
+        return pcm
+
+    def _convert(self, wav_path):
+        '''_convert reads a WAV file and converts it to the sink format.'''
+        sink = self._sink
+        w = wave.open(wav_path, 'rb')
+        try:
+            channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+            pcm = w.readframes(w.getnframes())
+        finally:
+            w.close()
+
+        if width == 1:
+            # 8-bit WAV samples are unsigned
+            pcm = audioop.bias(pcm, 1, -128)
+        if width != sink.width:
+            pcm = audioop.lin2lin(pcm, width, sink.width)
+        if channels == 2 and sink.channels == 1:
+            pcm = audioop.tomono(pcm, sink.width, 0.5, 0.5)
+        elif channels == 1 and sink.channels == 2:
+            pcm = audioop.tostereo(pcm, sink.width, 1, 1)
+        if rate != sink.rate:
+            pcm, _ = audioop.ratecv(
+                pcm, sink.width, sink.channels, rate, sink.rate, None)
+        return pcm
+
+
+class AudioChannel(object):
+    '''AudioChannel plays and flushes the clips of one owner, e.g. a
+    station, on a shared AudioScheduler.'''
+    def __init__(self, scheduler, owner):
+        self._scheduler = scheduler
+        self.owner = owner
+
+    def play(self, wav_path, priority=PRIORITY_NORMAL):
+        return self._scheduler.play(wav_path, priority, self.owner)
+
+    def flush(self):
+        self._scheduler.flush(self.owner)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+'''Micro-benchmark of LineReader under a flood of scanner input.
+
+Lines are appended in 1024-byte chunks, as ThreadLineReader reads them,
+and then consumed one by one.
+
+CPython 2.7 cannot count allocations without a debug build, so each run
+is made in a forked process, and the peak RSS above the RSS at the start
+of the run and the minor page faults, i.e. pages newly touched by the
+allocator, are reported.
+'''
+import argparse
+import json
+import os
+import resource
+import time
+
+from main import LineReader
+
+
+class StringLineReader(object):
+    '''StringLineReader is the former str-based LineReader,
+    kept for comparison.'''
+    def __init__(self):
+        self._pool = ''
+
+    def append(self, dat):
+        self._pool += dat
+
+    def readline(self):
+        lf_pos = self._pool.find('\n')
+        if lf_pos == -1:
+            return None
+        line = self._pool[:lf_pos]
+        self._pool = self._pool[lf_pos+1:]
+        return line
+
+
+def make_chunks(num_lines):
+    '''make_chunks returns the input in 1024-byte chunks. It does not
+    build the whole input at once, which would raise the peak RSS above
+    that of the readers.'''
+    chunks = []
+    pending = ''
+    for i in xrange(num_lines):
+        pending += '97847898{:05d}\n'.format(i % 100000)
+        if len(pending) >= 1024:
+            chunks.append(pending[:1024])
+            pending = pending[1024:]
+    if pending:
+        chunks.append(pending)
+    return chunks
+
+
+def flood(reader_class, chunks, num_lines):
+    reader = reader_class()
+    begin = time.time()
+    for chunk in chunks:
+        reader.append(chunk)
+    lines = 0
+    while reader.readline() is not None:
+        lines += 1
+    elapsed = time.time() - begin
+    assert lines == num_lines
+    return elapsed
+
+
+def current_rss():
+    '''current_rss returns the resident set size in KiB.'''
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+
+def measure(reader_class, num_lines):
+    '''measure returns the seconds, the growth of the peak RSS in KiB and
+    the minor page faults of flooding a reader in a child process, which
+    does not share the peak RSS of earlier runs.'''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        chunks = make_chunks(num_lines)
+        rss = current_rss()
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        elapsed = flood(reader_class, chunks, num_lines)
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        # ru_maxrss is in KiB on Linux
+        os.write(write_fd, json.dumps([elapsed,
+            max(0, after.ru_maxrss - rss),
+            after.ru_minflt - before.ru_minflt]))
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, nargs='+',
+        default=[1000, 10000, 100000])
+    ns = parser.parse_args()
+
+    print '{:<18} {:>8} {:>14} {:>12} {:>12}'.format(
+        'reader', 'lines', 'lines/sec', 'peak +KiB', 'minor flt')
+    for reader_class in (StringLineReader, LineReader):
+        for num_lines in ns.lines:
+            elapsed, peak, faults = measure(reader_class, num_lines)
+            print '{:<18} {:>8} {:>14.0f} {:>12} {:>12}'.format(
+                reader_class.__name__, num_lines, num_lines / elapsed,
+                peak, faults)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8
+'''End-to-end benchmark of BookProcedure against FakeKintoneServer.
+
+NFC taps are simulated through EmployeeIDScanner with a fake frontend,
+and barcodes are written to the pipe read by ThreadLineReader when the
+procedure prompts for them. The latency of process_once(), the number
+of kintone requests and the bytes received are reported for each flow.
+'''
+import argparse
+from collections import Counter, defaultdict
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from pykintone.account import Account
+
+from cache import TTLCache
+from catalog import BookCatalog
+from directory import UserDirectory
+from fakekintone import FakeKintoneServer
+from httpsession import KintoneSession, SessionService
+from inputsource import FdSource
+import kintone
+from kintone import KintoneEnv
+from logship import LogShipper
+import metrics
+from main import (
+        BookProcedure, EmployeeIDScanner, Kintone, KintoneLogger, Messages,
+        ThreadLineReader)
+
+
+MEIBO_APP_ID, BOOK_APP_ID, LOG_APP_ID = 1, 2, 3
+BORROWED_ISBN = u'9784000000001'
+UNREGISTERED_ISBN = u'9784999999999'
+
+FLOWS = [
+    ('borrow', 'successfully borrowed a book'),
+    ('return', 'successfully returned a book'),
+    ('already-borrowed', 'book has already been borrowed'),
+    ('unregistered', 'book is not registered'),
+]
+
+
+class FakeTag(object):
+    def __init__(self, employee_id):
+        self._employee_id = employee_id
+        self.identifier = employee_id.rjust(8, '\x01')
+
+    def polling(self, system_code):
+        return self.identifier, '\x02' * 8
+
+    def read_without_encryption(self, service_list, block_list):
+        return '\x00' * 6 + 'CBZ' + '\x00' + self._employee_id
+
+
+class FakeFrontend(object):
+    '''FakeFrontend touches the card of the next employee at once.'''
+    def __init__(self):
+        self.employee_id = None
+
+    def connect(self, rdwr, terminate):
+        if not terminate():
+            rdwr['on-connect'](FakeTag(self.employee_id))
+
+
+class BarcodeScanner(object):
+    '''BarcodeScanner is a MessagePrinter which scans the next barcode
+    when prompted.'''
+    def __init__(self, fd):
+        self._fd = fd
+        self.barcode = None
+
+    def put(self, msg_pair, **kwargs):
+        if msg_pair is Messages.PLEASE_SCAN_BARCODE:
+            os.write(self._fd, self.barcode + '\n')
+
+
+class RecordingLogger(KintoneLogger):
+    def log_completed(self, user_code, barcode, message):
+        self.message = message
+        super(RecordingLogger, self).log_completed(user_code, barcode, message)
+
+
+class NullPositioner(object):
+    def show(self, genre_name):
+        pass
+
+    def hide(self):
+        pass
+
+
+class NullSound(object):
+    def play_se(self):
+        pass
+
+
+def text_field(value):
+    return {u'type': u'SINGLE_LINE_TEXT', u'value': value}
+
+
+def book_record(isbn, status, user_codes):
+    return {
+        u'isbn': text_field(u''),
+        u'isbn13': text_field(isbn),
+        u'type': {u'type': u'DROP_DOWN', u'value': u'PGその他[棚6]'},
+        u'ステータス': {u'type': u'STATUS', u'value': status},
+        u'作業者': {u'type': u'STATUS_ASSIGNEE',
+            u'value': [{u'code': c, u'name': c} for c in user_codes]},
+    }
+
+
+def setup_server(server, num_patrons):
+    server.add_app(MEIBO_APP_ID, [
+        {u'employeeNumber': text_field(u'{:04d}'.format(i)),
+         u'code': text_field(u'user{}'.format(i))}
+        for i in range(num_patrons)])
+    server.add_app(BOOK_APP_ID,
+        [book_record(u'97847890{:05d}'.format(i), kintone.STATUS_FREE, [])
+         for i in range(num_patrons)] +
+        [book_record(BORROWED_ISBN, kintone.STATUS_BORROWED, [u'someone'])])
+    server.add_app(LOG_APP_ID)
+
+
+def schedule(iterations, num_patrons):
+    '''schedule returns (flow, employee_id, barcode) tuples. Each patron
+    borrows a book and returns it later.'''
+    steps = []
+    for i in range(iterations):
+        patron = i % num_patrons
+        employee_id = '{:04d}'.format(patron)
+        isbn = '97847890{:05d}'.format(patron)
+        steps.append(('borrow', employee_id, isbn))
+        steps.append(('already-borrowed', employee_id, str(BORROWED_ISBN)))
+        steps.append(('unregistered', employee_id, str(UNREGISTERED_ISBN)))
+        steps.append(('return', employee_id, isbn))
+    return steps
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    rank = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def run(ns):
+    latency = ns.latency / 1000.0
+    jitter = ns.jitter / 1000.0
+    server = FakeKintoneServer(
+        latency=lambda: max(0, random.gauss(latency, jitter)),
+        error_rate=ns.error_rate)
+    setup_server(server, ns.patrons)
+    server.start()
+
+    session = KintoneSession(compress=not ns.no_compress)
+    env = KintoneEnv(SessionService(Account('fake'), session, server.api_root),
+        MEIBO_APP_ID, BOOK_APP_ID, LOG_APP_ID, False, session)
+    schema = kintone.fetch_book_schema(env)
+
+    spool_dir = tempfile.mkdtemp()
+    directory = catalog = log_shipper = idm_cache = None
+    if ns.cached:
+        directory = UserDirectory(lambda: kintone.fetch_user_codes(env))
+        directory.load()
+        catalog = BookCatalog(
+            lambda since: kintone.fetch_book_records_updated_since(
+                env, since, kintone.book_fields(schema)), schema=schema)
+        catalog.sync()
+        log_shipper = LogShipper(
+            lambda logs: kintone.add_logs(env, logs), spool_dir)
+        log_shipper.start()
+        idm_cache = TTLCache(1024, 3600)
+    kin = Kintone(env, directory, catalog, log_shipper, schema=schema)
+
+    read_fd, write_fd = os.pipe()
+    line_reader = ThreadLineReader(FdSource(read_fd))
+    line_reader.start()
+    frontend = FakeFrontend()
+    scanner = BarcodeScanner(write_fd)
+    logger = RecordingLogger('bench', kin)
+    procedure = BookProcedure(scanner, kin, logger, NullPositioner(),
+        EmployeeIDScanner(frontend, idm_cache), NullSound(), line_reader)
+
+    latencies = defaultdict(list)
+    requests = Counter()
+    received = Counter()
+    errors = Counter()
+    expected = dict(FLOWS)
+    server.reset_counts()
+    for flow, employee_id, barcode in schedule(ns.iterations, ns.patrons):
+        frontend.employee_id = employee_id
+        scanner.barcode = barcode
+        logger.message = None
+        before = sum(server.request_counts().values())
+        bytes_before = session.stats()['bytes_received']
+        begin = time.time()
+        try:
+            procedure.process_once()
+        except Exception:
+            errors[flow] += 1
+            continue
+        elapsed = time.time() - begin
+        if logger.message != expected[flow]:
+            errors[flow] += 1
+            continue
+        latencies[flow].append(elapsed)
+        requests[flow] += sum(server.request_counts().values()) - before
+        received[flow] += session.stats()['bytes_received'] - bytes_before
+
+    line_reader.terminate()
+    line_reader.join()
+    if log_shipper is not None:
+        log_shipper.stop()
+    counts = server.request_counts()
+    session.close()
+    server.stop()
+    shutil.rmtree(spool_dir)
+    return latencies, requests, received, errors, counts
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=100,
+        help='transactions of each flow')
+    parser.add_argument('--patrons', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=50,
+        help='mean latency of kintone in milliseconds')
+    parser.add_argument('--jitter', type=float, default=10,
+        help='standard deviation of the latency in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--cached', action='store_true',
+        help='use the user directory, the book catalog, the log shipper '
+             'and the IDm cache')
+    parser.add_argument('--no-compress', action='store_true',
+        help='do not ask for gzipped responses')
+    parser.add_argument('--metrics', action='store_true',
+        help='print the latency histograms of stages and kintone calls')
+    ns = parser.parse_args()
+
+    latencies, requests, received, errors, counts = run(ns)
+
+    print '{:<18} {:>6} {:>6} {:>9} {:>9} {:>9} {:>8} {:>8}'.format(
+        'flow', 'n', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/tx', 'KB/tx')
+    for flow, _ in FLOWS:
+        values = sorted(latencies[flow])
+        n = len(values)
+        print '{:<18} {:>6} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>8.2f} {:>8.2f}'.format(
+            flow, n, errors[flow],
+            percentile(values, 50) * 1000,
+            percentile(values, 95) * 1000,
+            percentile(values, 99) * 1000,
+            float(requests[flow]) / n if n else float('nan'),
+            received[flow] / 1024.0 / n if n else float('nan'))
+    print
+    for endpoint, count in sorted(counts.iteritems()):
+        print '{:<30} {:>8}'.format(endpoint, count)
+    if ns.metrics:
+        print
+        print metrics.REGISTRY.render(),
+
+
+if __name__ == '__main__':
+    main()
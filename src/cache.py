@@ -0,0 +1,97 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    '''TTLCache is a thread-safe mapping with a size bound and an optional
+    time-to-live.
+
+    The least recently used entry is evicted when the cache grows beyond
+    max_size, and entries older than ttl seconds are treated as missing.
+    on_evict(key, value) is called for every entry dropped by the cache.
+
+    >>> c = TTLCache(2)
+    >>> c.put('a', 1); c.put('b', 2); c.put('c', 3)
+    >>> c.get('a') is None, c.get('c')
+    (True, 3)
+    '''
+    def __init__(self, max_size, ttl=None, on_evict=None, clock=time.time):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._on_evict = on_evict
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        '''get returns the value for key if it is fresh, or default.'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            stored_at, value = entry
+            if self._expired(stored_at):
+                evicted = [(key, value)]
+            else:
+                self._entries[key] = entry
+                return value
+        self._evicted(evicted)
+        return default
+
+    def put(self, key, value):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            self._entries[key] = (self._clock(), value)
+            evicted = []
+            if old is not None and old[1] != value:
+                evicted.append((key, old[1]))
+            while len(self._entries) > self._max_size:
+                k, (_, v) = self._entries.popitem(last=False)
+                evicted.append((k, v))
+        self._evicted(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        self._evicted([(key, entry[1])])
+        return entry[1]
+
+    def expire(self):
+        '''expire drops all entries older than ttl.'''
+        with self._lock:
+            evicted = [(k, v) for k, (t, v) in self._entries.iteritems()
+                       if self._expired(t)]
+            for k, _ in evicted:
+                del self._entries[k]
+        self._evicted(evicted)
+
+    def clear(self):
+        with self._lock:
+            evicted = [(k, v) for k, (_, v) in self._entries.iteritems()]
+            self._entries.clear()
+        self._evicted(evicted)
+
+    def items(self):
+        '''items returns a list of fresh (key, value) pairs.'''
+        with self._lock:
+            return [(k, v) for k, (t, v) in self._entries.iteritems()
+                    if not self._expired(t)]
+
+    def _expired(self, stored_at):
+        return self._ttl is not None and self._clock() - stored_at > self._ttl
+
+    def _evicted(self, entries):
+        if self._on_evict is None:
+            return
+        for k, v in entries:
+            self._on_evict(k, v)
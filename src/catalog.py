@@ -0,0 +1,153 @@
+from collections import defaultdict
+import threading
+import time
+
+from console import log
+import kintone
+
+
+class BookCatalog(object):
+    '''BookCatalog is a local mirror of the book app indexed by ISBN-10 and
+    ISBN-13.
+
+    fetch_updated(since) must return all book records updated at or after
+    since, or all book records if since is None.
+    sync() fetches only the records changed since the last sync, and put()
+    writes a record changed by this station through to the mirror.
+    Records are kept as kintone.BookView decoded with schema, which is
+    resolved from the first record if None.
+
+    Deleted records are not seen by an incremental sync, so the background
+    thread fetches all records every full_sync_interval seconds and drops
+    the records not found. The catalog answers nothing if it has not been
+    synced for max_age seconds, e.g. while kintone is unreachable, so that
+    callers fall back to kintone.
+    '''
+    def __init__(self, fetch_updated, refresh_interval=60, schema=None,
+            full_sync_interval=3600, max_age=600):
+        self._fetch_updated = fetch_updated
+        self._refresh_interval = refresh_interval
+        self._full_sync_interval = full_sync_interval
+        self._max_age = max_age
+        self.schema = schema
+        self._records = {}
+        self._by_isbn = defaultdict(set)
+        self._by_assignee = defaultdict(set)
+        self._last_updated = None
+        self._synced_at = None
+        self._full_synced_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def sync(self, full=False):
+        '''sync fetches records updated since the last sync, or all records
+        if full is set or the catalog is empty, and returns the number of
+        them. A full sync drops the records which have been deleted.'''
+        with self._lock:
+            since = None if full else self._last_updated
+        synced_at = time.time()
+        records = self._fetch_updated(since)
+        with self._lock:
+            views = [self._decode(r) for r in records]
+            if since is None:
+                found = set(v.id for v in views)
+                for record_id in [i for i in self._records if i not in found]:
+                    self._remove(record_id)
+                self._full_synced_at = synced_at
+            for view in views:
+                self._put(view)
+                updated = view.updated_time
+                if updated is not None and (
+                        self._last_updated is None or updated > self._last_updated):
+                    self._last_updated = updated
+            self._synced_at = synced_at
+        return len(records)
+
+    def find(self, isbn):
+        '''find returns a list of BookViews whose ISBN-10 or ISBN-13 is isbn,
+        or None if the catalog has not been synced for max_age seconds.'''
+        with self._lock:
+            if not self._fresh():
+                return None
+            ids = sorted(self._by_isbn.get(isbn, ()), key=int, reverse=True)
+            return [self._records[i] for i in ids]
+
+    def find_borrowed_by(self, user_code):
+        '''find_borrowed_by returns a list of BookViews borrowed by
+        user_code, or None if the catalog has not been synced for max_age
+        seconds.'''
+        with self._lock:
+            if not self._fresh():
+                return None
+            ids = sorted(self._by_assignee.get(user_code, ()), key=int)
+            return [self._records[i] for i in ids
+                    if self._records[i].is_borrowed_by(user_code)]
+
+    def put(self, view):
+        '''put stores a BookView unless the catalog has a newer revision
+        of it.'''
+        with self._lock:
+            self._put(view)
+
+    def start(self):
+        '''start starts a daemon thread which calls sync()
+        every refresh_interval seconds.'''
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self._refresh_interval):
+            with self._lock:
+                full = (self._full_synced_at is None or time.time() -
+                        self._full_synced_at >= self._full_sync_interval)
+            try:
+                self.sync(full)
+            except Exception as e:
+                log('failed to sync book catalog: {}'.format(e))
+
+    def _fresh(self):
+        return (self._synced_at is not None and
+                time.time() - self._synced_at < self._max_age)
+
+    def _decode(self, record):
+        view = kintone.BookView.from_record(record, self.schema)
+        self.schema = view.schema
+        return view
+
+    def _put(self, view):
+        old = self._records.get(view.id)
+        if old is not None:
+            if old.revision > view.revision:
+                return
+            self._remove(view.id)
+
+        self._records[view.id] = view
+        for isbn in view.isbns():
+            self._by_isbn[isbn].add(view.id)
+        for user_code in view.assignee_codes():
+            self._by_assignee[user_code].add(view.id)
+
+
+    def _remove(self, record_id):
+        old = self._records.pop(record_id)
+        _unindex(self._by_isbn, old.isbns(), record_id)
+        _unindex(self._by_assignee, old.assignee_codes(), record_id)
+
+
+def _unindex(index, keys, record_id):
+    for key in keys:
+        index[key].discard(record_id)
+        if not index[key]:
+            del index[key]
@@ -1,23 +1,91 @@
 #!/usr/bin/python
 
 import argparse
+import cPickle as pickle
+import hashlib
+import json
+import os
+import pipes
+import re
 import sys
-import yaml
 
 from console import log
 
 
-def fetch_value_from_file(key_str, yaml_file_path):
-    '''fetches a value corresponding the given key.'''
-    with open(yaml_file_path) as f:
-        y = yaml.load(f)
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.cache/hondana/config')
+
+_parsed = {}
+
+
+def load(yaml_file_path, cache_dir=None):
+    '''load returns the parsed config file.
+
+    Parsed configs are cached in this process, and also in cache_dir if
+    given, as long as the mtime and the size of the file are unchanged.
+    '''
+    st = os.stat(yaml_file_path)
+    stamp = (st.st_mtime, st.st_size)
+    path = os.path.abspath(yaml_file_path)
+
+    cached = _parsed.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
 
-    return fetch_value(key_str, y)
+    obj = None
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir, hashlib.sha1(path).hexdigest() + '.pickle')
+        obj = _load_cache(cache_path, stamp)
+    if obj is None:
+        # yaml is imported only if the cache misses
+        import yaml
+        # the C loader needs libyaml
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        with open(yaml_file_path) as f:
+            obj = yaml.load(f, Loader=loader)
+        if cache_path is not None:
+            _save_cache(cache_path, stamp, obj)
+
+    _parsed[path] = (stamp, obj)
+    return obj
+
+
+def _load_cache(cache_path, stamp):
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_stamp, obj = pickle.load(f)
+    except Exception:
+        return None
+    if cached_stamp != stamp:
+        return None
+    return obj
+
+
+def _save_cache(cache_path, stamp, obj):
+    '''_save_cache saves a parsed config, which may contain passwords,
+    readable only by the user.'''
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((stamp, obj), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as e:
+        log('failed to cache config: {}'.format(e))
+
+
+def fetch_value_from_file(key_str, yaml_file_path, cache_dir=None):
+    '''fetches a value corresponding the given key.'''
+    return fetch_value(key_str, load(yaml_file_path, cache_dir))
 
 
 def fetch_value(key_str, dict_obj):
     '''fetches a value corresponding the given key.
-    
+
     >>> fetch_value("foo", {})
     Traceback (most recent call last):
         ...
@@ -25,7 +93,12 @@ def fetch_value(key_str, dict_obj):
 
     >>> fetch_value("foo.bar", {'foo': {'bar': 42}})
     42
+
+    >>> fetch_value(".", {'foo': 42})
+    {'foo': 42}
     '''
+    if key_str == '.':
+        return dict_obj
     key_list = key_str.split('.')
     o = dict_obj
     for k in key_list:
@@ -33,20 +106,79 @@ def fetch_value(key_str, dict_obj):
     return o
 
 
+def fetch_values(keys, dict_obj):
+    '''fetches values of the given keys as a list of (name, value) pairs.
+    A key may be prefixed with "NAME=" to name it; otherwise, the name is
+    the key in upper case with non-alphanumeric characters replaced by "_".
+
+    >>> fetch_values(['foo.bar', 'BAZ=foo.baz'], {'foo': {'bar': 1, 'baz': 2}})
+    [('FOO_BAR', 1), ('BAZ', 2)]
+    '''
+    values = []
+    for key in keys:
+        name, sep, key_str = key.partition('=')
+        if not sep:
+            key_str = key
+            name = re.sub(r'[^0-9A-Za-z]', '_', key).upper()
+        try:
+            values.append((name, fetch_value(key_str, dict_obj)))
+        except KeyError:
+            raise KeyError(key_str)
+    return values
+
+
+def format_shell(values):
+    '''formats values as shell assignments to be eval'ed.
+
+    >>> print format_shell([('ID', 42), ('NAME', "it's"), ('APPS', {'a': 1})])
+    ID=42
+    NAME='it'"'"'s'
+    APPS='{"a": 1}'
+    '''
+    lines = []
+    for name, val in values:
+        if isinstance(val, (dict, list)):
+            val = json.dumps(val, sort_keys=True)
+        elif isinstance(val, unicode):
+            val = val.encode('utf-8')
+        lines.append('{}={}'.format(name, pipes.quote(str(val))))
+    return '\n'.join(lines)
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('key', help='key name to be fetched ("." to fetch all)')
+    parser.add_argument('key', nargs='?',
+        help='key name to be fetched ("." to fetch all)')
     parser.add_argument('conf', help='path to a config file')
+    parser.add_argument('-k', '--keys', action='append', metavar='[NAME=]KEY',
+        help='fetch several keys at once; may be given more than once')
+    parser.add_argument('--format', choices=['shell', 'json'], default='shell',
+        help='output format of --keys (default: shell assignments)')
+    parser.add_argument('--cache-dir',
+        help='directory to cache parsed config files, which may contain '
+             'passwords (default: not cached)')
 
     ns = parser.parse_args()
+    if (ns.key is None) == (ns.keys is None):
+        parser.error('give either a key or --keys')
 
     try:
-        val = fetch_value_from_file(ns.key, ns.conf)
-    except KeyError:
-        log('no such key: ' + ns.key)
+        obj = load(ns.conf, ns.cache_dir or None)
+        if ns.keys is not None:
+            values = fetch_values(ns.keys, obj)
+        else:
+            val = fetch_value(ns.key, obj)
+    except KeyError as e:
+        log('no such key: ' + (ns.key if ns.keys is None else e.args[0]))
         sys.exit(1)
 
-    if isinstance(val, dict) or isinstance(val, list):
+    if ns.keys is not None:
+        if ns.format == 'json':
+            print json.dumps(dict(values), sort_keys=True)
+        else:
+            print format_shell(values)
+    elif isinstance(val, dict) or isinstance(val, list):
+        import yaml
         print yaml.dump(val)
     else:
         print val
@@ -0,0 +1,60 @@
+import threading
+
+from cache import TTLCache
+from console import log
+
+
+class UserDirectory(object):
+    '''UserDirectory is a local cache which maps employee ids to user codes.
+
+    fetch_all is a function returning (employee_id, user_code) pairs of all
+    employees. It is called by load() and periodically by the refresher
+    thread started with start().
+    '''
+    def __init__(self, fetch_all, max_size=4096, ttl=24*60*60,
+            refresh_interval=30*60):
+        self._fetch_all = fetch_all
+        self._cache = TTLCache(max_size, ttl)
+        self._refresh_interval = refresh_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._cache)
+
+    def load(self):
+        '''load fills the directory with all employees and returns
+        the number of them.'''
+        pairs = self._fetch_all()
+        for employee_id, user_code in pairs:
+            self._cache.put(employee_id, user_code)
+        self._cache.expire()
+        return len(pairs)
+
+    def lookup(self, employee_id):
+        '''lookup returns the user code of employee_id,
+        or None if it is not cached or stale.'''
+        return self._cache.get(employee_id)
+
+    def put(self, employee_id, user_code):
+        self._cache.put(employee_id, user_code)
+
+    def start(self):
+        '''start starts a daemon thread which reloads the directory
+        every refresh_interval seconds.'''
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self._refresh_interval):
+            try:
+                self.load()
+            except Exception as e:
+                log('failed to refresh user directory: {}'.format(e))
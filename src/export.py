@@ -0,0 +1,207 @@
+#!/usr/bin/python
+'''Exports the log and book apps to a SQLite database for reports.
+
+Records are streamed through the cursor API and appended a page at a
+time. The last log $id and book updated time exported are kept in the
+database, so that the next export fetches only the records after them.
+'''
+import argparse
+import json
+import sqlite3
+
+from console import log
+import kintone
+
+
+# the latest logged_at exported, for reports
+HIGH_WATER_LOGS = 'logs'
+# the last $id of the logs exported, which chooses the logs to export
+HIGH_WATER_LOG_IDS = 'log_ids'
+HIGH_WATER_BOOKS = 'books'
+
+
+class ReportStore(object):
+    '''ReportStore keeps the exported logs and books in SQLite.
+
+    The JSON message of a log is decoded into columns, and the message
+    itself is kept as is. The rows of a page and the high-water marks
+    after them are committed together, so an interrupted export resumes
+    where it stopped.
+    '''
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY,
+            logged_at TEXT NOT NULL,
+            system_id TEXT,
+            event TEXT,
+            user_code TEXT,
+            employee_id TEXT,
+            book_isbn TEXT,
+            book_id TEXT,
+            intent TEXT,
+            timings_ms TEXT,
+            message TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS logs_logged_at ON logs (logged_at)',
+        '''CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY,
+            revision INTEGER NOT NULL,
+            isbn TEXT,
+            isbn13 TEXT,
+            genre TEXT,
+            status TEXT,
+            borrowers TEXT,
+            updated_time TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS high_water_marks (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )''',
+    ]
+
+    def __init__(self, path, page_size=kintone.SELECT_LIMIT):
+        self._conn = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self._conn.execute(statement)
+        self._conn.commit()
+        self._page_size = page_size
+
+    def high_water(self, name):
+        '''high_water returns the last value exported of name, or None.'''
+        row = self._conn.execute(
+            'SELECT value FROM high_water_marks WHERE name = ?',
+            (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_logs(self, log_records):
+        '''add_logs adds log records in the order of $id and returns the
+        number of logs not exported before.
+
+        Logs shipped late have an older logged_at than the logs before
+        them, so the latest logged_at is kept apart from the last $id.'''
+        return self._add(log_records, _log_row,
+            'INSERT OR IGNORE INTO logs VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+            {HIGH_WATER_LOGS: self.high_water(HIGH_WATER_LOGS)})
+
+    def put_books(self, books):
+        '''put_books stores BookViews in the order of the updated time and
+        returns the number of them.'''
+        return self._add(books, _book_row,
+            'INSERT OR REPLACE INTO books VALUES (?,?,?,?,?,?,?,?)', {})
+
+    def close(self):
+        self._conn.close()
+
+    def _add(self, items, to_row, statement, high_water):
+        '''_add inserts the rows of items a page at a time. to_row returns
+        the row of an item and a dict of its values of the high-water
+        marks, which are raised from the values in high_water.'''
+        count = 0
+        rows = []
+        for item in items:
+            row, values = to_row(item)
+            rows.append(row)
+            for name, value in values.iteritems():
+                if high_water.get(name) is None or value > high_water[name]:
+                    high_water[name] = value
+            if len(rows) >= self._page_size:
+                count += self._commit(statement, rows, high_water)
+                rows = []
+        if rows:
+            count += self._commit(statement, rows, high_water)
+        return count
+
+    def _commit(self, statement, rows, high_water):
+        with self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(statement, rows)
+            count = self._conn.total_changes - before
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO high_water_marks VALUES (?, ?)',
+                [(name, unicode(value))
+                 for name, value in high_water.iteritems()
+                 if value is not None])
+        return count
+
+
+def _log_row(record):
+    message = record[u'message'][u'value']
+    try:
+        decoded = json.loads(message)
+    except ValueError:
+        decoded = None
+    if not isinstance(decoded, dict):
+        decoded = {u'message': message}
+    timings = decoded.get(u'timings_ms')
+    log_id = int(record[u'$id'][u'value'])
+    logged_at = record[u'logged_at'][u'value']
+    return (
+        log_id,
+        logged_at,
+        record[u'system_id'][u'value'],
+        decoded.get(u'message'),
+        decoded.get(u'user_code'),
+        decoded.get(u'employee_id'),
+        decoded.get(u'book_isbn'),
+        decoded.get(u'book_id'),
+        decoded.get(u'intent'),
+        json.dumps(timings, sort_keys=True) if timings is not None else None,
+        message,
+    ), {HIGH_WATER_LOGS: logged_at, HIGH_WATER_LOG_IDS: log_id}
+
+
+def _book_row(book):
+    return (
+        int(book.id),
+        book.revision,
+        book.isbn,
+        book.isbn13,
+        book.genre,
+        book.status,
+        json.dumps(book.to_dict()['borrowers'], ensure_ascii=False),
+        book.updated_time,
+    ), {HIGH_WATER_BOOKS: book.updated_time}
+
+
+def export_logs(env, store):
+    '''export_logs adds the logs after the high-water mark of $id to store.
+
+    kintone assigns $id in the order the logs are added, so the logs
+    shipped late by a station, with an older logged_at, are exported
+    however late they are.'''
+    last_id = store.high_water(HIGH_WATER_LOG_IDS)
+    return store.add_logs(kintone.iter_logs_after(
+        env, int(last_id) if last_id is not None else None))
+
+
+def export_books(env, store):
+    '''export_books stores the books updated after the high-water mark.'''
+    schema = kintone.fetch_book_schema(env)
+    records = kintone.iter_book_records_updated_since(env,
+        store.high_water(HIGH_WATER_BOOKS), kintone.book_fields(schema))
+    return store.put_books(
+        kintone.BookView.from_record(r, schema) for r in records)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store', help='path to the SQLite database')
+    parser.add_argument('--conf', default='kintone.yml',
+        help='path to the kintone config file')
+    parser.add_argument('--no-books', action='store_true',
+        help='export only the logs')
+    ns = parser.parse_args()
+
+    env = kintone.init(ns.conf)
+    store = ReportStore(ns.store)
+    try:
+        log('exported {} logs'.format(export_logs(env, store)))
+        if not ns.no_books:
+            log('exported {} books'.format(export_books(env, store)))
+    finally:
+        store.close()
+        env.session.close()
+
+
+if __name__ == '__main__':
+    main()
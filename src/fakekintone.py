@@ -0,0 +1,626 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8
+'''A local stand-in for the kintone REST API.
+
+FakeKintoneServer keeps apps in memory and serves the endpoints hondana
+uses, so that the borrow and return paths can be tested and benchmarked
+without the cloud tenant. Latency and errors can be injected.
+'''
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from collections import Counter, deque
+import copy
+from datetime import datetime
+import gzip
+import json
+import random
+import re
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+import threading
+import time
+from urlparse import parse_qs, urlparse
+
+import kintone
+
+
+API_PREFIX = '/k/v1/'
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+MAX_BATCH = 100
+MAX_BULK_REQUESTS = 20
+MAX_CURSORS = 10
+
+ERROR_NOT_FOUND = 'GAIA_RE01'
+ERROR_INVALID = 'CB_VA01'
+ERROR_QUERY = 'GAIA_IQ11'
+ERROR_ACTION = 'GAIA_IL03'
+ERROR_INJECTED = 'FAKE_INJECTED'
+
+# action: (status before, status after)
+ACTIONS = {
+    u'system_borrow': (kintone.STATUS_FREE, kintone.STATUS_BORROWED),
+    u'返す': (kintone.STATUS_BORROWED, kintone.STATUS_FREE),
+}
+
+
+class KintoneError(Exception):
+    def __init__(self, status, code, message):
+        super(KintoneError, self).__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeKintoneServer(ThreadingMixIn, HTTPServer):
+    '''FakeKintoneServer serves record select, get, create, status and
+    assignees endpoints, form fields, bulk requests and cursors, of
+    in-memory apps.
+
+    latency is seconds (or a function returning seconds) to wait before
+    each response, and error_rate is the probability of failing a request
+    with 503. inject_error() makes the next requests fail.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0, error_rate=0,
+            seed=None):
+        HTTPServer.__init__(self, address, _FakeKintoneHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._apps = {}
+        self._users = {}
+        self._errors = deque()
+        self._counts = Counter()
+        self._cursors = {}
+        self._last_cursor_id = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def api_root(self):
+        '''api_root is a replacement of Application.API_ROOT.'''
+        return 'http://127.0.0.1:{}{}{{1}}'.format(self.server_port, API_PREFIX)
+
+    def add_app(self, app_id, records=()):
+        '''add_app creates an app with records, which are given in the
+        format of the API responses without $id and $revision.'''
+        with self._lock:
+            app = self._apps.setdefault(unicode(app_id), _App())
+            for r in records:
+                app.add(copy.deepcopy(r))
+
+    def add_user(self, code, name):
+        with self._lock:
+            self._users[code] = name
+
+    def records(self, app_id):
+        with self._lock:
+            return copy.deepcopy(self._apps[unicode(app_id)].records())
+
+    def inject_error(self, status=503, code=ERROR_INJECTED, count=1):
+        '''inject_error makes the next count requests fail.'''
+        with self._lock:
+            for i in range(count):
+                self._errors.append((status, code))
+
+    def request_counts(self):
+        '''request_counts returns a dict from "METHOD endpoint" to the
+        number of requests.'''
+        with self._lock:
+            return dict(self._counts)
+
+    def open_cursors(self):
+        with self._lock:
+            return len(self._cursors)
+
+    def reset_counts(self):
+        with self._lock:
+            self._counts.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+    def handle_api(self, method, endpoint, params):
+        with self._lock:
+            self._counts['{} {}'.format(method, endpoint)] += 1
+            error = self._errors.popleft() if self._errors else None
+            if error is None and self._random.random() < self.error_rate:
+                error = (503, ERROR_INJECTED)
+
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+        if error is not None:
+            raise KintoneError(error[0], error[1], 'injected error')
+
+        handler = _ENDPOINTS.get((method, endpoint))
+        if handler is None:
+            raise KintoneError(404, ERROR_NOT_FOUND,
+                'no such API: {} {}'.format(method, endpoint))
+        with self._lock:
+            return handler(self, params)
+
+    def _app(self, params):
+        app = self._apps.get(unicode(params.get('app')))
+        if app is None:
+            raise KintoneError(404, ERROR_NOT_FOUND, 'no such app')
+        return app
+
+    def _get_record(self, params):
+        return {'record': self._app(params).get(params.get('id'))}
+
+    def _select(self, params, paging=True):
+        app = self._app(params)
+        records = app.select(params.get('query', u''), paging)
+        fields = params.get('fields')
+        if fields:
+            records = [dict((k, v) for k, v in r.iteritems() if k in fields)
+                       for r in records]
+        result = {'records': records}
+        if params.get('totalCount'):
+            result['totalCount'] = unicode(len(app.select(
+                params.get('query', u''), paging=False)))
+        return result
+
+    def _create_cursor(self, params):
+        if len(self._cursors) >= MAX_CURSORS:
+            raise KintoneError(400, ERROR_INVALID, 'too many cursors')
+        size = int(params.get('size', DEFAULT_LIMIT))
+        if size > MAX_LIMIT:
+            raise KintoneError(400, ERROR_INVALID, 'size must be <= 500')
+        query = params.get('query', u'')
+        if re.search(r'\b(limit|offset)\b', query, re.IGNORECASE):
+            raise KintoneError(400, ERROR_QUERY,
+                'limit and offset cannot be used with a cursor')
+        records = self._select({'app': params.get('app'), 'query': query,
+            'fields': params.get('fields')}, paging=False)['records']
+        self._last_cursor_id += 1
+        cursor_id = unicode(self._last_cursor_id)
+        self._cursors[cursor_id] = (deque(records), size)
+        return {'id': cursor_id, 'totalCount': unicode(len(records))}
+
+    def _fetch_cursor(self, params):
+        cursor = self._cursors.get(params.get('id'))
+        if cursor is None:
+            raise KintoneError(404, ERROR_NOT_FOUND, 'no such cursor')
+        records, size = cursor
+        page = [records.popleft() for i in range(min(size, len(records)))]
+        if not records:
+            del self._cursors[params.get('id')]
+        return {'records': page, 'next': bool(records)}
+
+    def _delete_cursor(self, params):
+        if self._cursors.pop(params.get('id'), None) is None:
+            raise KintoneError(404, ERROR_NOT_FOUND, 'no such cursor')
+        return {}
+
+    def _form_fields(self, params):
+        return {'properties': self._app(params).fields(), 'revision': u'1'}
+
+    def _create(self, params):
+        record_id, revision = self._app(params).create(params.get('record', {}))
+        return {'id': record_id, 'revision': revision}
+
+    def _batch_create(self, params):
+        records = params.get('records', [])
+        if len(records) > MAX_BATCH:
+            raise KintoneError(400, ERROR_INVALID, 'too many records')
+        app = self._app(params)
+        keys = [app.create(r) for r in records]
+        return {'ids': [k[0] for k in keys], 'revisions': [k[1] for k in keys]}
+
+    def _proceed(self, params):
+        app = self._app(params)
+        updated = self._proceeded(app, params)
+        app.put(updated)
+        return {'revision': updated[u'$revision'][u'value']}
+
+    def _batch_proceed(self, params):
+        app = self._app(params)
+        requests = params.get('records', [])
+        if len(requests) > MAX_BATCH:
+            raise KintoneError(400, ERROR_INVALID, 'too many records')
+        # all or nothing
+        updated = [self._proceeded(app, dict(r, app=params.get('app')))
+                   for r in requests]
+        for r in updated:
+            app.put(r)
+        return {'records': [
+            {'id': r[u'$id'][u'value'], 'revision': r[u'$revision'][u'value']}
+            for r in updated]}
+
+    def _proceeded(self, app, params):
+        record = app.get(params.get('id'))
+        _check_revision(record, params.get('revision'))
+        action = params.get('action')
+        if action not in ACTIONS:
+            raise KintoneError(400, ERROR_ACTION, 'no such action')
+        before, after = ACTIONS[action]
+        status = kintone.find_field_by_type(record, u'STATUS')
+        if status[u'value'] != before:
+            raise KintoneError(400, ERROR_ACTION,
+                'action is not available in this status')
+        status[u'value'] = after
+        assignee = params.get('assignee')
+        self._set_assignee_field(record, [assignee] if assignee else [])
+        # kintone counts a status change as two revisions
+        return _touch(record, 2)
+
+    def _set_assignees(self, params):
+        app = self._app(params)
+        record = app.get(params.get('id'))
+        _check_revision(record, params.get('revision'))
+        self._set_assignee_field(record, params.get('assignees', []))
+        record = _touch(record, 1)
+        app.put(record)
+        return {'revision': record[u'$revision'][u'value']}
+
+    def _bulk(self, params):
+        requests = params.get('requests', [])
+        if len(requests) > MAX_BULK_REQUESTS:
+            raise KintoneError(400, ERROR_INVALID, 'too many requests')
+        # all or nothing
+        apps = copy.deepcopy(self._apps)
+        try:
+            results = []
+            for r in requests:
+                path = urlparse(r.get('api', '')).path
+                handler = _ENDPOINTS.get((r.get('method'),
+                    path[len(API_PREFIX):] if path.startswith(API_PREFIX) else None))
+                if handler is None or handler == FakeKintoneServer._bulk:
+                    raise KintoneError(400, ERROR_INVALID,
+                        'no such API: {} {}'.format(r.get('method'), path))
+                results.append(handler(self, r.get('payload', {})))
+        except KintoneError:
+            self._apps = apps
+            raise
+        return {'results': results}
+
+    def _set_assignee_field(self, record, user_codes):
+        kintone.find_field_by_type(record, u'STATUS_ASSIGNEE')[u'value'] = [
+            {u'code': c, u'name': self._users.get(c, c)} for c in user_codes]
+
+
+_ENDPOINTS = {
+    ('GET', 'record.json'): FakeKintoneServer._get_record,
+    ('POST', 'record.json'): FakeKintoneServer._create,
+    ('GET', 'records.json'): FakeKintoneServer._select,
+    ('GET', 'app/form/fields.json'): FakeKintoneServer._form_fields,
+    ('POST', 'records.json'): FakeKintoneServer._batch_create,
+    ('PUT', 'record/status.json'): FakeKintoneServer._proceed,
+    ('PUT', 'records/status.json'): FakeKintoneServer._batch_proceed,
+    ('PUT', 'record/assignees.json'): FakeKintoneServer._set_assignees,
+    ('POST', 'bulkRequest.json'): FakeKintoneServer._bulk,
+    ('POST', 'records/cursor.json'): FakeKintoneServer._create_cursor,
+    ('GET', 'records/cursor.json'): FakeKintoneServer._fetch_cursor,
+    ('DELETE', 'records/cursor.json'): FakeKintoneServer._delete_cursor,
+}
+
+
+class _App(object):
+    def __init__(self):
+        self._records = {}
+        self._last_id = 0
+
+    def records(self):
+        return [self._records[i] for i in sorted(self._records)]
+
+    def fields(self):
+        '''fields returns the form properties of the fields of the records.'''
+        fields = {}
+        for r in self._records.itervalues():
+            for code, field in r.iteritems():
+                fields[code] = {
+                    u'type': field[u'type'], u'code': code, u'label': code}
+        return fields
+
+    def add(self, record):
+        self._last_id += 1
+        record[u'$id'] = {u'type': u'__ID__', u'value': unicode(self._last_id)}
+        record[u'$revision'] = {u'type': u'__REVISION__', u'value': u'1'}
+        record.setdefault(kintone.BOOK_UPDATED_TIME_FIELD,
+            {u'type': u'UPDATED_TIME', u'value': _now()})
+        self._records[self._last_id] = record
+        return record
+
+    def create(self, fields):
+        record = dict((k, {u'type': u'SINGLE_LINE_TEXT', u'value': v[u'value']})
+                      for k, v in fields.iteritems())
+        record = self.add(record)
+        return record[u'$id'][u'value'], u'1'
+
+    def get(self, record_id):
+        try:
+            return copy.deepcopy(self._records[int(record_id)])
+        except (KeyError, TypeError, ValueError):
+            raise KintoneError(404, ERROR_NOT_FOUND, 'no such record')
+
+    def put(self, record):
+        self._records[int(record[u'$id'][u'value'])] = record
+
+    def select(self, query, paging=True):
+        cond, order, limit, offset = parse_query(query)
+        if limit > MAX_LIMIT:
+            raise KintoneError(400, ERROR_QUERY, 'limit must be <= 500')
+        records = [r for r in self.records() if cond(r)]
+        for field, desc in reversed(order):
+            records.sort(key=lambda r: _sort_key(_value(r, field)), reverse=desc)
+        if paging:
+            records = records[offset:offset+limit]
+        return copy.deepcopy(records)
+
+
+def _check_revision(record, revision):
+    if revision is None or int(revision) == -1:
+        return
+    if int(revision) != int(record[u'$revision'][u'value']):
+        raise KintoneError(409, kintone.REVISION_CONFLICT,
+            'revision does not match')
+
+
+def _touch(record, revisions):
+    record[u'$revision'][u'value'] = unicode(
+        int(record[u'$revision'][u'value']) + revisions)
+    field = kintone.find_field_by_type(record, u'UPDATED_TIME')
+    if field is not None:
+        field[u'value'] = _now()
+    return record
+
+
+def _now():
+    return unicode(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+
+_TOKEN = re.compile(
+    ur'\s*(?:"((?:[^"\\]|\\.)*)"|(!=|>=|<=|=|>|<|\(|\)|,)|([^\s()=!<>,"]+))',
+    re.UNICODE)
+
+
+def _tokenize(query):
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        m = _TOKEN.match(query, pos)
+        if m is None:
+            raise KintoneError(400, ERROR_QUERY, 'invalid query')
+        string, op, word = m.groups()
+        if string is not None:
+            tokens.append(('str', re.sub(r'\\(.)', r'\1', string)))
+        elif op is not None:
+            tokens.append(('op', op))
+        else:
+            tokens.append(('word', word))
+        pos = m.end()
+    return tokens
+
+
+def parse_query(query):
+    '''parse_query parses the kintone query language with comparison and
+    in operators, and, or, parentheses, order by, limit and offset.
+    It returns (predicate, [(field, descending)], limit, offset).'''
+    parser = _QueryParser(_tokenize(query))
+    cond = lambda r: True
+    if parser.peek() is not None and not parser.peek_word('order', 'limit',
+            'offset'):
+        cond = parser.parse_or()
+
+    order = [(u'$id', True)]
+    limit, offset = DEFAULT_LIMIT, 0
+    while parser.peek() is not None:
+        if parser.accept_word('order'):
+            parser.expect_word('by')
+            order = []
+            while True:
+                field = parser.next_value()
+                desc = False
+                if parser.accept_word('desc'):
+                    desc = True
+                else:
+                    parser.accept_word('asc')
+                order.append((field, desc))
+                if not parser.accept_op(','):
+                    break
+        elif parser.accept_word('limit'):
+            limit = int(parser.next_value())
+        elif parser.accept_word('offset'):
+            offset = int(parser.next_value())
+        else:
+            raise KintoneError(400, ERROR_QUERY, 'invalid query')
+    return cond, order, limit, offset
+
+
+class _QueryParser(object):
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._pos = 0
+
+    def peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return None
+
+    def peek_word(self, *words):
+        token = self.peek()
+        return (token is not None and token[0] == 'word' and
+                token[1].lower() in words)
+
+    def accept_word(self, word):
+        if self.peek_word(word):
+            self._pos += 1
+            return True
+        return False
+
+    def expect_word(self, word):
+        if not self.accept_word(word):
+            raise KintoneError(400, ERROR_QUERY, 'expected ' + word)
+
+    def accept_op(self, op):
+        if self.peek() == ('op', op):
+            self._pos += 1
+            return True
+        return False
+
+    def expect_op(self, op):
+        if not self.accept_op(op):
+            raise KintoneError(400, ERROR_QUERY, 'expected ' + op)
+
+    def next_value(self):
+        token = self.peek()
+        if token is None or token[0] == 'op':
+            raise KintoneError(400, ERROR_QUERY, 'invalid query')
+        self._pos += 1
+        return token[1]
+
+    def parse_or(self):
+        conds = [self.parse_and()]
+        while self.accept_word('or'):
+            conds.append(self.parse_and())
+        return lambda r: any(c(r) for c in conds)
+
+    def parse_and(self):
+        conds = [self.parse_term()]
+        while self.accept_word('and'):
+            conds.append(self.parse_term())
+        return lambda r: all(c(r) for c in conds)
+
+    def parse_term(self):
+        if self.accept_op('('):
+            cond = self.parse_or()
+            self.expect_op(')')
+            return cond
+
+        field = self.next_value()
+        negate = self.accept_word('not')
+        if self.accept_word('in'):
+            self.expect_op('(')
+            values = [self.next_value()]
+            while self.accept_op(','):
+                values.append(self.next_value())
+            self.expect_op(')')
+            keys = set(_sort_key(v) for v in values)
+            return lambda r: (_sort_key(_value(r, field)) in keys) != negate
+        if negate:
+            raise KintoneError(400, ERROR_QUERY, 'expected in')
+
+        token = self.peek()
+        if token is None or token[0] != 'op':
+            raise KintoneError(400, ERROR_QUERY, 'expected an operator')
+        self._pos += 1
+        key = _sort_key(self.next_value())
+        compare = _COMPARE.get(token[1])
+        if compare is None:
+            raise KintoneError(400, ERROR_QUERY, 'invalid operator')
+        return lambda r: compare(_sort_key(_value(r, field)), key)
+
+
+_COMPARE = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+}
+
+
+def _value(record, field):
+    v = record.get(field)
+    if v is None:
+        raise KintoneError(400, ERROR_QUERY, u'no such field: ' + field)
+    return v[u'value']
+
+
+def _sort_key(value):
+    '''_sort_key compares numbers as numbers and others as strings.'''
+    try:
+        return (0, float(value), u'')
+    except (TypeError, ValueError):
+        return (1, 0, value)
+
+
+class _FakeKintoneHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send a response in one segment so that it is not delayed by
+    # Nagle's algorithm on keep-alive connections
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def _handle(self, method):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        method = self.headers.get('X-HTTP-Method-Override', method).upper()
+        try:
+            if not url.path.startswith(API_PREFIX):
+                raise KintoneError(404, ERROR_NOT_FOUND, 'not found')
+            if method == 'GET' and not body:
+                params = _query_params(url.query)
+            else:
+                params = json.loads(body or '{}')
+            result = self.server.handle_api(
+                method, url.path[len(API_PREFIX):], params)
+            self._send(200, result)
+        except KintoneError as e:
+            self._send(e.status, {
+                'code': e.code, 'id': 'fake', 'message': e.message})
+        except ValueError as e:
+            self._send(400, {
+                'code': ERROR_INVALID, 'id': 'fake', 'message': str(e)})
+
+    def _send(self, code, obj):
+        body = json.dumps(obj)
+        encoding = None
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            encoding = 'gzip'
+            body = _gzip(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _gzip(data):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _query_params(query):
+    params = {}
+    fields = []
+    for k, v in parse_qs(query).iteritems():
+        v = v[-1].decode('utf-8')
+        if k.startswith('fields['):
+            fields.append((int(k[len('fields['):-1]), v))
+        else:
+            params[k] = v
+    if fields:
+        params['fields'] = [v for _, v in sorted(fields)]
+    return params
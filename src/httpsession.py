@@ -0,0 +1,178 @@
+import functools
+import json
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import (
+        HTTPConnectionPool, HTTPSConnectionPool)
+from pykintone.application import Application
+
+
+_received = threading.local()
+
+
+def received_bytes():
+    '''received_bytes returns the number of bytes received on the wire
+    by the requests sent from this thread so far.'''
+    return getattr(_received, 'bytes', 0)
+
+
+class KintoneSession(object):
+    '''KintoneSession is a keep-alive, connection-pooled HTTP session
+    shared by all kintone apps.
+
+    It counts requests and newly opened connections so that connection
+    reuse can be monitored, and the bytes of response bodies on the wire and
+    after decompression. Responses are gzipped unless compress is False.
+    '''
+    def __init__(self, pool_size=4, keep_alive=True,
+            connect_timeout=5, read_timeout=30, compress=True):
+        self.requests = 0
+        self.new_connections = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self._lock = threading.Lock()
+        self._timeout = (connect_timeout, read_timeout)
+
+        self._session = requests.Session()
+        adapter = _CountingAdapter(self._count_new_connection,
+            pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        if not keep_alive:
+            self._session.headers['Connection'] = 'close'
+        self._session.headers['Accept-Encoding'] = (
+            'gzip' if compress else 'identity')
+
+    @classmethod
+    def from_config(cls, conf):
+        '''from_config creates a session from the "session" section of
+        kintone.yml, which may be None.'''
+        conf = conf or {}
+        return cls(**dict((k, conf[k]) for k in
+            ('pool_size', 'keep_alive', 'connect_timeout', 'read_timeout',
+             'compress')
+            if k in conf))
+
+    @property
+    def reused_connections(self):
+        return self.requests - self.new_connections
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused_connections': self.reused_connections,
+                'bytes_received': self.bytes_received,
+                'bytes_decoded': self.bytes_decoded,
+            }
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self._timeout)
+        with self._lock:
+            self.requests += 1
+        resp = self._session.request(method, url, **kwargs)
+        # the response has been read, so tell() is the size on the wire
+        received = resp.raw.tell() if resp.raw is not None else 0
+        decoded = len(resp.content)
+        _received.bytes = received_bytes() + received
+        with self._lock:
+            self.bytes_received += received
+            self.bytes_decoded += decoded
+        return resp
+
+    def close(self):
+        self._session.close()
+
+    def _count_new_connection(self):
+        with self._lock:
+            self.new_connections += 1
+
+
+class SessionService(object):
+    '''SessionService is a replacement of pykintone.kintoneService
+    whose apps send requests through a KintoneSession.
+
+    api_root replaces Application.API_ROOT, e.g. to send requests to
+    a local stand-in server such as fakekintone.FakeKintoneServer.'''
+    def __init__(self, account, session, api_root=None):
+        self.account = account
+        self.session = session
+        self.api_root = api_root
+        self._apps = {}
+        self._lock = threading.Lock()
+
+    def app(self, app_id, api_token='', app_name=''):
+        with self._lock:
+            app = self._apps.get(app_id)
+            if app is None:
+                app = SessionApplication(
+                    self.session, self.account, app_id, api_token, app_name)
+                if self.api_root is not None:
+                    app.API_ROOT = self.api_root
+                self._apps[app_id] = app
+            return app
+
+
+class SessionApplication(Application):
+    def __init__(self, session, *args, **kwargs):
+        super(SessionApplication, self).__init__(*args, **kwargs)
+        self._session = session
+
+    def _request(self, method, url, params_or_data, headers=None,
+            use_api_token=True):
+        m = method.upper()
+        token = self.api_token if use_api_token else ''
+
+        if m == 'GET':
+            h = headers or self.account.to_header(
+                api_token=token, with_content_type=False)
+            return self._session.request('GET', url,
+                params=params_or_data, headers=h, **self.requests_options)
+        elif m == 'FILE':
+            h = headers or self.account.to_header(
+                api_token=token, with_content_type=False)
+            return self._session.request('POST', url,
+                files=params_or_data, headers=h, **self.requests_options)
+        else:
+            h = headers or self.account.to_header(api_token=token)
+            return self._session.request(m, url,
+                data=json.dumps(params_or_data), headers=h,
+                **self.requests_options)
+
+
+class _CountingAdapter(HTTPAdapter):
+    def __init__(self, on_new_connection, **kwargs):
+        self._on_new_connection = on_new_connection
+        super(_CountingAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_CountingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': functools.partial(_CountingHTTPConnectionPool,
+                on_new_connection=self._on_new_connection),
+            'https': functools.partial(_CountingHTTPSConnectionPool,
+                on_new_connection=self._on_new_connection),
+        }
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, *args, **kwargs):
+        self._on_new_connection = kwargs.pop('on_new_connection')
+        super(_CountingHTTPConnectionPool, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        self._on_new_connection()
+        return super(_CountingHTTPConnectionPool, self)._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def __init__(self, *args, **kwargs):
+        self._on_new_connection = kwargs.pop('on_new_connection')
+        super(_CountingHTTPSConnectionPool, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        self._on_new_connection()
+        return super(_CountingHTTPSConnectionPool, self)._new_conn()
@@ -0,0 +1,82 @@
+import fcntl
+import os
+import struct
+
+
+class FdSource(object):
+    '''FdSource reads bytes from a file descriptor such as stdin or a pipe.'''
+    def __init__(self, fd):
+        self._fd = fd
+
+    def fileno(self):
+        return self._fd
+
+    def read(self):
+        '''read returns available bytes, or '' at EOF.'''
+        return os.read(self._fd, 1024)
+
+    def close(self):
+        pass
+
+
+class EvdevSource(object):
+    '''EvdevSource reads a HID barcode scanner through its evdev device
+    file, e.g. /dev/input/by-id/usb-...-event-kbd, so that no TTY or
+    keyboard focus is needed.
+
+    Key presses are translated into bytes with a US keyboard layout and
+    Enter into LF. The device is grabbed so that scanned codes do not leak
+    into other programs.
+    '''
+    EVENT = struct.Struct('llHHi')
+    EV_KEY = 1
+    KEY_PRESS = 1
+    KEY_LEFTSHIFT = 42
+    KEY_RIGHTSHIFT = 54
+    EVIOCGRAB = 0x40044590
+
+    KEYMAP = dict(
+        [(2 + i, c) for i, c in enumerate('1234567890-=')] +
+        [(16 + i, c) for i, c in enumerate('qwertyuiop[]')] +
+        [(30 + i, c) for i, c in enumerate("asdfghjkl;'`")] +
+        [(43 + i, c) for i, c in enumerate('\\zxcvbnm,./')] +
+        [(28, '\n'), (57, ' '), (96, '\n')])
+    SHIFTED = dict(zip(
+        "1234567890-=qwertyuiop[]asdfghjkl;'`\\zxcvbnm,./",
+        '!@#$%^&*()_+QWERTYUIOP{}ASDFGHJKL:"~|ZXCVBNM<>?'))
+
+    def __init__(self, path, grab=True):
+        self._fd = os.open(path, os.O_RDONLY)
+        self._shift = False
+        if grab:
+            fcntl.ioctl(self._fd, self.EVIOCGRAB, 1)
+
+    def fileno(self):
+        return self._fd
+
+    def read(self):
+        '''read returns bytes typed since the last call, None if no key
+        was pressed, or '' when the device has gone.'''
+        try:
+            data = os.read(self._fd, self.EVENT.size * 64)
+        except OSError:
+            return ''
+        if not data:
+            return ''
+
+        chars = []
+        for i in xrange(0, len(data) - self.EVENT.size + 1, self.EVENT.size):
+            _, _, ev_type, code, value = self.EVENT.unpack_from(data, i)
+            if ev_type != self.EV_KEY:
+                continue
+            if code in (self.KEY_LEFTSHIFT, self.KEY_RIGHTSHIFT):
+                self._shift = value != 0
+            elif value == self.KEY_PRESS and code in self.KEYMAP:
+                c = self.KEYMAP[code]
+                if self._shift:
+                    c = self.SHIFTED.get(c, c)
+                chars.append(c)
+        return ''.join(chars) if chars else None
+
+    def close(self):
+        os.close(self._fd)
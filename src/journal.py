@@ -0,0 +1,187 @@
+from collections import namedtuple
+import json
+import sqlite3
+import threading
+import uuid
+
+from console import log
+import kintone
+
+
+# system_id is the station which recorded the intent, or None
+Intent = namedtuple('Intent',
+    ['key', 'action', 'book_id', 'user_code', 'created_at', 'system_id'])
+
+
+STATE_PENDING = 'pending'
+STATE_APPLIED = 'applied'
+STATE_CONFLICT = 'conflict'
+
+
+class Journal(object):
+    '''Journal is a durable log of borrow and return intents kept in
+    SQLite in WAL mode.
+
+    An intent is recorded together with the book record as this station
+    expects it to be after the intent is applied, so that the station can
+    behave as if kintone had accepted it. Each intent has a unique key,
+    and it stays pending until the Reconciler marks it applied or
+    conflicting.
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS intents (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            action TEXT NOT NULL,
+            book_id TEXT NOT NULL,
+            user_code TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            record TEXT NOT NULL,
+            state TEXT NOT NULL,
+            reason TEXT,
+            system_id TEXT
+        )'''
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # an acknowledged intent must survive a power loss
+        self._conn.execute('PRAGMA synchronous=FULL')
+        self._conn.execute(self.SCHEMA)
+        columns = [row[1] for row in
+                   self._conn.execute('PRAGMA table_info(intents)')]
+        if 'system_id' not in columns:
+            # a journal created before intents had their station
+            self._conn.execute('ALTER TABLE intents ADD COLUMN system_id TEXT')
+        self._lock = threading.Lock()
+
+    def record(self, action, book_record, user_code, key=None,
+            system_id=None):
+        '''record records an intent of the station system_id and returns
+        its key. book_record is the record of the book after applying the
+        intent.'''
+        if key is None:
+            key = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO intents '
+                '(key, action, book_id, user_code, created_at, record, state, '
+                'system_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, action, book_record[u'$id'][u'value'], user_code,
+                 kintone.now_logged_at(), json.dumps(book_record),
+                 STATE_PENDING, system_id))
+        return key
+
+    def pending(self):
+        '''pending returns pending intents in the recorded order.'''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, action, book_id, user_code, created_at, '
+                'system_id FROM intents WHERE state = ? ORDER BY seq',
+                (STATE_PENDING,)).fetchall()
+        return [Intent(*row) for row in rows]
+
+    def pending_records(self):
+        '''pending_records returns a dict from book ids to the book
+        records expected after applying all pending intents.'''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT book_id, record FROM intents '
+                'WHERE state = ? ORDER BY seq', (STATE_PENDING,)).fetchall()
+        return dict((book_id, json.loads(record)) for book_id, record in rows)
+
+    def mark_applied(self, key):
+        self._set_state(key, STATE_APPLIED, None)
+
+    def mark_conflict(self, key, reason):
+        self._set_state(key, STATE_CONFLICT, reason)
+
+    def conflicts(self):
+        '''conflicts returns (intent, reason) pairs of conflicting intents.'''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT key, action, book_id, user_code, created_at, '
+                'system_id, reason FROM intents WHERE state = ? ORDER BY seq',
+                (STATE_CONFLICT,)).fetchall()
+        return [(Intent(*row[:6]), row[6]) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _set_state(self, key, state, reason):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE intents SET state = ?, reason = ? WHERE key = ?',
+                (state, reason, key))
+
+
+class Reconciler(object):
+    '''Reconciler replays pending intents of a Journal to kintone
+    in the background.
+
+    apply(intent) must apply the intent, or raise
+    kintone.IntentConflictError if it can never be applied, in which case
+    the intent is marked conflicting and on_conflict(intent, reason) is
+    called. Intents of a book are replayed in the recorded order; if one
+    fails for another reason, e.g. kintone is unreachable, the following
+    intents of the book wait for the next round.
+    '''
+    def __init__(self, journal, apply, on_conflict=None, interval=1):
+        self._journal = journal
+        self._apply = apply
+        self._on_conflict = on_conflict
+        self._interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reconcile(self):
+        '''reconcile replays pending intents once and returns the number
+        of intents which are still pending.'''
+        blocked = set()
+        remaining = 0
+        for intent in self._journal.pending():
+            if intent.book_id in blocked:
+                remaining += 1
+                continue
+            try:
+                self._apply(intent)
+            except kintone.IntentConflictError as e:
+                reason = unicode(e)
+                log(u'journal conflict {}: {}'.format(
+                    intent.key, reason).encode('utf-8'))
+                self._journal.mark_conflict(intent.key, reason)
+                if self._on_conflict is not None:
+                    self._on_conflict(intent, reason)
+                continue
+            except Exception as e:
+                log('failed to replay {}: {}'.format(intent.key, e))
+                blocked.add(intent.book_id)
+                remaining += 1
+                continue
+            self._journal.mark_applied(intent.key)
+        return remaining
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''stop replays pending intents (if possible) and stops the thread.'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            stopping = self._stop.is_set()
+            try:
+                self.reconcile()
+            except Exception as e:
+                log('failed to reconcile journal: {}'.format(e))
+            if stopping:
+                return
+            self._stop.wait(self._interval)
@@ -2,43 +2,121 @@
 # vim: set fileencoding=utf-8
 
 from collections import namedtuple
+import copy
 from datetime import datetime
-import yaml
+import functools
+import re
+from urlparse import urlparse
 
-import pykintone
-import pykintone.model_result as mr
+import config
+from console import log
+import metrics
 
 
 KintoneEnv = namedtuple('KintoneEnv',
-    ['kintone', 'meibo_app_id', 'book_app_id', 'log_app_id'])
+    ['kintone', 'meibo_app_id', 'book_app_id', 'log_app_id', 'direct_assign',
+     'session'])
 
 
 API_USER = 'Administrator'
 SYSTEM_USER = 'kota-uchida'
-
-
-def init():
-    kin = pykintone.load('kintone.yml')
-
-    with open('kintone.yml') as f:
-        apps = yaml.load(f)['apps']
-
-    def get_id(app_name):
+SELECT_LIMIT = 500
+UPDATE_LIMIT = 100
+BULK_REQUEST_LIMIT = 20
+BOOK_UPDATED_TIME_FIELD = u'更新日時'
+STATUS_FREE = u'本棚にあります'
+STATUS_BORROWED = u'レンタル中'
+REVISION_CONFLICT = 'GAIA_CO02'
+MAX_CONFLICT_RETRIES = 3
+INTENT_BORROW = 'borrow'
+INTENT_RETURN = 'return'
+# ISBN-13 starts with 978 or 979, unlike the 192 price code printed next
+# to it on Japanese books and the command barcodes
+ISBN_PATTERN = re.compile(r'^(?:[0-9]{9}[0-9X]|97[89][0-9]{10})$')
+# fields of book records other than those found by type
+BOOK_FIELDS = [u'$id', u'$revision', u'isbn', u'isbn13', u'type']
+
+
+CALL_SECONDS = metrics.histogram('hondana_kintone_call_seconds',
+    'Time spent in functions calling kintone.', 'function')
+CALL_BYTES = metrics.histogram('hondana_kintone_call_bytes',
+    'Bytes received on the wire by functions calling kintone.', 'function',
+    (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+
+
+def _measured(fn):
+    '''_measured observes the time spent in fn and the bytes of the
+    responses it received.'''
+    timed = CALL_SECONDS.timed(fn)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        from httpsession import received_bytes
+        before = received_bytes()
+        try:
+            return timed(*args, **kwargs)
+        finally:
+            CALL_BYTES.observe(fn.__name__, received_bytes() - before)
+    return wrapper
+
+
+BookSchema = namedtuple('BookSchema', ['status', 'assignee', 'updated_time'])
+
+
+class RevisionConflictError(RuntimeError):
+    '''RevisionConflictError is raised when kintone rejects an update
+    because the record has been modified by someone else.'''
+
+
+class IntentConflictError(RuntimeError):
+    '''IntentConflictError is raised when a journaled borrow or return
+    cannot be applied because of the current state of the book.'''
+
+
+@_measured
+def init(conf_path='kintone.yml', cache_dir=None):
+    '''init parses the config file once and creates a KintoneEnv.
+    pykintone and requests are imported here rather than at startup.
+
+    The parsed config, including the credentials, is cached in cache_dir
+    only if it is given.'''
+    from pykintone.account import Account
+    from httpsession import KintoneSession, SessionService
+
+    conf = config.load(conf_path, cache_dir)
+    apps = conf['apps']
+
+    def get_app(app_name):
         for name, value in apps.iteritems():
             if name == app_name:
-                return value['id']
+                return value
         raise SystemError('no such app: ' + app_name)
 
+    # the same as pykintone.account.Account.loads
+    account_args = {'domain': conf['domain']}
+    for k in ['login', 'basic']:
+        if k in conf:
+            account_args[k + '_id'] = conf[k]['id']
+            account_args[k + '_password'] = conf[k]['password']
+
+    session = KintoneSession.from_config(conf.get('session'))
+    service = SessionService(
+        Account(**account_args), session, conf.get('api_root'))
+    for name, value in apps.iteritems():
+        service.app(value['id'], value.get('token', ''), name)
+
     return KintoneEnv(
-        kintone=kin,
-        meibo_app_id=get_id('meibo'),
-        book_app_id=get_id('book'),
-        log_app_id=get_id('log'))
+        kintone=service,
+        meibo_app_id=get_app('meibo')['id'],
+        book_app_id=get_app('book')['id'],
+        log_app_id=get_app('log')['id'],
+        direct_assign=get_app('book').get('direct_assign', False),
+        session=session)
 
 
+@_measured
 def fetch_user_code(env, employee_id):
     app = env.kintone.app(env.meibo_app_id)
-    res = app.select('employeeNumber = "{}"'.format(employee_id))
+    res = app.select('employeeNumber = "{}"'.format(employee_id), ['code'])
     if not res.ok:
         raise RuntimeError(res.error)
     if len(res.records) == 0:
@@ -56,7 +134,94 @@ def fetch_user_code(env, employee_id):
     return user_code
 
 
-def find_book_records(env, isbn):
+@_measured
+def fetch_user_codes(env):
+    '''fetch_user_codes returns a list of (employee_id, user_code)
+    for all employees registered in the meibo app.'''
+    app = env.kintone.app(env.meibo_app_id)
+    pairs = []
+    for r in select_all(app, '', ['$id', 'employeeNumber', 'code']):
+        employee_id = r[u'employeeNumber'][u'value']
+        user_code = r[u'code'][u'value'].strip()
+        if employee_id and user_code != '':
+            pairs.append((employee_id, user_code))
+    return pairs
+
+
+@_measured
+def select_all(app, query='', fields=()):
+    '''select_all fetches all records matching the query.
+
+    Records are paged by $id so that it is not limited by the offset limit
+    of the API. fields must contain '$id' if it is not empty.'''
+    records = []
+    last_id = 0
+    while True:
+        cond = u'$id > {}'.format(last_id)
+        if query:
+            cond = u'({}) and {}'.format(query, cond)
+        res = app.select(u'{} order by $id asc limit {}'.format(
+            cond, SELECT_LIMIT), fields)
+        if not res.ok:
+            raise RuntimeError(res.error)
+        records.extend(res.records)
+        if len(res.records) < SELECT_LIMIT:
+            return records
+        last_id = int(res.records[-1][u'$id'][u'value'])
+
+
+def iter_records(app, query='', fields=(), size=SELECT_LIMIT):
+    '''iter_records yields the records matching the query through the
+    cursor API, so that only a page of records is held at a time.
+    The cursor is deleted if the iteration is stopped early.'''
+    cursor_id = _create_cursor(app, query, fields, size)
+    done = False
+    try:
+        while not done:
+            records, done = _fetch_cursor(app, cursor_id)
+            for r in records:
+                yield r
+    finally:
+        if not done:
+            _delete_cursor(app, cursor_id)
+
+
+@_measured
+def _create_cursor(app, query, fields, size):
+    url = app.API_ROOT.format(app.account.domain, 'records/cursor.json')
+    params = {'app': app.app_id, 'query': query, 'size': size}
+    if fields:
+        params['fields'] = list(fields)
+    resp = app._request('POST', url, params_or_data=params)
+    if not resp.ok:
+        raise RuntimeError('failed to create a cursor: {}'.format(resp.text))
+    return resp.json()['id']
+
+
+@_measured
+def _fetch_cursor(app, cursor_id):
+    '''_fetch_cursor returns the next page of records and whether the
+    cursor has been read to the end.'''
+    url = app.API_ROOT.format(app.account.domain, 'records/cursor.json')
+    resp = app._request('GET', url, params_or_data={'id': cursor_id})
+    if not resp.ok:
+        raise RuntimeError('failed to read a cursor: {}'.format(resp.text))
+    body = resp.json()
+    return body['records'], not body['next']
+
+
+@_measured
+def _delete_cursor(app, cursor_id):
+    url = app.API_ROOT.format(app.account.domain, 'records/cursor.json')
+    resp = app._request('DELETE', url, params_or_data={'id': cursor_id})
+    if not resp.ok:
+        raise RuntimeError('failed to delete a cursor: {}'.format(resp.text))
+
+
+@_measured
+def find_book_records(env, isbn, fields=()):
+    '''find_book_records returns the book records of isbn with fields,
+    or with all fields if it is empty.'''
     if len(isbn) == 10:
         isbn_len = 10
         query = 'isbn = "{}"'
@@ -67,13 +232,208 @@ def find_book_records(env, isbn):
         raise RuntimeError('invalid ISBN length: {}'.format(isbn))
 
     book_app = env.kintone.app(env.book_app_id)
-    res = book_app.select(query.format(isbn))
+    res = book_app.select(query.format(isbn), fields)
     if not res.ok:
         raise RuntimeError(res.error)
 
     return res.records
 
 
+@_measured
+def find_book_records_by_isbns(env, isbns, fields=()):
+    '''find_book_records_by_isbns returns the book records whose ISBN-10
+    or ISBN-13 is one of isbns, querying them all at once.'''
+    isbn10 = []
+    isbn13 = []
+    for isbn in isbns:
+        if not ISBN_PATTERN.match(isbn):
+            raise RuntimeError('invalid ISBN: {}'.format(isbn))
+        (isbn10 if len(isbn) == 10 else isbn13).append(isbn)
+
+    conds = []
+    for code, values in (('isbn', isbn10), ('isbn13', isbn13)):
+        if values:
+            conds.append('{} in ({})'.format(
+                code, ', '.join('"{}"'.format(v) for v in values)))
+    if not conds:
+        return []
+    book_app = env.kintone.app(env.book_app_id)
+    return select_all(book_app, ' or '.join(conds), fields)
+
+
+@_measured
+def find_free_book_records(env, schema, fields=()):
+    '''find_free_book_records returns the book records which should be
+    on the shelf.'''
+    book_app = env.kintone.app(env.book_app_id)
+    return select_all(book_app,
+        u'{} in ("{}")'.format(schema.status, STATUS_FREE), fields)
+
+
+@_measured
+def fetch_book_records_updated_since(env, since=None, fields=()):
+    '''fetch_book_records_updated_since returns all book records updated
+    at or after since, which is a value of the updated time field.
+    If since is None, it returns all book records.'''
+    query = ''
+    if since is not None:
+        query = u'{} >= "{}"'.format(BOOK_UPDATED_TIME_FIELD, since)
+    book_app = env.kintone.app(env.book_app_id)
+    return select_all(book_app, query, fields)
+
+
+def iter_book_records_updated_since(env, since=None, fields=()):
+    '''iter_book_records_updated_since yields the book records updated at
+    or after since in the order of the updated time, through a cursor.'''
+    query = u'order by {0} asc, $id asc'.format(BOOK_UPDATED_TIME_FIELD)
+    if since is not None:
+        query = u'{0} >= "{1}" {2}'.format(
+            BOOK_UPDATED_TIME_FIELD, since, query)
+    book_app = env.kintone.app(env.book_app_id)
+    return iter_records(book_app, query, fields)
+
+
+@_measured
+def fetch_book_schema(env):
+    '''fetch_book_schema returns the BookSchema of the book app
+    from its form.'''
+    book_app = env.kintone.app(env.book_app_id)
+    url = book_app.API_ROOT.format(
+        book_app.account.domain, "app/form/fields.json")
+    resp = book_app._request("GET", url, params_or_data={"app": book_app.app_id})
+    if not resp.ok:
+        raise RuntimeError('failed to fetch the form: {}'.format(resp.text))
+    return resolve_book_schema(resp.json()[u'properties'])
+
+
+def resolve_book_schema(fields):
+    '''resolve_book_schema returns the BookSchema of fields, which are
+    either the properties of a form or a record.'''
+    codes = {}
+    for code, field in fields.iteritems():
+        codes.setdefault(field[u'type'], code)
+    return BookSchema(status=codes.get(u'STATUS'),
+        assignee=codes.get(u'STATUS_ASSIGNEE'),
+        updated_time=codes.get(u'UPDATED_TIME'))
+
+
+def book_fields(schema):
+    '''book_fields returns the fields of book records read into BookView,
+    or an empty list, meaning all fields, if schema is None or incomplete.'''
+    if schema is None or None in schema:
+        return []
+    return BOOK_FIELDS + list(schema)
+
+
+class BookView(object):
+    '''BookView is a compact, read-only view of a book record with the
+    fields hondana uses. The codes of the status, assignee and updated time
+    fields are taken from a BookSchema rather than searched by type.'''
+    __slots__ = ('schema', 'id', 'revision', 'isbn', 'isbn13', 'genre',
+        'status', 'assignees', 'updated_time')
+
+    @classmethod
+    def from_record(cls, record, schema=None):
+        '''from_record decodes a record. If schema is None, it is resolved
+        from the record.'''
+        if schema is None:
+            schema = resolve_book_schema(record)
+        view = cls()
+        view.schema = schema
+        view.id = _field_value(record, u'$id')
+        revision = _field_value(record, u'$revision')
+        view.revision = None if revision is None else int(revision)
+        view.isbn = _field_value(record, u'isbn')
+        view.isbn13 = _field_value(record, u'isbn13')
+        view.genre = _shared(_field_value(record, u'type'))
+        view.status = _shared(_field_value(record, schema.status))
+        view.assignees = tuple(
+            (a[u'code'], a[u'name'])
+            for a in _field_value(record, schema.assignee) or ())
+        view.updated_time = _field_value(record, schema.updated_time)
+        return view
+
+    def to_record(self):
+        '''to_record returns a record with the fields of this view,
+        which is enough to update the book.'''
+        fields = [
+            (u'$id', u'__ID__', self.id),
+            (u'$revision', u'__REVISION__',
+                None if self.revision is None else unicode(self.revision)),
+            (u'isbn', u'SINGLE_LINE_TEXT', self.isbn),
+            (u'isbn13', u'SINGLE_LINE_TEXT', self.isbn13),
+            (u'type', u'DROP_DOWN', self.genre),
+            (self.schema.status, u'STATUS', self.status),
+            (self.schema.assignee, u'STATUS_ASSIGNEE',
+                [{u'code': c, u'name': n} for c, n in self.assignees]),
+            (self.schema.updated_time, u'UPDATED_TIME', self.updated_time),
+        ]
+        return dict((code, {u'type': t, u'value': v})
+                    for code, t, v in fields
+                    if code is not None and v is not None)
+
+    def isbns(self):
+        return [isbn for isbn in (self.isbn, self.isbn13) if isbn]
+
+    def is_free(self):
+        return self.status == STATUS_FREE
+
+    def is_borrowed_by(self, user_code):
+        if self.status != STATUS_BORROWED:
+            return False
+        for code, _ in self.assignees:
+            if code == user_code:
+                return True
+        return False
+
+    def assignee_codes(self):
+        return [code for code, _ in self.assignees]
+
+    def user_names(self):
+        return [format_user_name(name) for _, name in self.assignees]
+
+    def to_dict(self):
+        '''to_dict returns the view as a dict to be dumped as JSON.'''
+        return {
+            'id': self.id,
+            'isbn': self.isbn,
+            'isbn13': self.isbn13,
+            'genre': self.genre,
+            'status': self.status,
+            'borrowers': [{'code': code, 'name': name}
+                          for code, name in self.assignees],
+        }
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, BookView) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'BookView(id={!r}, revision={!r}, status={!r})'.format(
+            self.id, self.revision, self.status)
+
+
+def _field_value(record, code):
+    field = record.get(code) if code is not None else None
+    if field is None:
+        return None
+    return field[u'value']
+
+
+# statuses and genres are shared by many books
+_shared_values = {}
+
+def _shared(value):
+    if value is None:
+        return None
+    return _shared_values.setdefault(value, value)
+
+
 def find_field_by_type(record, field_type):
     for k, v in record.iteritems():
         if v[u'type'] == field_type:
@@ -88,12 +448,12 @@ def book_is_borrowed(record, user_code):
 
     for v in assignee[u'value']:
         if v[u'code'] == user_code:
-            return get_record_status(record) == u'レンタル中'
+            return get_record_status(record) == STATUS_BORROWED
     return False
 
 
 def book_is_free(record):
-    return get_record_status(record) == u'本棚にあります'
+    return get_record_status(record) == STATUS_FREE
 
 def find_first(records, pred):
     for r in records:
@@ -111,7 +471,10 @@ def get_borrowing_users(records):
     return users
 
 def get_user_name(assignee):
-    return assignee[u'name'].encode('utf-8').replace(' ', '').replace('　', '')
+    return format_user_name(assignee[u'name'])
+
+def format_user_name(name):
+    return name.encode('utf-8').replace(' ', '').replace('　', '')
         
 def get_record_status(record):
     status = find_field_by_type(record, u'STATUS')
@@ -121,41 +484,283 @@ def get_record_status(record):
     return status[u'value']
 
 
+def get_record_updated_time(record):
+    updated_time = find_field_by_type(record, u'UPDATED_TIME')
+    if updated_time is None:
+        return None
+
+    return updated_time[u'value']
+
+
+def updated_record(record, revision, status=None, user_codes=None):
+    '''updated_record returns a copy of record with the given revision,
+    status and assignees.'''
+    record = copy.deepcopy(record)
+    record[u'$revision'] = {u'type': u'__REVISION__', u'value': unicode(revision)}
+    if status is not None:
+        find_field_by_type(record, u'STATUS')[u'value'] = status
+    if user_codes is not None:
+        # names are unknown here; they are filled by the next fetch.
+        find_field_by_type(record, u'STATUS_ASSIGNEE')[u'value'] = [
+            {u'code': c, u'name': c} for c in user_codes]
+    return record
+
+
+def get_assignee_codes(record):
+    assignee = find_field_by_type(record, u'STATUS_ASSIGNEE')
+    if assignee is None:
+        return []
+
+    return [v[u'code'] for v in assignee[u'value']]
+
+
+@_measured
 def borrow_book(env, book_record, user_code):
+    '''borrow_book returns the updated record,
+    or None if the book is not free.
+
+    Each write is chained on the revision returned by the previous one.
+    If the book app lets the system_borrow action choose any user as the
+    assignee (direct_assign), the status and the assignee are changed in
+    a single call.'''
+    if not book_is_free(book_record):
+        return None
+
     book_app = env.kintone.app(env.book_app_id)
-    if book_is_free(book_record):
-        res = book_app.proceed(book_record, u'system_borrow', SYSTEM_USER)
-        if not res.ok:
-            raise RuntimeError(res.error)
-        res = book_app.get(book_record['$id']['value'])
-        if not res.ok:
-            raise RuntimeError(res.error)
-        book_record = res.record
-        res = set_assignee(env, book_record, [user_code])
-        if not res.ok:
-            raise RuntimeError(res.error)
-        return True
-    return False
+    def borrow(book_record):
+        if book_is_free(book_record):
+            if env.direct_assign:
+                revision = proceed(env, book_record, u'system_borrow', user_code)
+                return updated_record(
+                    book_record, revision, STATUS_BORROWED, [user_code])
+            revision = proceed(env, book_record, u'system_borrow', SYSTEM_USER)
+            book_record = updated_record(
+                book_record, revision, STATUS_BORROWED, [SYSTEM_USER])
+
+        if (get_record_status(book_record) == STATUS_BORROWED and
+                get_assignee_codes(book_record) == [SYSTEM_USER]):
+            revision = _check(set_assignee(env, book_record, [user_code])).revision
+            return updated_record(book_record, revision, user_codes=[user_code])
+        return None
 
+    return _retry_on_conflict(book_app, book_record, borrow)
 
+
+@_measured
 def return_book(env, book_record, user_code):
+    '''return_book returns the updated record,
+    or None if the book is not borrowed by user_code.
+
+    The assignee is cleared first so that the API user can proceed
+    the status, and the two writes are chained on the revision.'''
+    if not book_is_borrowed(book_record, user_code):
+        return None
+
     book_app = env.kintone.app(env.book_app_id)
-    if book_is_borrowed(book_record, user_code):
-        res = set_assignee(env, book_record, [])
-        if not res.ok:
-            raise RuntimeError(res.error)
-        res = book_app.get(book_record['$id']['value'])
-        if not res.ok:
-            raise RuntimeError(res.error)
-        book_record = res.record
-        res = book_app.proceed(book_record, u'返す')
-        if not res.ok:
-            raise RuntimeError(res.error)
-        return True
-    return False
+    def return_(book_record):
+        if book_is_borrowed(book_record, user_code):
+            revision = _check(set_assignee(env, book_record, [])).revision
+            book_record = updated_record(book_record, revision, user_codes=[])
+
+        if (get_record_status(book_record) == STATUS_BORROWED and
+                get_assignee_codes(book_record) == []):
+            revision = proceed(env, book_record, u'返す')
+            return updated_record(book_record, revision, status=STATUS_FREE)
+        return None
+
+    return _retry_on_conflict(book_app, book_record, return_)
+
+
+@_measured
+def borrow_books(env, book_records, user_code):
+    '''borrow_books borrows the free books of book_records and returns
+    their updated records in the same order, with None for the books
+    not borrowed.
+
+    The books are borrowed in bulk requests, which kintone applies all
+    or nothing. If kintone rejects a bulk request, e.g. because one of
+    the books has been changed by someone else, its books are borrowed
+    one by one. If a request fails on the way, e.g. by a timeout, its
+    books are counted as not borrowed, and the other requests go on.'''
+    def bulk(records):
+        if env.direct_assign:
+            results = _bulk_request(env, [
+                _status_request(env, records, u'system_borrow', user_code)])
+            revisions = [r['revision'] for r in results[0]['records']]
+        else:
+            # the assignees are changed in the same transaction,
+            # so their revisions need not be checked
+            results = _bulk_request(env,
+                [_status_request(env, records, u'system_borrow', SYSTEM_USER)] +
+                [_assignees_request(env, r, [user_code], check_revision=False)
+                 for r in records])
+            revisions = [r['revision'] for r in results[1:]]
+        return [updated_record(r, rev, STATUS_BORROWED, [user_code])
+                for r, rev in zip(records, revisions)]
+
+    chunk_size = UPDATE_LIMIT if env.direct_assign else BULK_REQUEST_LIMIT - 1
+    return _update_in_bulk(book_records, book_is_free, chunk_size, bulk,
+        lambda r: borrow_book(env, r, user_code))
+
+
+@_measured
+def return_books(env, book_records, user_code):
+    '''return_books returns the books of book_records borrowed by
+    user_code and returns their updated records in the same order,
+    with None for the books not returned. See borrow_books.'''
+    def bulk(records):
+        results = _bulk_request(env,
+            [_assignees_request(env, r, []) for r in records] +
+            [_status_request(env, records, u'返す', check_revision=False)])
+        revisions = [r['revision'] for r in results[-1]['records']]
+        return [updated_record(r, rev, STATUS_FREE, [])
+                for r, rev in zip(records, revisions)]
+
+    return _update_in_bulk(book_records,
+        lambda r: book_is_borrowed(r, user_code), BULK_REQUEST_LIMIT - 1,
+        bulk, lambda r: return_book(env, r, user_code))
+
+
+def _update_in_bulk(book_records, pred, chunk_size, bulk, update_one):
+    updated = [None] * len(book_records)
+    indices = [i for i, r in enumerate(book_records) if pred(r)]
+    for begin in range(0, len(indices), chunk_size):
+        chunk = indices[begin:begin+chunk_size]
+        records = [book_records[i] for i in chunk]
+        try:
+            results = bulk(records)
+        except RuntimeError as e:
+            log('bulk update failed, updating one by one: {}'.format(e))
+            results = [_or_none(update_one, r) for r in records]
+        except Exception as e:
+            # e.g. a connection error of requests, which may or may not
+            # have been applied; the catalog sees the result on its sync
+            log('bulk update failed: {}'.format(e))
+            results = [None] * len(records)
+        for i, r in zip(chunk, results):
+            updated[i] = r
+    return updated
+
+
+def _or_none(update_one, book_record):
+    try:
+        return update_one(book_record)
+    except Exception as e:
+        log('update of book {} failed: {}'.format(
+            book_record[u'$id'][u'value'], e))
+        return None
+
+
+def _status_request(env, book_records, action, assignee='',
+        check_revision=True):
+    book_app = env.kintone.app(env.book_app_id)
+    records = []
+    for r in book_records:
+        record = {
+            'id': int(r[u'$id'][u'value']),
+            'action': action,
+            'revision': int(r[u'$revision'][u'value']) if check_revision else -1,
+        }
+        if assignee:
+            record['assignee'] = assignee
+        records.append(record)
+    return {
+        'method': 'PUT',
+        'api': _api_path(book_app, 'records/status.json'),
+        'payload': {'app': book_app.app_id, 'records': records},
+    }
+
+
+def _assignees_request(env, book_record, user_codes, check_revision=True):
+    book_app = env.kintone.app(env.book_app_id)
+    return {
+        'method': 'PUT',
+        'api': _api_path(book_app, 'record/assignees.json'),
+        'payload': {
+            'app': book_app.app_id,
+            'id': int(book_record[u'$id'][u'value']),
+            'assignees': user_codes,
+            'revision': (int(book_record[u'$revision'][u'value'])
+                         if check_revision else -1),
+        },
+    }
+
+
+def _api_path(app, api):
+    return urlparse(app.API_ROOT.format(app.account.domain, api)).path
+
+
+def _bulk_request(env, requests):
+    '''_bulk_request sends requests in a transaction and returns
+    their results.'''
+    book_app = env.kintone.app(env.book_app_id)
+    url = book_app.API_ROOT.format(book_app.account.domain, 'bulkRequest.json')
+    resp = book_app._request('POST', url, params_or_data={'requests': requests})
+    if not resp.ok:
+        raise RuntimeError('bulk request failed: {}'.format(resp.text))
+    return resp.json()['results']
 
 
+@_measured
+def replay_intent(env, action, book_id, user_code):
+    '''replay_intent applies a journaled borrow or return to the latest
+    record of book_id and returns the updated record.
+
+    An intent which has already been applied, e.g. by a replay which
+    was interrupted before being marked as applied, is not applied twice.'''
+    book_app = env.kintone.app(env.book_app_id)
+    book_record = _check(book_app.get(book_id)).record
+    if action == INTENT_BORROW:
+        if book_is_borrowed(book_record, user_code):
+            return book_record
+        updated = borrow_book(env, book_record, user_code)
+    elif action == INTENT_RETURN:
+        if book_is_free(book_record):
+            return book_record
+        updated = return_book(env, book_record, user_code)
+    else:
+        raise ValueError('unknown intent: {}'.format(action))
+
+    if updated is None:
+        raise IntentConflictError(
+            u'cannot {} book {} for {}: {} by {}'.format(
+                action, book_id, user_code, get_record_status(book_record),
+                u','.join(get_assignee_codes(book_record))))
+    return updated
+
+
+def _retry_on_conflict(book_app, book_record, update):
+    '''_retry_on_conflict calls update(book_record) and, if the revision
+    does not match, calls it again with the latest record so that update
+    can resume from the state someone else has left.'''
+    for i in range(MAX_CONFLICT_RETRIES):
+        try:
+            return update(book_record)
+        except RevisionConflictError:
+            res = _check(book_app.get(book_record[u'$id'][u'value']))
+            book_record = res.record
+    return update(book_record)
+
+
+@_measured
+def proceed(env, book_record, action, assignee=''):
+    '''proceed executes the action on the record and returns
+    the new revision.'''
+    book_app = env.kintone.app(env.book_app_id)
+    return _check(book_app.proceed(book_record, action, assignee)).revision
+
+
+def _check(res):
+    if not res.ok:
+        if res.error.code == REVISION_CONFLICT:
+            raise RevisionConflictError(res.error)
+        raise RuntimeError(res.error)
+    return res
+
+
+@_measured
 def set_assignee(env, book_record, user_codes):
+    import pykintone.model_result as mr
     book_app = env.kintone.app(env.book_app_id)
     url = book_app.API_ROOT.format(
         book_app.account.domain, "record/assignees.json")
@@ -172,16 +777,48 @@ def set_assignee(env, book_record, user_codes):
     return r
 
 
-def add_log(env, system_id, msg, logged_at=None):
-    if logged_at is None:
-        logged_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+def now_logged_at():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
 
-    log_app = env.kintone.app(env.log_app_id)
-    res = log_app.create({
+
+def log_record(system_id, msg, logged_at):
+    return {
         'logged_at': {'value': logged_at},
         'system_id': {'value': system_id},
         'message': {'value': msg}
-    })
+    }
+
+
+def iter_logs_after(env, last_id=None):
+    '''iter_logs_after yields the log records added after the one of
+    last_id in the order of $id, through a cursor.'''
+    query = 'order by $id asc'
+    if last_id is not None:
+        query = '$id > {} {}'.format(last_id, query)
+    log_app = env.kintone.app(env.log_app_id)
+    return iter_records(log_app, query,
+        ['$id', 'logged_at', 'system_id', 'message'])
+
+
+@_measured
+def add_log(env, system_id, msg, logged_at=None):
+    if logged_at is None:
+        logged_at = now_logged_at()
+
+    log_app = env.kintone.app(env.log_app_id)
+    res = log_app.create(log_record(system_id, msg, logged_at))
 
     if not res.ok:
         raise RuntimeError(res.error)
+
+
+@_measured
+def add_logs(env, logs):
+    '''add_logs adds (system_id, msg, logged_at) tuples to the log app
+    with the bulk records API.'''
+    log_app = env.kintone.app(env.log_app_id)
+    for i in range(0, len(logs), UPDATE_LIMIT):
+        res = log_app.batch_create(
+            [log_record(*l) for l in logs[i:i+UPDATE_LIMIT]])
+        if not res.ok:
+            raise RuntimeError(res.error)
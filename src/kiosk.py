@@ -0,0 +1,122 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import mimetypes
+import os
+from SocketServer import ThreadingMixIn
+import threading
+
+
+class KioskServer(ThreadingMixIn, HTTPServer):
+    '''KioskServer serves the bookshelf page to a long-lived browser and
+    pushes the genre to highlight with server-sent events.'''
+    daemon_threads = True
+    HEARTBEAT_INTERVAL = 15
+    # static_dir is the working directory, which also holds kintone.yml
+    # and the journal, so only the assets of the page are served
+    STATIC_FILES = frozenset(['hondana.png'])
+
+    def __init__(self, address, html_template, static_dir):
+        HTTPServer.__init__(self, address, _KioskHandler)
+        self.html_template = html_template
+        self.static_dir = static_dir
+        self._genre = ''
+        self._version = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_port)
+
+    def push(self, genre_class):
+        '''push makes every connected page highlight genre_class,
+        or nothing if genre_class is empty.'''
+        with self._cond:
+            if genre_class == self._genre:
+                return
+            self._genre = genre_class
+            self._version += 1
+            self._cond.notify_all()
+
+    def current(self):
+        with self._cond:
+            return self._version, self._genre
+
+    def wait_change(self, version, timeout):
+        '''wait_change waits until the genre changes from version and
+        returns the latest (version, genre), or None if closed.'''
+        with self._cond:
+            if self._version == version and not self._closed:
+                self._cond.wait(timeout)
+            if self._closed:
+                return None
+            return self._version, self._genre
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+
+class _KioskHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/':
+            _, genre = self.server.current()
+            html = self.server.html_template.render(genre=genre, kiosk=True)
+            self._send(200, 'text/html; charset=utf-8', html.encode('utf-8'))
+        elif self.path == '/events':
+            self._stream_events()
+        else:
+            self._send_static(self.path.lstrip('/'))
+
+    def _stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        version, genre = self.server.current()
+        try:
+            self.wfile.write('data: {}\n\n'.format(genre))
+            while True:
+                self.wfile.flush()
+                changed = self.server.wait_change(
+                    version, self.server.HEARTBEAT_INTERVAL)
+                if changed is None:
+                    return
+                if changed[0] == version:
+                    self.wfile.write(': heartbeat\n\n')
+                    continue
+                version, genre = changed
+                self.wfile.write('data: {}\n\n'.format(genre))
+        except IOError:
+            # the browser has gone
+            pass
+
+    def _send_static(self, name):
+        path = os.path.join(self.server.static_dir, name)
+        if name not in self.server.STATIC_FILES or not os.path.isfile(path):
+            self._send(404, 'text/plain', 'not found')
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self._send(200, content_type, body)
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
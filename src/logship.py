@@ -0,0 +1,136 @@
+import json
+import os
+import Queue
+import threading
+import time
+
+from console import log
+import kintone
+
+
+class LogShipper(object):
+    '''LogShipper sends logs to the log app in the background.
+
+    put() never blocks. Queued logs are appended to a spool file under
+    spool_dir before being sent, so logs which could not be sent survive
+    a restart. ship(logs) is called with at most batch_size
+    (system_id, msg, logged_at) tuples when batch_size logs are pending
+    or flush_interval seconds have passed since the oldest one.
+    A log may be sent twice if the process dies right after sending it.
+    After a failure, sending is retried after flush_interval seconds,
+    doubled on each failure up to max_backoff seconds.
+    '''
+    SPOOL_FILE = 'log_spool.jsonl'
+
+    def __init__(self, ship, spool_dir, batch_size=kintone.UPDATE_LIMIT,
+            flush_interval=5, max_backoff=300):
+        self._ship = ship
+        self._spool_path = os.path.join(spool_dir, self.SPOOL_FILE)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_backoff = max_backoff
+        self._queue = Queue.Queue()
+        self._pending = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def put(self, system_id, msg, logged_at=None):
+        if logged_at is None:
+            logged_at = kintone.now_logged_at()
+        self._queue.put_nowait((system_id, msg, logged_at))
+
+    def start(self):
+        self._pending = self._load_spool()
+        self._spool = open(self._spool_path, 'a')
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''stop sends all queued logs (if possible) and stops the thread.'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        deadline = None
+        backoff = 0
+        while True:
+            stopping = self._stop.is_set()
+            timeout = 0.5
+            if deadline is not None:
+                timeout = max(0, min(timeout, deadline - time.time()))
+            try:
+                self._spool_entry(self._queue.get(timeout=timeout))
+                while len(self._pending) < self._batch_size:
+                    self._spool_entry(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            if not self._pending:
+                deadline = None
+            elif deadline is None:
+                deadline = time.time() + self._flush_interval
+
+            # a full batch does not bring a retry forward
+            backing_off = (backoff and not stopping and
+                           time.time() < deadline)
+            if self._pending and not backing_off and (stopping or
+                    len(self._pending) >= self._batch_size or
+                    time.time() >= deadline):
+                if self._flush():
+                    deadline = None
+                    backoff = 0
+                else:
+                    backoff = min(self._max_backoff,
+                                  backoff * 2 or self._flush_interval)
+                    deadline = time.time() + backoff
+
+            if stopping and self._queue.empty():
+                self._spool.close()
+                return
+
+    def _spool_entry(self, entry):
+        self._spool.write(json.dumps(entry) + '\n')
+        self._spool.flush()
+        os.fsync(self._spool.fileno())
+        self._pending.append(entry)
+
+    def _flush(self):
+        '''_flush sends pending logs and returns True if all of them
+        have been sent.'''
+        try:
+            while self._pending:
+                self._ship(self._pending[:self._batch_size])
+                self._pending = self._pending[self._batch_size:]
+                self._rewrite_spool()
+        except Exception as e:
+            log('failed to ship logs: {}'.format(e))
+            return False
+        return True
+
+    def _rewrite_spool(self):
+        tmp_path = self._spool_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for entry in self._pending:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._spool_path)
+        self._spool.close()
+        self._spool = open(self._spool_path, 'a')
+
+    def _load_spool(self):
+        if not os.path.exists(self._spool_path):
+            return []
+
+        entries = []
+        with open(self._spool_path) as f:
+            for line in f:
+                try:
+                    entries.append(tuple(json.loads(line)))
+                except ValueError:
+                    # a line torn by a crash
+                    log('broken log in spool: {!r}'.format(line))
+        return entries
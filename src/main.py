@@ -1,12 +1,12 @@
 #!/usr/bin/python
 # vim: set encoding=utf-8
+import argparse
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from collections import namedtuple
 from datetime import datetime, timedelta
-import jinja2
 import json
 import logging
-import nfc
+from multiprocessing.pool import ThreadPool
 import os
 import Queue
 import select
@@ -18,12 +18,39 @@ import threading
 import time
 import re
 from urlparse import urlparse
-import requests
 
+import audio
+from audio import AudioScheduler
+from cache import TTLCache
+from catalog import BookCatalog
+import config
+from console import log
+from directory import UserDirectory
+from inputsource import EvdevSource, FdSource
+from journal import Journal, Reconciler
+from kiosk import KioskServer
 import kintone
+from logship import LogShipper
+import metrics
+from metrics import MetricsServer
+from query import QueryServer
+from runtime import (
+        AsyncLineStream, CancelledError, EventLoop, Return, TimeoutError,
+        wait_for)
+from speechcache import SpeechCache
+from stocktake import Stocktaker, report_to_dict
 
 
 TEMPDIR = '/run/librarypi'
+SPEECH_CACHE_DIR = os.path.join(TEMPDIR, 'speech')
+# TEMPDIR does not survive a reboot
+JOURNAL_PATH = './journal.sqlite3'
+
+STAGE_SECONDS = metrics.histogram('hondana_stage_seconds',
+    'Time spent in each stage of a borrow or return transaction.', 'stage')
+STATION_SECONDS = metrics.histogram('hondana_station_transaction_seconds',
+    'Time spent in a transaction after a card touch at each station.',
+    'station')
 CMD_BORROW = '2000000000008'
 CMD_RETURN = '1000000000009'
 DEVNULL = open('/dev/null', 'w')
@@ -33,48 +60,81 @@ terminating = False
 
 
 class LineReader(object):
+    '''LineReader splits appended bytes into lines.
+
+    Appending and consuming are amortized O(1) per byte: consumed bytes
+    are only dropped from the buffer when they make up half of it, and
+    the search for LF resumes where the previous one stopped.
+    '''
     def __init__(self):
-        self._pool = ''
+        self._pool = bytearray()
+        self._pos = 0
+        self._scanned = 0
 
     def append(self, dat):
         self._pool += dat
 
     def readline(self):
         '''Reads until a LF character and returns it without a LF character.'''
-        lf_pos = self._pool.find('\n')
+        lf_pos = self._pool.find('\n', self._scanned)
         if lf_pos == -1:
+            self._scanned = len(self._pool)
             return None
-        line = self._pool[:lf_pos]
-        self._pool  = self._pool[lf_pos+1:]
+        line = str(self._pool[self._pos:lf_pos])
+        self._consume(lf_pos + 1)
         return line
 
     def skiplines(self):
-        lf_pos = self._pool.rfind('\n')
+        lf_pos = self._pool.rfind('\n', self._pos)
         if lf_pos == -1:
             return
-        self._pool = self._pool[lf_pos+1:]
+        self._consume(lf_pos + 1)
+
+    def _consume(self, pos):
+        self._pos = self._scanned = pos
+        if self._pos * 2 >= len(self._pool):
+            del self._pool[:self._pos]
+            self._pos = self._scanned = 0
 
 
 class ThreadLineReader(threading.Thread):
-    def __init__(self, read_fd):
+    def __init__(self, source, stream=False):
+        '''source is an input source such as inputsource.FdSource,
+        or a file descriptor to read.
+
+        If stream is True, every line is kept to be read regardless of
+        the next flag, e.g. to read barcodes scanned in a row.'''
         super(ThreadLineReader, self).__init__()
-        self._read_fd = read_fd
+        if isinstance(source, int):
+            source = FdSource(source)
+        self._source = source
+        self._stream = stream
         self._line_reader = LineReader()
         self._next_flag = threading.Event()
         self._quit_pipe, self._quit_pipe_write = os.pipe()
         self._lines = Queue.Queue()
+        self._terminated = threading.Event()
 
         # for testing
         self._processed = threading.Event()
 
     def run(self):
+        read_fd = self._source.fileno()
         poll = select.poll()
-        poll.register(self._read_fd, select.POLLIN | select.POLLPRI | select.POLLHUP)
+        poll.register(read_fd, select.POLLIN | select.POLLPRI | select.POLLHUP)
         poll.register(self._quit_pipe, select.POLLHUP)
 
-        reader = LineReader()
+        reader = self._line_reader
         def process_line(readbytes):
             reader.append(readbytes)
+            if self._stream:
+                line = reader.readline()
+                while line is not None:
+                    self._lines.put(line)
+                    line = reader.readline()
+                self._processed.set()
+                return
+
             line = reader.readline()
             if line is None:
                 return
@@ -96,22 +156,33 @@ class ThreadLineReader(threading.Thread):
                 if fd == self._quit_pipe and (ev & select.POLLHUP) != 0:
                     # quit
                     return
-                elif fd == self._read_fd and (ev & (select.POLLIN | select.POLLPRI)) != 0:
+                elif fd == read_fd and (ev & (select.POLLIN | select.POLLPRI)) != 0:
                     # there are some data
-                    readbytes = os.read(fd, 1024)
-                    if not readbytes:
+                    readbytes = self._source.read()
+                    if readbytes == '':
                         # EOF
                         return
-                    process_line(readbytes)
-                elif fd == self._read_fd and (ev & select.POLLHUP) != 0:
+                    if readbytes is not None:
+                        process_line(readbytes)
+                elif fd == read_fd and (ev & select.POLLHUP) != 0:
                     # read_fd closed
                     return
                 else:
-                    self.log(msg)
+                    self.log('unexpected poll event: {}'.format(e))
 
     def set_next_flag(self):
         '''set_next_flag sets the next flag, which requests this reader
-        to read a line inputted after calling this method.'''
+        to read a line inputted after calling this method.
+
+        Lines read for an earlier request and not taken by readline, e.g.
+        a barcode scanned after the previous procedure gave up, are
+        discarded so that they are not taken as the answer to this one.'''
+        if not self._stream:
+            while True:
+                try:
+                    self._lines.get(block=False)
+                except Queue.Empty:
+                    break
         self._next_flag.set()
 
     def readline(self, timeout=None):
@@ -119,23 +190,30 @@ class ThreadLineReader(threading.Thread):
 
         If the next flag is not set, readline returns immediately
         the last inputted value or None.
-        Otherwise, readline waits until at least one line comes and returns
-        the inputted value. If it timed out, then returns None.
+        Otherwise, or in the stream mode, readline waits until at least
+        one line comes and returns the inputted value. If it timed out,
+        then returns None.
         '''
-        if not self._next_flag.is_set():
+        if not self._stream and not self._next_flag.is_set():
             try:
                 return self._lines.get(block=False)
             except Queue.Empty:
                 return None
 
+        if self._terminated.is_set():
+            return None
         try:
             return self._lines.get(block=True, timeout=timeout)
         except Queue.Empty:
             return None
 
     def terminate(self):
-        '''terminate requests this thread to be stopped.'''
+        '''terminate requests this thread to be stopped. A readline
+        waiting for a line returns None.'''
+        self._terminated.set()
         os.close(self._quit_pipe_write)
+        # wakes up a readline waiting for a line
+        self._lines.put(None)
 
     def log(self, msg):
         '''log logs the given message. User can override this method.'''
@@ -163,18 +241,35 @@ def speech(msg):
     check_call(cmd, stderr=DEVNULL)
 
 
+def play_wav(wav_path):
+    cmd = ['aplay', wav_path]
+    check_call(cmd, stderr=DEVNULL)
+
+
 def fetch_employee_id(tag):
+    import nfc.tag.tt3
     sc = nfc.tag.tt3.ServiceCode(93, 0x0b)
     bc = nfc.tag.tt3.BlockCode(1, service=0)
     data = tag.read_without_encryption([sc], [bc])
     if data[6:9] == 'CBZ':
         return data[10:]
 
-    log.warning('No employee id: %s', data)
+    log('No employee id: {!r}'.format(data))
     return None
 
 
+_genre_classes = TTLCache(256)
+
+
 def get_genre_class(genre):
+    genre_class = _genre_classes.get(genre)
+    if genre_class is None:
+        genre_class = _get_genre_class(genre)
+        _genre_classes.put(genre, genre_class)
+    return genre_class
+
+
+def _get_genre_class(genre):
     genre = re.sub(r'\[.*\]', '', genre)
     if genre in DICTIONARY:
         return DICTIONARY[genre]
@@ -218,14 +313,47 @@ class Messages(object):
     KINTONE_ERROR = MessagePair(
         'kintone returned an error',
         'キントーンがエラーを返しました')
+    SESSION_BOOK_ADDED = MessagePair(
+        'added {isbn} ({count} books in this session)',
+        None)
+    NOT_BORROWED_BY_YOU = MessagePair(
+        '{isbn} is not borrowed by you',
+        None)
+    SESSION_COMPLETED = MessagePair(
+        'borrowed {borrowed} and returned {returned} books',
+        '{borrowed}冊のかしだしと{returned}冊の返却が完了しました')
+    SESSION_FAILED = MessagePair(
+        '{count} books could not be processed',
+        '{count}冊は手続きできませんでした。画面を確認してください。')
+
+    @classmethod
+    def static_speeches(cls):
+        '''static_speeches returns speech texts which have no placeholders.'''
+        return sorted(set(
+            m.speech for m in vars(cls).itervalues()
+            if isinstance(m, cls.MessagePair) and m.speech and '{' not in m.speech))
 
 
 class MessagePrinter(object):
+    def __init__(self, speech_cache=None, audio=None, prefix=''):
+        self._speech_cache = speech_cache
+        self._audio = audio
+        self._prefix = prefix
+
     def put(self, msg_pair, **kwargs):
+        '''put prints and speaks the message. If an audio scheduler is
+        given, it returns the scheduled clip without waiting for it.'''
         if msg_pair.log:
-            print_flush(msg_pair.log.format(**kwargs))
+            print_flush(self._prefix + msg_pair.log.format(**kwargs))
         if msg_pair.speech:
-            speech(msg_pair.speech.format(**kwargs))
+            text = msg_pair.speech.format(**kwargs)
+            with STAGE_SECONDS.time('audio'):
+                if self._speech_cache is None:
+                    speech(text)
+                elif self._audio is None:
+                    play_wav(self._speech_cache.get(text))
+                else:
+                    return self._audio.play(self._speech_cache.get(text))
 
 
 class EpiphanyBrowser(object):
@@ -233,8 +361,7 @@ class EpiphanyBrowser(object):
         self._process = None
 
     def open(self, url):
-        cmd = ['epiphany', '-a', '--profile', '/home/pi/.epiconfig',
-                self._temporary_html_path]
+        cmd = ['epiphany', '-a', '--profile', '/home/pi/.epiconfig', url]
         self._process = Popen(cmd, close_fds=True, stderr=DEVNULL)
 
     def close(self):
@@ -246,36 +373,104 @@ class EpiphanyBrowser(object):
 
 
 class BrowserReturnPositioner(object):
-    def __init__(self, browser, html_template, temporary_dir_path):
+    '''BrowserReturnPositioner opens a page per genre in the browser.
+
+    Pages of the genres in DICTIONARY are rendered by prerender(), and pages
+    of other genres are rendered on demand and kept up to max_other_pages.
+    '''
+    PAGE_PREFIX = 'genre-'
+
+    def __init__(self, browser, html_template, temporary_dir_path,
+            max_other_pages=16):
         self._browser = browser
         self._html_template = html_template
-        self._temporary_html_path = None
         self._temporary_dir_path = temporary_dir_path
+        self._pages = {}
+        self._other_pages = TTLCache(max_other_pages,
+            on_evict=lambda genre_class, path: os.remove(path))
+
+    def prerender(self):
+        '''prerender removes pages left by a previous run and renders pages
+        of all known genres.'''
+        for name in os.listdir(self._temporary_dir_path):
+            if name.startswith(self.PAGE_PREFIX):
+                os.remove(os.path.join(self._temporary_dir_path, name))
+        self._other_pages.clear()
+        self._pages = dict(
+            (c, self._render(c)) for c in set(DICTIONARY.itervalues()))
 
     def show(self, genre_name):
         self.hide()
-        genre_class = get_genre_class(genre_name)
+        self._browser.open(self._page_of(get_genre_class(genre_name)))
+
+    def hide(self):
+        self._browser.close()
+
+    def close(self):
+        '''close removes all rendered pages.'''
+        self.hide()
+        self._other_pages.clear()
+        for path in self._pages.itervalues():
+            os.remove(path)
+        self._pages = {}
+
+    def _page_of(self, genre_class):
+        path = self._pages.get(genre_class)
+        if path is None:
+            path = self._other_pages.get(genre_class)
+        if path is None:
+            path = self._render(genre_class)
+            self._other_pages.put(genre_class, path)
+        return path
+
+    def _render(self, genre_class):
         html = self._html_template.render(genre=genre_class)
-        with tempfile.NamedTemporaryFile(
-                dir=self._temporary_dir_path, delete=False) as f:
-            self._temporary_html_path = f.name
+        with tempfile.NamedTemporaryFile(prefix=self.PAGE_PREFIX,
+                suffix='.html', dir=self._temporary_dir_path, delete=False) as f:
             f.write(html.encode('utf-8'))
-        self._browser.open(self._temporary_html_path)
+        return f.name
+
+
+class KioskReturnPositioner(object):
+    '''KioskReturnPositioner shows the return position on a page kept open
+    in the browser by pushing the genre to it.'''
+    def __init__(self, kiosk_server):
+        self._kiosk_server = kiosk_server
+
+    def show(self, genre_name):
+        self._kiosk_server.push(get_genre_class(genre_name))
 
     def hide(self):
-        self._browser.close()
+        self._kiosk_server.push('')
 
 
 class EmployeeIDScanner(object):
-    def __init__(self, clf):
+    '''EmployeeIDScanner reads employee ids from cards.
+
+    If idm_cache, a TTLCache from the IDm of a card to its employee id,
+    is given, a known card is resolved by the IDm found when the card is
+    sensed, without polling it again and reading its blocks.'''
+    def __init__(self, clf, idm_cache=None):
         self._clf = clf
+        self._idm_cache = idm_cache
         self._scanned_id = None
         self._request_terminate = False
 
     def _on_connect(self, tag):
-        idm, pmm = tag.polling(system_code=0xfe00)
-        tag.idm, tag.pmm, tag.sys = idm, pmm, 0xfe00
-        self._scanned_id = fetch_employee_id(tag)
+        if self._idm_cache is not None:
+            with STAGE_SECONDS.time('nfc_cached'):
+                employee_id = self._idm_cache.get(tag.identifier)
+            if employee_id is not None:
+                self._scanned_id = employee_id
+                return False
+        with STAGE_SECONDS.time('nfc_read'):
+            identifier = tag.identifier
+            idm, pmm = tag.polling(system_code=0xfe00)
+            tag.idm, tag.pmm, tag.sys = idm, pmm, 0xfe00
+            self._scanned_id = fetch_employee_id(tag)
+        if self._idm_cache is not None and self._scanned_id is not None:
+            self._idm_cache.put(identifier, self._scanned_id)
+        return False
 
     def terminate(self):
         self._request_terminate = True
@@ -293,29 +488,155 @@ class EmployeeIDScanner(object):
 
 
 class Kintone(object):
-    def __init__(self, kintone_env):
-        this._env = kintone_env
+    '''Kintone returns books as kintone.BookView decoded with schema,
+    which is resolved from the first record if None. Journaled intents
+    are recorded as those of the station system_id.'''
+    def __init__(self, kintone_env, directory=None, catalog=None,
+            log_shipper=None, journal=None, schema=None, system_id=None):
+        self._env = kintone_env
+        self._directory = directory
+        self._catalog = catalog
+        self._log_shipper = log_shipper
+        self._journal = journal
+        self._schema = schema
+        self._system_id = system_id
+
+    def for_station(self, system_id):
+        '''for_station returns a Kintone sharing the caches, the log
+        shipper and the journal of this one for the station system_id.'''
+        return Kintone(self._env, self._directory, self._catalog,
+            self._log_shipper, self._journal, self._schema, system_id)
 
     def fetch_user_code(self, employee_id):
-        return kintone.fetch_user_code(self._env, employee_id)
+        if self._directory is not None:
+            user_code = self._directory.lookup(employee_id)
+            if user_code is not None:
+                return user_code
+
+        user_code = kintone.fetch_user_code(self._env, employee_id)
+        if self._directory is not None:
+            self._directory.put(employee_id, user_code)
+        return user_code
 
     def find_book_records(self, barcode):
-        return kintone.find_book_records(self._env, barcode)
+        if self._catalog is not None:
+            book_records = self._catalog.find(barcode)
+            if book_records:
+                return self._with_pending(book_records)
+
+        book_records = [self._decode(r) for r in kintone.find_book_records(
+            self._env, barcode, kintone.book_fields(self._schema))]
+        if self._catalog is not None:
+            for r in book_records:
+                self._catalog.put(r)
+        return self._with_pending(book_records)
 
     def borrow_book(self, book_record, user_code):
-        return kintone.borrow_book(self._env, book_record, user_code)
+        if self._journal is not None:
+            if not book_record.is_free():
+                return False
+            return self._record(kintone.INTENT_BORROW, book_record, user_code,
+                kintone.STATUS_BORROWED, [user_code])
+        return self._write_through(kintone.borrow_book(
+            self._env, book_record.to_record(), user_code))
 
     def return_book(self, book_record, user_code):
-        return kintone.return_book(self._env, book_record, user_code)
+        if self._journal is not None:
+            if not book_record.is_borrowed_by(user_code):
+                return False
+            return self._record(kintone.INTENT_RETURN, book_record, user_code,
+                kintone.STATUS_FREE, [])
+        return self._write_through(kintone.return_book(
+            self._env, book_record.to_record(), user_code))
+
+    def borrow_books(self, book_records, user_code):
+        '''borrow_books borrows books in bulk and returns a list of whether
+        each of them is borrowed.'''
+        if self._journal is not None or not book_records:
+            return [self.borrow_book(r, user_code) for r in book_records]
+        return [self._write_through(r) for r in kintone.borrow_books(
+            self._env, [r.to_record() for r in book_records], user_code)]
+
+    def return_books(self, book_records, user_code):
+        '''return_books returns books in bulk and returns a list of whether
+        each of them is returned.'''
+        if self._journal is not None or not book_records:
+            return [self.return_book(r, user_code) for r in book_records]
+        return [self._write_through(r) for r in kintone.return_books(
+            self._env, [r.to_record() for r in book_records], user_code)]
+
+    def lookup_book_records(self, isbn):
+        '''lookup_book_records is find_book_records answered only from the
+        catalog and the journal. It returns None if the catalog is not
+        loaded.'''
+        if self._catalog is None:
+            return None
+        book_records = self._catalog.find(isbn)
+        if book_records is None:
+            return None
+        return self._with_pending(book_records)
+
+    def lookup_borrowed_books(self, user_code):
+        '''lookup_borrowed_books returns the books borrowed by user_code
+        from the catalog and the journal, or None if the catalog is not
+        loaded.'''
+        if self._catalog is None:
+            return None
+        book_records = self._catalog.find_borrowed_by(user_code)
+        if book_records is None:
+            return None
+        if self._journal is None:
+            return book_records
+        pending = dict((book_id, self._decode(r))
+            for book_id, r in self._journal.pending_records().iteritems())
+        book_records = [pending.pop(r.id, r) for r in book_records]
+        book_records.extend(pending.itervalues())
+        return [r for r in book_records if r.is_borrowed_by(user_code)]
+
+    def replay(self, intent):
+        '''replay applies a journaled intent to kintone.'''
+        self._write_through(kintone.replay_intent(
+            self._env, intent.action, intent.book_id, intent.user_code))
+
+    def _record(self, action, book_record, user_code, status, user_codes):
+        '''_record journals an intent instead of applying it, and the book
+        looks updated until the intent is replayed.'''
+        self._journal.record(action, kintone.updated_record(
+            book_record.to_record(), book_record.revision,
+            status, user_codes), user_code, system_id=self._system_id)
+        return True
+
+    def _with_pending(self, book_records):
+        if self._journal is None:
+            return book_records
+        pending = self._journal.pending_records()
+        return [self._decode(pending[r.id]) if r.id in pending else r
+                for r in book_records]
+
+    def _write_through(self, updated_record):
+        if updated_record is None:
+            return False
+        if self._catalog is not None:
+            self._catalog.put(self._decode(updated_record))
+        return True
+
+    def _decode(self, record):
+        view = kintone.BookView.from_record(record, self._schema)
+        self._schema = view.schema
+        return view
 
     def add_log(self, system_id, json_msg):
-        kintone.add_log(self._env, system_id, json_msg)
+        if self._log_shipper is not None:
+            self._log_shipper.put(system_id, json_msg)
+        else:
+            kintone.add_log(self._env, system_id, json_msg)
 
 
 class KintoneLogger(object):
-    def __init__(self, system_id, kintone):
+    def __init__(self, system_id, kintone, attach_timings=False):
         self._system_id = system_id
         self._kintone = kintone
+        self._attach_timings = attach_timings
 
     def log_nfc_connected(self, employee_id, user_code):
         self._kintone.add_log(self._system_id, json.dumps({
@@ -325,22 +646,44 @@ class KintoneLogger(object):
         }))
 
     def log_completed(self, user_code, barcode, message):
-        self._kintone.add_log(self._system_id, json.dumps({
+        '''log_completed logs the result of a transaction, with the
+        milliseconds spent in each stage so far if attach_timings is set.'''
+        json_obj = {
             'user_code': user_code,
             'book_isbn': barcode,
             'message': message
-        }))
+        }
+        timings = metrics.current_trace()
+        if self._attach_timings and timings:
+            json_obj['timings_ms'] = dict(
+                (k, int(round(v * 1000))) for k, v in timings.iteritems())
+        self._kintone.add_log(self._system_id, json.dumps(json_obj))
 
 
 class Sound(object):
+    SE_PATH = '/home/pi/Downloads/nc75064.wav'
+
+    def __init__(self, audio=None):
+        self._audio = audio
+
     def play_se(self):
-        cmd = ['aplay', '/home/pi/Downloads/nc75064.wav']
-        check_call(cmd, stderr=DEVNULL)
+        '''play_se plays the sound effect of a touch. Prompts still queued
+        or playing are stale at that point, so they are dropped.'''
+        if self._audio is None:
+            play_wav(self.SE_PATH)
+            return
+        self._audio.flush()
+        self._audio.play(self.SE_PATH, audio.PRIORITY_HIGH)
 
 
 class BookProcedure(object):
+    '''BookProcedure borrows or returns a book for each card touch, or,
+    if session_timeout is given, the books scanned after a touch until
+    a command barcode is scanned or no barcode is scanned for
+    session_timeout seconds.'''
     def __init__(self, msg_printer, kintone, logger, positioner,
-            id_scanner, sound, line_reader):
+            id_scanner, sound, line_reader, executor=None,
+            session_timeout=None):
         self._msg_printer = msg_printer
         self._kintone = kintone
         self._logger = logger
@@ -348,20 +691,30 @@ class BookProcedure(object):
         self._id_scanner = id_scanner
         self._sound = sound
         self._line_reader = line_reader
+        self._executor = executor
+        self._session_timeout = session_timeout
 
     def process_once(self):
         employee_id = self.scan_employee_id()
+        with metrics.trace():
+            self.process_employee_id(employee_id)
+
+    def process_employee_id(self, employee_id):
         self._msg_printer.put(Messages.EMPLOYEE_ID_SCANNED, id=employee_id)
-        self._sound.play_se()
-        self._positioner.hide()
+        if self._executor is not None:
+            self.process_concurrently(employee_id)
+            return
 
-        user_code = None
-        try:
-            user_code = self._kintone.fetch_user_code(employee_id)
-        except:
-            pass
+        with STAGE_SECONDS.time('sound'):
+            self._sound.play_se()
+        with STAGE_SECONDS.time('browser'):
+            self._positioner.hide()
+
+        with STAGE_SECONDS.time('meibo_lookup'):
+            user_code = self.fetch_user_code(employee_id)
 
-        self._logger.log_nfc_connected(employee_id, user_code)
+        with STAGE_SECONDS.time('log_write'):
+            self._logger.log_nfc_connected(employee_id, user_code)
         if user_code is None:
             self._msg_printer.put(Messages.FAILED_TO_FETCH_USERCODE)
             return
@@ -370,10 +723,60 @@ class BookProcedure(object):
         if barcode is None:
             return
 
-        book_records = self._kintone.find_book_records(barcode)
+        self.process_scanned(user_code, barcode)
+
+    def process_concurrently(self, employee_id):
+        '''process_concurrently does the same as process_once after
+        scanning an employee id, but runs independent steps in the executor.
+
+        The user code lookup (followed by the log) and closing the browser
+        start at once, and the patron is asked for a barcode without waiting
+        for them.'''
+        with STAGE_SECONDS.time('sound'):
+            self._sound.play_se()
+        hidden = self._executor.apply_async(self._positioner.hide)
+        fetched = self._executor.apply_async(
+            metrics.traced(self.fetch_user_code_and_log), (employee_id,))
+        self.prompt_barcode()
+
+        user_code = fetched.get()
+        if user_code is None:
+            self._msg_printer.put(Messages.FAILED_TO_FETCH_USERCODE)
+            hidden.get()
+            return
+
+        barcode = self.read_barcode()
+        hidden.get()
+        if barcode is None:
+            return
+
+        self.process_scanned(user_code, barcode)
+
+    def fetch_user_code(self, employee_id):
+        try:
+            return self._kintone.fetch_user_code(employee_id)
+        except:
+            return None
+
+    def fetch_user_code_and_log(self, employee_id):
+        with STAGE_SECONDS.time('meibo_lookup'):
+            user_code = self.fetch_user_code(employee_id)
+        self._executor.apply_async(
+            metrics.traced(self._logger.log_nfc_connected),
+            (employee_id, user_code))
+        return user_code
+
+    def process_scanned(self, user_code, barcode):
+        if self._session_timeout is None:
+            self.process_barcode(user_code, barcode)
+        else:
+            self.process_session(user_code, barcode)
+
+    def process_barcode(self, user_code, barcode):
+        with STAGE_SECONDS.time('record_lookup'):
+            book_records = self._kintone.find_book_records(barcode)
         borrowed_book_record = kintone.find_first(
-                book_records,
-                lambda r: kintone.book_is_borrowed(r, user_code))
+                book_records, lambda r: r.is_borrowed_by(user_code))
 
         log_message = None
         if borrowed_book_record is None:
@@ -381,22 +784,129 @@ class BookProcedure(object):
         else:
             log_message = self.return_book(borrowed_book_record, user_code)
 
-        self._logger.log_completed(user_code, barcode, log_message)
+        with STAGE_SECONDS.time('log_write'):
+            self._logger.log_completed(user_code, barcode, log_message)
+
+    def process_session(self, user_code, barcode):
+        '''process_session collects the barcodes scanned after barcode and
+        then borrows or returns all the books at once.
+
+        CMD_BORROW borrows the books and CMD_RETURN returns them. If the
+        session times out, each book is returned if user_code has
+        borrowed it, and borrowed otherwise, as process_barcode does.'''
+        barcodes = [barcode]
+        while True:
+            self._msg_printer.put(Messages.SESSION_BOOK_ADDED,
+                isbn=barcode, count=len(barcodes))
+            barcode = self.read_session_barcode()
+            if barcode is None or barcode in (CMD_BORROW, CMD_RETURN):
+                break
+            barcodes.append(barcode)
+
+        with STAGE_SECONDS.time('record_lookup'):
+            found = [(b, self._kintone.find_book_records(b)) for b in barcodes]
+
+        def log_completed(barcode, log_message):
+            with STAGE_SECONDS.time('log_write'):
+                self._logger.log_completed(user_code, barcode, log_message)
+
+        to_borrow, to_return = [], []
+        chosen = set()
+        for b, book_records in found:
+            book_records = [r for r in book_records if r.id not in chosen]
+            borrowed_book_record = None
+            if barcode != CMD_BORROW:
+                borrowed_book_record = kintone.find_first(
+                    book_records, lambda r: r.is_borrowed_by(user_code))
+            free_book_record = kintone.find_first(
+                book_records, lambda r: r.is_free())
+            if borrowed_book_record is not None:
+                to_return.append((b, borrowed_book_record))
+                chosen.add(borrowed_book_record.id)
+            elif barcode == CMD_RETURN:
+                self._msg_printer.put(Messages.NOT_BORROWED_BY_YOU, isbn=b)
+                log_completed(b, 'book is not borrowed by the user')
+            elif free_book_record is not None:
+                to_borrow.append((b, free_book_record))
+                chosen.add(free_book_record.id)
+            else:
+                log_completed(b, self.report_unavailable(book_records))
+
+        # each result is logged as soon as it is known, so that the books
+        # borrowed are logged even if the returns fail
+        with STAGE_SECONDS.time('borrow'):
+            borrowed = self._update_books(
+                self._kintone.borrow_books, to_borrow, user_code)
+        for (b, _), succeeded in zip(to_borrow, borrowed):
+            log_completed(b, 'successfully borrowed a book'
+                if succeeded else 'kintone returned an error')
+        with STAGE_SECONDS.time('return'):
+            returned = self._update_books(
+                self._kintone.return_books, to_return, user_code)
+        for (b, _), succeeded in zip(to_return, returned):
+            log_completed(b, 'successfully returned a book'
+                if succeeded else 'kintone returned an error')
+
+        self._msg_printer.put(Messages.SESSION_COMPLETED,
+            borrowed=sum(borrowed), returned=sum(returned))
+        failed = len(barcodes) - sum(borrowed) - sum(returned)
+        if failed:
+            self._msg_printer.put(Messages.SESSION_FAILED, count=failed)
+        returned_records = [r for (_, r), ok in zip(to_return, returned) if ok]
+        if returned_records:
+            # the shelf of the last book returned is shown
+            with STAGE_SECONDS.time('browser'):
+                self._positioner.show(get_genre_name(returned_records[-1]))
+
+    def _update_books(self, update, books, user_code):
+        '''_update_books calls update with the book records of books, the
+        (barcode, record) pairs, and returns whether each one succeeded.
+        All of them are taken as failed if update raises.'''
+        try:
+            return update([r for _, r in books], user_code)
+        except Exception as e:
+            log('failed to update {} books: {}'.format(len(books), e))
+            return [False] * len(books)
+
+    def read_session_barcode(self):
+        '''read_session_barcode returns the next ISBN or command barcode,
+        or None if none is scanned for session_timeout seconds.'''
+        with STAGE_SECONDS.time('barcode_wait'):
+            while True:
+                self._line_reader.set_next_flag()
+                line = self._line_reader.readline(
+                    timeout=self._session_timeout)
+                if line is None:
+                    return None
+                barcode = line.strip()
+                if barcode.startswith('97') or barcode in (
+                        CMD_BORROW, CMD_RETURN):
+                    return barcode
+                self._msg_printer.put(Messages.BARCODE_IS_NOT_ISBN)
 
     def scan_employee_id(self):
         while True:
             try:
                 return self._id_scanner.scan()
             except:
-                self._msg_printer.put(Message.FAILED_TO_SCAN_EMPLOYEE_ID)
+                self._msg_printer.put(Messages.FAILED_TO_SCAN_EMPLOYEE_ID)
 
     def terminate(self):
         self._id_scanner.terminate()
 
     def scan_barcode(self):
+        self.prompt_barcode()
+        return self.read_barcode()
+
+    def prompt_barcode(self):
         self._line_reader.set_next_flag()
         self._msg_printer.put(Messages.PLEASE_SCAN_BARCODE)
 
+    def read_barcode(self):
+        with STAGE_SECONDS.time('barcode_wait'):
+            return self._read_barcode()
+
+    def _read_barcode(self):
         while True:
             line = self._line_reader.readline(timeout=20)
             if line is None:
@@ -409,32 +919,179 @@ class BookProcedure(object):
             self._msg_printer.put(Messages.BARCODE_IS_NOT_ISBN)
 
     def borrow_book(self, book_records, user_code):
-        free_book_record = kintone.find_first(book_records, kintone.book_is_free)
+        free_book_record = kintone.find_first(
+                book_records, lambda r: r.is_free())
         if free_book_record is None:
-            user_names = kintone.get_borrowing_users(book_records)
-            if user_names:
-                names = ' '.join(name + 'さん' for name in user_names)
-                self._msg_printer.put(Messages.ALREADY_BORROWED, names=names)
-                return 'book has already been borrowed'
-            else:
-                self._msg_printer.put(Messages.NOT_REGISTERED)
-                return 'book is not registered'
+            return self.report_unavailable(book_records)
+
+        with STAGE_SECONDS.time('borrow'):
+            succeeded = self._kintone.borrow_book(free_book_record, user_code)
+        return self.report_borrowed(succeeded)
 
-        if self._kintone.borrow_book(free_book_record, user_code):
+    def return_book(self, book_record, user_code):
+        with STAGE_SECONDS.time('return'):
+            succeeded = self._kintone.return_book(book_record, user_code)
+        if succeeded:
+            self._msg_printer.put(Messages.BOOK_RETURNED)
+            with STAGE_SECONDS.time('browser'):
+                self._positioner.show(get_genre_name(book_record))
+            return 'successfully returned a book'
+
+        self._msg_printer.put(Messages.KINTONE_ERROR)
+        return 'kintone returned an error'
+
+    def report_unavailable(self, book_records):
+        user_names = [name for r in book_records for name in r.user_names()]
+        if user_names:
+            names = ' '.join(name + 'さん' for name in user_names)
+            self._msg_printer.put(Messages.ALREADY_BORROWED, names=names)
+            return 'book has already been borrowed'
+        else:
+            self._msg_printer.put(Messages.NOT_REGISTERED)
+            return 'book is not registered'
+
+    def report_borrowed(self, succeeded):
+        if succeeded:
             self._msg_printer.put(Messages.BOOK_BORROWED)
             return 'successfully borrowed a book'
 
         self._msg_printer.put(Messages.KINTONE_ERROR)
         return 'kintone returned an error'
 
+
+def get_genre_name(book_record):
+    return book_record.genre.encode('utf-8')
+
+
+class AsyncBookProcedure(BookProcedure):
+    '''AsyncBookProcedure is BookProcedure run by a runtime.EventLoop.
+
+    process_once() and the other scanning and kintone steps are coroutines.
+    NFC scanning and kintone calls run in the executor of the loop, and the
+    barcode comes from a runtime.AsyncLineStream. Cancelling the task
+    running run() stops the procedure wherever it is waiting.
+    '''
+    BARCODE_TIMEOUT = 20
+
+    def __init__(self, loop, msg_printer, kintone, logger, positioner,
+            id_scanner, sound, line_stream):
+        super(AsyncBookProcedure, self).__init__(msg_printer, kintone, logger,
+            positioner, id_scanner, sound, None)
+        self._loop = loop
+        self._line_stream = line_stream
+        self._next_line = None
+
+    def run(self):
+        while True:
+            yield self.process_once()
+
+    def process_once(self):
+        employee_id = yield self.scan_employee_id()
+        if employee_id is None:
+            return
+        with metrics.trace():
+            yield self.process_employee_id(employee_id)
+
+    def process_employee_id(self, employee_id):
+        self._msg_printer.put(Messages.EMPLOYEE_ID_SCANNED, id=employee_id)
+
+        with STAGE_SECONDS.time('sound'):
+            self._sound.play_se()
+        hidden = self._call(self._positioner.hide)
+        fetched = self._call(self.fetch_user_code, employee_id)
+        self.prompt_barcode()
+
+        with STAGE_SECONDS.time('meibo_lookup'):
+            user_code = yield fetched
+        self._call(self._logger.log_nfc_connected, employee_id, user_code)
+        if user_code is None:
+            self._msg_printer.put(Messages.FAILED_TO_FETCH_USERCODE)
+            yield hidden
+            return
+
+        with STAGE_SECONDS.time('barcode_wait'):
+            barcode = yield self.read_barcode()
+        yield hidden
+        if barcode is None:
+            return
+
+        with STAGE_SECONDS.time('record_lookup'):
+            book_records = yield self._call(
+                self._kintone.find_book_records, barcode)
+        borrowed_book_record = kintone.find_first(
+                book_records, lambda r: r.is_borrowed_by(user_code))
+
+        if borrowed_book_record is None:
+            log_message = yield self.borrow_book(book_records, user_code)
+        else:
+            log_message = yield self.return_book(borrowed_book_record, user_code)
+
+        self._call(self._logger.log_completed, user_code, barcode, log_message)
+
+    def scan_employee_id(self):
+        while True:
+            scanning = self._call(self._id_scanner.scan)
+            scanning.add_done_callback(self._terminate_if_cancelled)
+            try:
+                employee_id = yield scanning
+            except CancelledError:
+                raise
+            except Exception:
+                self._msg_printer.put(Messages.FAILED_TO_SCAN_EMPLOYEE_ID)
+                continue
+            raise Return(employee_id)
+
+    def prompt_barcode(self):
+        self._next_line = self._line_stream.readline()
+        self._msg_printer.put(Messages.PLEASE_SCAN_BARCODE)
+
+    def read_barcode(self):
+        while True:
+            try:
+                line = yield wait_for(
+                    self._loop, self._next_line, self.BARCODE_TIMEOUT)
+            except TimeoutError:
+                line = None
+            if line is None:
+                self._msg_printer.put(Messages.TIMED_OUT)
+                raise Return(None)
+            barcode = line.strip()
+            if barcode.startswith('97'):
+                raise Return(barcode)
+            self._next_line = self._line_stream.readline()
+            self._msg_printer.put(Messages.BARCODE_IS_NOT_ISBN)
+
+    def borrow_book(self, book_records, user_code):
+        free_book_record = kintone.find_first(
+                book_records, lambda r: r.is_free())
+        if free_book_record is None:
+            raise Return(self.report_unavailable(book_records))
+
+        with STAGE_SECONDS.time('borrow'):
+            succeeded = yield self._call(
+                self._kintone.borrow_book, free_book_record, user_code)
+        raise Return(self.report_borrowed(succeeded))
+
     def return_book(self, book_record, user_code):
-        if self._kintone.return_book(book_record, user_code):
+        with STAGE_SECONDS.time('return'):
+            succeeded = yield self._call(
+                self._kintone.return_book, book_record, user_code)
+        if succeeded:
             self._msg_printer.put(Messages.BOOK_RETURNED)
-            self._positioner.show(book_record[u'type'][u'value'].encode('utf-8'))
-            return 'successfully returned a book'
+            with STAGE_SECONDS.time('browser'):
+                yield self._call(
+                    self._positioner.show, get_genre_name(book_record))
+            raise Return('successfully returned a book')
 
         self._msg_printer.put(Messages.KINTONE_ERROR)
-        return 'kintone returned an error'
+        raise Return('kintone returned an error')
+
+    def _call(self, fn, *args):
+        return self._loop.run_in_executor(metrics.traced(fn), *args)
+
+    def _terminate_if_cancelled(self, future):
+        if future.cancelled():
+            self._id_scanner.terminate()
 
 
 def post_connect():
@@ -521,7 +1178,108 @@ def post_connect():
     }))
 
 
+class StartupTimer(object):
+    '''StartupTimer measures the stages of startup to report them.'''
+    def __init__(self):
+        self._begin = time.time()
+        self._stages = []
+        self._lock = threading.Lock()
+
+    def run(self, name, fn, *args):
+        begin = time.time()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._stages.append((name, time.time() - begin))
+
+    def run_all(self, stages, parallel=False):
+        '''run_all runs (name, fn) stages, in threads if parallel,
+        and returns their results.'''
+        if not parallel:
+            return [self.run(name, fn) for name, fn in stages]
+
+        pool = ThreadPool(len(stages))
+        try:
+            results = [pool.apply_async(self.run, stage) for stage in stages]
+            return [r.get() for r in results]
+        finally:
+            pool.close()
+
+    def report(self):
+        with self._lock:
+            stages = ', '.join(
+                '{} {:.2f}s'.format(name, t) for name, t in self._stages)
+        return 'ready in {:.2f}s ({})'.format(time.time() - self._begin, stages)
+
+
+def load_template():
+    import jinja2
+    jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader('.'))
+    return jinja_env.get_template('hondana.html')
+
+
+def open_frontend(path='usb'):
+    import nfc
+    return nfc.ContactlessFrontend(path)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrent', action='store_true',
+        help='run independent steps of a procedure concurrently')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+        help='run the procedure as a coroutine on a single event loop')
+    parser.add_argument('--barcode-device',
+        help='read barcodes from this evdev device instead of stdin')
+    parser.add_argument('--journal', action='store_true',
+        help='acknowledge borrows and returns at once and apply them to '
+             'kintone in the background')
+    parser.add_argument('--metrics-port', type=int,
+        help='serve latency histograms for Prometheus on this port')
+    parser.add_argument('--metrics-address', default='127.0.0.1',
+        metavar='ADDRESS',
+        help='address to serve the histograms on, e.g. 0.0.0.0 to let '
+             'Prometheus on another host scrape them (default: 127.0.0.1)')
+    parser.add_argument('--log-timings', action='store_true',
+        help='attach the time spent in each stage to the log of a transaction')
+    parser.add_argument('--fast-start', action='store_true',
+        help='load kintone data, the page template and the NFC reader '
+             'in parallel at startup, and cache the parsed kintone.yml '
+             '(readable only by the user) under ' + config.DEFAULT_CACHE_DIR)
+    parser.add_argument('--kiosk-port', type=int,
+        help='serve the bookshelf page on this port and keep a browser open')
+    parser.add_argument('--idm-cache-ttl', type=int, metavar='SECONDS',
+        help='remember the employee id of a card by its IDm for this long '
+             'so that the card is not read again')
+    parser.add_argument('--query-socket', metavar='PATH',
+        help='answer lookups of books and borrowers from the local caches '
+             'on this Unix domain socket')
+    parser.add_argument('--stocktake', metavar='REPORT',
+        help='check the books scanned in a row, without card touches, '
+             'against kintone and write the report as JSON to this file')
+    parser.add_argument('--stations', metavar='FILE',
+        help='serve the stations listed in this YAML file, each with its '
+             'own NFC reader, barcode scanner and system id')
+    parser.add_argument('--session-timeout', type=float, metavar='SECONDS',
+        help='accept several barcodes after a card touch until the borrow '
+             'or return command barcode is scanned or no barcode is '
+             'scanned for this long')
+    args = parser.parse_args()
+    if args.session_timeout is not None and args.use_async:
+        parser.error('--session-timeout cannot be used with --async')
+    if args.stations is not None and (
+            args.use_async or args.barcode_device is not None):
+        parser.error('--stations cannot be used with --async or '
+                     '--barcode-device')
+    if args.stocktake is not None and args.stations is not None:
+        parser.error('--stocktake cannot be used with --stations')
+    return args
+
+
 def main():
+    args = parse_args()
+
     if not os.path.exists(TEMPDIR):
         print_flush('Please create temp dir: ' + TEMPDIR)
         sys.exit(1)
@@ -532,42 +1290,409 @@ def main():
     with open('system_id') as f:
         system_id = f.read().strip()
 
-    jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader('.'))
+    stations = None
+    if args.stations is not None:
+        stations = load_stations(args.stations)
+
+    timer = StartupTimer()
+
+    if not os.path.exists(SPEECH_CACHE_DIR):
+        os.mkdir(SPEECH_CACHE_DIR)
+    speech_cache = SpeechCache(SPEECH_CACHE_DIR)
+    speech_cache.start_prerender(Messages.static_speeches())
+    audio_scheduler = AudioScheduler()
+    audio_scheduler.start()
+
+    if stations is not None:
+        barcode_source = None
+    elif args.barcode_device is None:
+        barcode_source = FdSource(sys.stdin.fileno())
+    else:
+        barcode_source = EvdevSource(args.barcode_device)
+
+    # the parsed config holds the credentials, so it is cached on disk
+    # only if asked for
+    kintone_env = timer.run('config', kintone.init, 'kintone.yml',
+        config.DEFAULT_CACHE_DIR if args.fast_start else None)
+    if args.stocktake is not None:
+        audio_scheduler.stop()
+        run_stocktake(kintone_env, barcode_source, args.stocktake)
+        kintone_env.session.close()
+        return
+    directory = UserDirectory(lambda: kintone.fetch_user_codes(kintone_env))
+    catalog = BookCatalog(
+        lambda since: kintone.fetch_book_records_updated_since(
+            kintone_env, since, kintone.book_fields(catalog.schema)))
 
-    line_reader = ThreadLineReader(sys.stdin.fileno())
+    def load_directory():
+        try:
+            print_flush('Loaded {} employees'.format(directory.load()))
+        except Exception as e:
+            print_flush('Failed to load user directory: {}'.format(e))
+
+    def fetch_book_schema():
+        try:
+            return kintone.fetch_book_schema(kintone_env)
+        except Exception as e:
+            # the schema is resolved from the first record instead
+            print_flush('Failed to fetch book schema: {}'.format(e))
+            return None
+
+    def sync_catalog():
+        # the schema tells which fields to fetch
+        catalog.schema = fetch_book_schema()
+        try:
+            print_flush('Loaded {} books'.format(catalog.sync()))
+        except Exception as e:
+            print_flush('Failed to load book catalog: {}'.format(e))
+
+    def open_frontends():
+        if stations is None:
+            return open_frontend()
+        return [open_frontend(s.nfc) for s in stations]
+
+    # loading the directory also warms up the connection to kintone
+    _, _, html_template, clf = timer.run_all([
+        ('directory', load_directory),
+        ('catalog', sync_catalog),
+        ('template', load_template),
+        ('nfc', open_frontends),
+    ], parallel=args.fast_start)
+    directory.start()
+    catalog.start()
+
+    log_shipper = LogShipper(
+        lambda logs: kintone.add_logs(kintone_env, logs), TEMPDIR)
+    log_shipper.start()
+
+    journal = None
+    if args.journal:
+        journal = Journal(JOURNAL_PATH)
+    kin = Kintone(kintone_env, directory, catalog, log_shipper, journal,
+        catalog.schema, system_id)
+    if journal is not None:
+        def on_conflict(intent, reason):
+            # logged as the station which acknowledged the intent
+            kin.add_log(intent.system_id or system_id, json.dumps({
+                'user_code': intent.user_code,
+                'book_id': intent.book_id,
+                'intent': intent.action,
+                'key': intent.key,
+                'message': u'journal conflict: ' + reason
+            }))
+        reconciler = Reconciler(journal, kin.replay, on_conflict)
+        reconciler.start()
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(
+            (args.metrics_address, args.metrics_port))
+        metrics_server.start()
+
+    query_server = None
+    if args.query_socket is not None:
+        def status():
+            s = {
+                'books': len(catalog),
+                'employees': len(directory),
+                'session': kintone_env.session.stats(),
+            }
+            if journal is not None:
+                s['pending_intents'] = len(journal.pending())
+            return s
+        query_server = QueryServer(args.query_socket, kin, status)
+        query_server.start()
+
+    kiosk_server = None
+    if args.kiosk_port is None:
+        positioner = BrowserReturnPositioner(
+            EpiphanyBrowser(), html_template, TEMPDIR)
+        timer.run('prerender', positioner.prerender)
+    else:
+        kiosk_server = KioskServer(('127.0.0.1', args.kiosk_port),
+            html_template, '.')
+        kiosk_server.start()
+        kiosk_browser = EpiphanyBrowser()
+        kiosk_browser.open(kiosk_server.url)
+        positioner = KioskReturnPositioner(kiosk_server)
+
+    print_flush('startup: ' + timer.report())
+
+    idm_cache = None
+    if args.idm_cache_ttl is not None:
+        idm_cache = TTLCache(1024, args.idm_cache_ttl)
+
+    executors = []
+    def new_executor():
+        if not args.concurrent:
+            return None
+        executors.append(ThreadPool(4))
+        return executors[-1]
+
+    if stations is None:
+        with clf:
+            components = (
+                MessagePrinter(speech_cache, audio_scheduler),
+                kin,
+                KintoneLogger(system_id, kin, args.log_timings),
+                positioner,
+                EmployeeIDScanner(clf, idm_cache))
+            if args.use_async:
+                run_async(components, Sound(audio_scheduler), barcode_source)
+            else:
+                run_threaded(components, Sound(audio_scheduler),
+                    barcode_source, new_executor(), args.session_timeout)
+    else:
+        workers = []
+        for station, frontend in zip(stations, clf):
+            line_reader = ThreadLineReader(EvdevSource(station.barcode_device))
+            station_kin = kin.for_station(station.system_id)
+            # a touch flushes the prompts of its own station only
+            station_audio = audio_scheduler.channel(station.system_id)
+            procedure = BookProcedure(
+                MessagePrinter(speech_cache, station_audio,
+                    station.system_id + ': '),
+                station_kin,
+                KintoneLogger(station.system_id, station_kin, args.log_timings),
+                positioner,
+                EmployeeIDScanner(frontend, idm_cache),
+                Sound(station_audio),
+                line_reader,
+                new_executor(),
+                args.session_timeout)
+            workers.append(
+                StationWorker(station.system_id, procedure, line_reader))
+        try:
+            run_stations(workers)
+        finally:
+            for frontend in clf:
+                frontend.close()
+    for executor in executors:
+        executor.close()
+        executor.join()
+
+    if kiosk_server is None:
+        positioner.close()
+    else:
+        kiosk_browser.close()
+        kiosk_server.stop()
+    audio_scheduler.stop()
+    if query_server is not None:
+        query_server.stop()
+    if journal is not None:
+        reconciler.stop()
+        journal.close()
+    log_shipper.stop()
+    catalog.stop()
+    directory.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    print_flush('kintone session: {}'.format(kintone_env.session.stats()))
+    kintone_env.session.close()
+
+
+def run_threaded(components, sound, barcode_source, executor,
+        session_timeout=None):
+    line_reader = ThreadLineReader(barcode_source)
     line_reader.start()
+    procedure = BookProcedure(*components + (
+        sound, line_reader, executor, session_timeout))
 
-    kin = Kintone(kintone.init())
-
-    with nfc.ContactlessFrontend('usb') as clf:
-        procedure = BookProcedure(
-            MessagePrinter(),
-            kin,
-            KintoneLogger(system_id, kin),
-            BrowserReturnPositioner(
-                EpiphanyBrowser(),
-                jinja_env.get_template('hondana.html'),
-                TEMPDIR),
-            EmployeeIDScanner(clf),
-            Sound(),
-            line_reader)
-
-        request_terminate = threading.Event()
-        def sig_handler(signum, frame):
-            print_flush('signal handler: ' + str(signum))
-            if signum in {signal.SIGINT, signal.SIGTERM}:
-                request_terminate.set()
-                procedure.terminate()
-
-        signal.signal(signal.SIGINT, sig_handler)
-        signal.signal(signal.SIGTERM, sig_handler)
-
-        while not request_terminate.is_set():
-            procedure.process_once()
+    request_terminate = threading.Event()
+    def sig_handler(signum, frame):
+        print_flush('signal handler: ' + str(signum))
+        if signum in {signal.SIGINT, signal.SIGTERM}:
+            request_terminate.set()
+            procedure.terminate()
+
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    while not request_terminate.is_set():
+        procedure.process_once()
 
     line_reader.terminate()
     line_reader.join()
 
 
+def run_stocktake(kintone_env, barcode_source, report_path):
+    '''run_stocktake checks barcodes scanned in a row until EOF or a
+    signal, and writes the report to report_path.'''
+    schema = kintone.fetch_book_schema(kintone_env)
+    fields = kintone.book_fields(schema)
+    def decode(records):
+        return [kintone.BookView.from_record(r, schema) for r in records]
+    stocktaker = Stocktaker(
+        lambda isbns: decode(kintone.find_book_records_by_isbns(
+            kintone_env, isbns, fields)),
+        lambda: decode(kintone.find_free_book_records(
+            kintone_env, schema, fields)))
+
+    line_reader = ThreadLineReader(barcode_source, stream=True)
+    line_reader.start()
+
+    request_terminate = threading.Event()
+    def sig_handler(signum, frame):
+        print_flush('signal handler: ' + str(signum))
+        if signum in {signal.SIGINT, signal.SIGTERM}:
+            request_terminate.set()
+
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    print_flush('Scan the books. Stop with Ctrl-C or EOF.')
+    while not request_terminate.is_set():
+        # a timeout so that signals are handled
+        line = line_reader.readline(timeout=1)
+        if line is None:
+            if not line_reader.is_alive():
+                break
+            continue
+        barcode = line.strip()
+        if stocktaker.scan(barcode):
+            print_flush('{:>5} {}'.format(len(stocktaker), barcode))
+        elif barcode:
+            print_flush('Not an ISBN: {}'.format(barcode))
+
+    if line_reader.is_alive():
+        line_reader.terminate()
+    line_reader.join()
+
+    try:
+        report = stocktaker.finish()
+    except Exception:
+        # keep the scans so that the books need not be scanned again
+        with open(report_path, 'w') as f:
+            json.dump({'scanned': stocktaker.scanned()}, f, indent=2,
+                sort_keys=True)
+        raise
+    with open(report_path, 'w') as f:
+        json.dump(report_to_dict(report), f, indent=2, sort_keys=True)
+    for u in report.unexpected:
+        print_flush('unexpected: {} ({})'.format(u.isbn, u.reason))
+    if report.missing is None:
+        print_flush('missing: unknown (failed to fetch the books on shelves)')
+    else:
+        for b in report.missing:
+            print_flush(u'missing: {} {}'.format(
+                b.isbn13 or b.isbn, b.genre).encode('utf-8'))
+    print_flush('on shelf: {}, missing: {}, unexpected: {}'.format(
+        len(report.on_shelf),
+        'unknown' if report.missing is None else len(report.missing),
+        len(report.unexpected)))
+
+
+Station = namedtuple('Station', ['system_id', 'nfc', 'barcode_device'])
+
+
+def load_stations(path):
+    '''load_stations returns the stations listed in a YAML file like:
+
+        stations:
+          - system_id: shelf-1
+            nfc: usb:001:004
+            barcode_device: /dev/input/by-id/usb-...-event-kbd
+
+    nfc is the path of the reader given to nfc.ContactlessFrontend.'''
+    stations = [
+        Station(str(s['system_id']), s.get('nfc', 'usb'), s['barcode_device'])
+        for s in config.load(path)['stations']]
+    system_ids = [s.system_id for s in stations]
+    if len(set(system_ids)) != len(system_ids):
+        raise ValueError('duplicate system_id in ' + path)
+    return stations
+
+
+class StationWorker(object):
+    '''StationWorker runs the BookProcedure of a station in a thread.
+    A failed transaction is logged and the station keeps serving.'''
+    def __init__(self, system_id, procedure, line_reader):
+        self.system_id = system_id
+        self._procedure = procedure
+        self._line_reader = line_reader
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._line_reader.start()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.request_stop()
+        self.join()
+
+    def request_stop(self):
+        '''request_stop asks the station to stop without waiting. A scan
+        or a barcode wait in progress returns at once.'''
+        self._stop.set()
+        self._procedure.terminate()
+        self._line_reader.terminate()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._line_reader.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            employee_id = self._procedure.scan_employee_id()
+            if self._stop.is_set():
+                break
+            try:
+                with STATION_SECONDS.time(self.system_id), metrics.trace():
+                    self._procedure.process_employee_id(employee_id)
+            except Exception as e:
+                log('station {}: transaction failed: {}'.format(
+                    self.system_id, e))
+
+
+def run_stations(workers):
+    for worker in workers:
+        worker.start()
+
+    request_terminate = threading.Event()
+    def sig_handler(signum, frame):
+        print_flush('signal handler: ' + str(signum))
+        if signum in {signal.SIGINT, signal.SIGTERM}:
+            request_terminate.set()
+
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    # wait with a timeout so that signals are handled
+    while not request_terminate.wait(1):
+        pass
+    for worker in workers:
+        worker.request_stop()
+    for worker in workers:
+        worker.join()
+
+
+def run_async(components, sound, barcode_source):
+    loop = EventLoop()
+    line_stream = AsyncLineStream(loop, barcode_source, LineReader())
+    procedure = AsyncBookProcedure(
+        loop, *components + (sound, line_stream))
+    task = loop.create_task(procedure.run())
+
+    def sig_handler(signum, frame):
+        print_flush('signal handler: ' + str(signum))
+        if signum in {signal.SIGINT, signal.SIGTERM}:
+            loop.call_soon_threadsafe(task.cancel)
+
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    try:
+        loop.run_until_complete(task)
+    except CancelledError:
+        pass
+    line_stream.close()
+    loop.close()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,206 @@
+'''In-process latency histograms exposed in the Prometheus text format.'''
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    '''Histogram counts observed values in cumulative buckets.'''
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += 1
+                    break
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        '''snapshot returns (cumulative bucket counts, sum, count).'''
+        with self._lock:
+            cumulative = []
+            total = 0
+            for c in self._counts:
+                total += c
+                cumulative.append(total)
+            return cumulative, self._sum, self._count
+
+
+class HistogramFamily(object):
+    '''HistogramFamily is a set of histograms distinguished by a label,
+    e.g. the stage of a transaction.'''
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            histogram = self._histograms.get(label_value)
+            if histogram is None:
+                histogram = Histogram(self._buckets)
+                self._histograms[label_value] = histogram
+        histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, label_value):
+        '''time observes the time spent in the with block. The time is also
+        added to the trace of this thread, if any.'''
+        begin = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - begin
+            self.observe(label_value, elapsed)
+            timings = current_trace()
+            if timings is not None:
+                timings[label_value] = timings.get(label_value, 0) + elapsed
+
+    def timed(self, fn):
+        '''timed is a decorator observing the time spent in fn,
+        labeled with the name of fn.'''
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.time(fn.__name__):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        for label_value, histogram in histograms:
+            label = '{}="{}"'.format(self.label, _escape(label_value))
+            counts, total, count = histogram.snapshot()
+            for bound, c in zip(histogram.buckets, counts):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    self.name, label, _format_bound(bound), c))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                self.name, label, count))
+            lines.append('{}_sum{{{}}} {!r}'.format(self.name, label, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label, count))
+        return '\n'.join(lines) + '\n'
+
+
+class Registry(object):
+    def __init__(self):
+        self._families = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        family = HistogramFamily(name, help, label, buckets)
+        with self._lock:
+            self._families.append(family)
+        return family
+
+    def render(self):
+        '''render returns all metrics in the Prometheus text format.'''
+        with self._lock:
+            families = list(self._families)
+        return ''.join(f.render() for f in families)
+
+
+REGISTRY = Registry()
+_local = threading.local()
+
+
+def histogram(name, help, label, buckets=DEFAULT_BUCKETS):
+    '''histogram creates a HistogramFamily in the default registry.'''
+    return REGISTRY.histogram(name, help, label, buckets)
+
+
+@contextmanager
+def trace():
+    '''trace collects the seconds spent in histogram spans in this thread
+    into a dict keyed by their labels, e.g. to log them with a transaction.'''
+    timings = {}
+    outer = current_trace()
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = outer
+
+
+def current_trace():
+    return getattr(_local, 'timings', None)
+
+
+def traced(fn):
+    '''traced returns a function calling fn with the current trace of this
+    thread, which is used to carry the trace to a worker thread.'''
+    timings = current_trace()
+    if timings is None:
+        return fn
+    def wrapper(*args, **kwargs):
+        outer = current_trace()
+        _local.timings = timings
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.timings = outer
+    return wrapper
+
+
+class MetricsServer(HTTPServer):
+    '''MetricsServer serves /metrics of a registry for Prometheus.'''
+    def __init__(self, address, registry=REGISTRY):
+        HTTPServer.__init__(self, address, _MetricsHandler)
+        self.registry = registry
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self._send(404, 'text/plain', 'not found')
+            return
+        self._send(200, 'text/plain; version=0.0.4',
+            self.server.registry.render())
+
+    def _send(self, code, content_type, body):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
@@ -0,0 +1,107 @@
+'''A Unix domain socket answering lookups from the warm state of hondana,
+so that other tools on the host do not have to query kintone.
+
+A request is a line, and the response is a line of JSON:
+
+    book <isbn>        the books of isbn with their status and borrowers
+    user <user_code>   the books borrowed by user_code
+    status             the state of the process
+
+A response has "ok": true and the result in "books" or "status",
+or "ok": false and "error".
+'''
+import errno
+import json
+import os
+import socket
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+import stat
+import threading
+
+
+class QueryServer(ThreadingMixIn, UnixStreamServer):
+    '''QueryServer serves lookups on a Unix domain socket at path.
+
+    books must have lookup_book_records(isbn) and
+    lookup_borrowed_books(user_code), e.g. main.Kintone, which return
+    kintone.BookView lists, or None if the books are not loaded.
+    status is a function returning a dict of the state of the process.
+
+    The socket is created readable only by the user and the group, since
+    the answers contain borrowers. RuntimeError is raised if another
+    process is serving at path.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, books, status=None):
+        _remove_stale_socket(path)
+        umask = os.umask(0117)
+        try:
+            UnixStreamServer.__init__(self, path, _QueryHandler)
+        finally:
+            os.umask(umask)
+        self.path = path
+        self._books = books
+        self._status = status
+        self._thread = None
+
+    def query(self, line):
+        '''query returns the response to a request line as a dict.'''
+        # a line which is not UTF-8 is answered as an invalid request
+        line = line.decode('utf-8', 'replace')
+        command, _, arg = line.strip().partition(u' ')
+        arg = arg.strip()
+        if command == 'book' and arg:
+            return _books_response(self._books.lookup_book_records(arg))
+        elif command == 'user' and arg:
+            return _books_response(self._books.lookup_borrowed_books(arg))
+        elif command == 'status' and not arg:
+            status = self._status() if self._status is not None else {}
+            return {'ok': True, 'status': status}
+        return {'ok': False, 'error': u'invalid request: ' + line.strip()}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        os.unlink(self.path)
+
+
+def _remove_stale_socket(path):
+    '''_remove_stale_socket removes the socket at path left by a previous
+    process, and raises RuntimeError if a process still answers on it.'''
+    if not (os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode)):
+        return
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+    raise RuntimeError('another process is serving on ' + path)
+
+
+class _QueryHandler(StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            try:
+                response = self.server.query(line)
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(response, sort_keys=True) + '\n')
+            self.wfile.flush()
+
+
+def _books_response(books):
+    if books is None:
+        return {'ok': False, 'error': 'books are not loaded'}
+    return {'ok': True, 'books': [b.to_dict() for b in books]}
@@ -0,0 +1,384 @@
+'''A single-threaded event loop with generator-based coroutines.
+
+Python 2.7 has no asyncio, so this module provides the small part of it
+hondana needs: an EventLoop polling file descriptors and timers, Futures,
+Tasks driving generators which yield Futures (or other generators), and
+run_in_executor() for blocking calls such as NFC and kintone.
+A coroutine returns a value by raising Return(value).
+'''
+from collections import deque
+import errno
+import fcntl
+import heapq
+import itertools
+from multiprocessing.pool import ThreadPool
+import os
+import select
+import sys
+import time
+import types
+
+
+class CancelledError(Exception):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Return(Exception):
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Future(object):
+    def __init__(self, loop):
+        self._loop = loop
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def cancelled(self):
+        return self._cancelled
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('result is not ready')
+        if self._cancelled:
+            raise CancelledError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def set_result(self, result):
+        if self._done:
+            raise RuntimeError('future is already done')
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        '''set_exception sets an exception given as sys.exc_info()
+        or an exception instance.'''
+        if self._done:
+            raise RuntimeError('future is already done')
+        if isinstance(exc_info, BaseException):
+            exc_info = (type(exc_info), exc_info, None)
+        self._exc_info = exc_info
+        self._finish()
+
+    def cancel(self):
+        if self._done:
+            return False
+        self._cancelled = True
+        self._finish()
+        return True
+
+    def add_done_callback(self, fn):
+        if self._done:
+            self._loop.call_soon(fn, self)
+        else:
+            self._callbacks.append(fn)
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._loop.call_soon(fn, self)
+
+
+class Task(Future):
+    '''Task runs a generator, resuming it with the result of each Future
+    it yields. A yielded generator is run as a sub-task.'''
+    def __init__(self, loop, gen):
+        super(Task, self).__init__(loop)
+        self._gen = gen
+        self._waiting = None
+        self._must_cancel = False
+        loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        if self._done:
+            return False
+        # the task is woken up with CancelledError by the waited future,
+        # or by _step if the future has already been done.
+        if self._waiting is None or not self._waiting.cancel():
+            self._must_cancel = True
+        return True
+
+    def _step(self, value, exc_info):
+        if self._done:
+            return
+        if self._must_cancel:
+            self._must_cancel = False
+            exc_info = (CancelledError, CancelledError(), None)
+        self._waiting = None
+
+        try:
+            if exc_info is None:
+                yielded = self._gen.send(value)
+            else:
+                yielded = self._gen.throw(*exc_info)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return as r:
+            self.set_result(r.value)
+            return
+        except CancelledError:
+            Future.cancel(self)
+            return
+        except Exception:
+            self.set_exception(sys.exc_info())
+            return
+
+        if isinstance(yielded, types.GeneratorType):
+            yielded = Task(self._loop, yielded)
+        if not isinstance(yielded, Future):
+            self._loop.call_soon(self._step, None, (TypeError,
+                TypeError('coroutine yielded {!r}'.format(yielded)), None))
+            return
+        self._waiting = yielded
+        yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        try:
+            value = future.result()
+        except BaseException:
+            self._step(None, sys.exc_info())
+        else:
+            self._step(value, None)
+
+
+class Timer(object):
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    def __init__(self, executor=None):
+        self._ready = deque()
+        self._timers = []
+        self._seq = itertools.count()
+        self._readers = {}
+        self._poll = select.poll()
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in (self._wake_read, self._wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poll.register(self._wake_read, select.POLLIN)
+        self._executor = executor or ThreadPool(4)
+        self._stopping = False
+
+    def time(self):
+        return time.time()
+
+    def call_soon(self, fn, *args):
+        self._ready.append((fn, args))
+
+    def call_soon_threadsafe(self, fn, *args):
+        '''call_soon_threadsafe is call_soon for other threads
+        and signal handlers.'''
+        self._ready.append((fn, args))
+        try:
+            os.write(self._wake_write, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def call_later(self, delay, fn, *args):
+        timer = Timer(self.time() + delay, fn, args)
+        heapq.heappush(self._timers, (timer.when, next(self._seq), timer))
+        return timer
+
+    def add_reader(self, fd, fn):
+        self._readers[fd] = fn
+        self._poll.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._poll.unregister(fd)
+
+    def create_task(self, gen):
+        return Task(self, gen)
+
+    def run_in_executor(self, fn, *args):
+        '''run_in_executor calls fn(*args) in a worker thread and returns
+        a Future of its result. Cancelling the Future does not stop fn.'''
+        future = Future(self)
+        def set_result(result, exc_info):
+            if future.done():
+                return
+            if exc_info is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc_info)
+        def call():
+            try:
+                result = fn(*args)
+            except Exception:
+                self.call_soon_threadsafe(set_result, None, sys.exc_info())
+            else:
+                self.call_soon_threadsafe(set_result, result, None)
+        self._executor.apply_async(call)
+        return future
+
+    def run_until_complete(self, future):
+        if isinstance(future, types.GeneratorType):
+            future = self.create_task(future)
+        future.add_done_callback(lambda f: self.stop())
+        self.run_forever()
+        return future.result()
+
+    def run_forever(self):
+        while not self._stopping:
+            self._run_once()
+        self._stopping = False
+
+    def stop(self):
+        self._stopping = True
+
+    def close(self):
+        self._executor.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _run_once(self):
+        timeout = -1
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, (self._timers[0][0] - self.time()) * 1000)
+
+        try:
+            events = self._poll.poll(timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        for fd, ev in events:
+            if fd == self._wake_read:
+                try:
+                    while os.read(self._wake_read, 4096):
+                        pass
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            elif fd in self._readers:
+                self._ready.append((self._readers[fd], ()))
+
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._ready.append((timer.fn, timer.args))
+
+        for i in xrange(len(self._ready)):
+            fn, args = self._ready.popleft()
+            fn(*args)
+
+
+def sleep(loop, delay, result=None):
+    future = Future(loop)
+    def wake():
+        if not future.done():
+            future.set_result(result)
+    loop.call_later(delay, wake)
+    return future
+
+
+def wait_for(loop, future, timeout):
+    '''wait_for returns a Future of future's result which fails with
+    TimeoutError and cancels future if it takes more than timeout seconds.'''
+    if isinstance(future, types.GeneratorType):
+        future = loop.create_task(future)
+    if timeout is None:
+        return future
+
+    waiter = Future(loop)
+    def on_timeout():
+        if not waiter.done():
+            waiter.set_exception(TimeoutError())
+            future.cancel()
+    timer = loop.call_later(timeout, on_timeout)
+
+    def on_done(f):
+        timer.cancel()
+        if waiter.done():
+            return
+        if f.cancelled():
+            waiter.cancel()
+        elif f._exc_info is not None:
+            waiter.set_exception(f._exc_info)
+        else:
+            waiter.set_result(f._result)
+    future.add_done_callback(on_done)
+
+    def on_waiter_done(w):
+        if w.cancelled():
+            future.cancel()
+    waiter.add_done_callback(on_waiter_done)
+    return waiter
+
+
+class AsyncLineStream(object):
+    '''AsyncLineStream reads lines from an input source in the event loop.
+
+    Like ThreadLineReader, only the first line of each chunk inputted after
+    calling readline() is delivered; the others are skipped.
+    '''
+    def __init__(self, loop, source, line_reader):
+        self._loop = loop
+        self._source = source
+        self._line_reader = line_reader
+        self._waiter = None
+        self._eof = False
+        loop.add_reader(source.fileno(), self._on_readable)
+
+    def readline(self):
+        '''readline returns a Future of the next line inputted after
+        calling this method, which is None at EOF.'''
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.cancel()
+        self._waiter = Future(self._loop)
+        if self._eof:
+            self._deliver(None)
+        return self._waiter
+
+    def close(self):
+        self._loop.remove_reader(self._source.fileno())
+
+    def _on_readable(self):
+        data = self._source.read()
+        if data == '':
+            self._eof = True
+            self.close()
+            self._deliver(None)
+            return
+        if data is None:
+            return
+
+        self._line_reader.append(data)
+        line = self._line_reader.readline()
+        if line is None:
+            return
+        self._deliver(line)
+        self._line_reader.skiplines()
+
+    def _deliver(self, line):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(line)
@@ -0,0 +1,110 @@
+import hashlib
+import os
+from subprocess import check_call
+import tempfile
+import threading
+
+from cache import TTLCache
+from console import log
+
+
+AQUESTALK = '/home/pi/Downloads/aquestalkpi/AquesTalkPi'
+DEVNULL = open('/dev/null', 'w')
+
+
+def synthesize(text, wav_path):
+    '''synthesize writes speech of text into wav_path with AquesTalkPi.'''
+    with open(wav_path, 'wb') as f:
+        check_call([AQUESTALK, text], stdout=f, stderr=DEVNULL)
+
+
+class SpeechCache(object):
+    '''SpeechCache keeps synthesized speech as WAV files named by the hash
+    of the text.
+
+    Texts given to prerender() are kept for the lifetime of the cache.
+    Other texts, e.g. messages with names, are rendered on demand and the
+    least recently used ones are removed when there are more than
+    max_dynamic of them.
+    '''
+    def __init__(self, cache_dir, max_dynamic=32, synthesize=synthesize):
+        self._cache_dir = cache_dir
+        self._synthesize = synthesize
+        self._static = {}
+        self._dynamic = TTLCache(max_dynamic, on_evict=self._evict)
+        self._lock = threading.Lock()
+
+    def prerender(self, texts):
+        '''prerender renders texts unless they have been rendered before,
+        and removes files of texts which are no longer used.'''
+        for text in texts:
+            path = self._render(text)
+            with self._lock:
+                self._static[text] = path
+
+        with self._lock:
+            used = set(self._static.itervalues())
+        used.update(path for _, path in self._dynamic.items())
+        for name in os.listdir(self._cache_dir):
+            path = os.path.join(self._cache_dir, name)
+            if name.endswith('.wav') and path not in used:
+                self._remove(path)
+
+    def start_prerender(self, texts):
+        '''start_prerender calls prerender in a daemon thread.'''
+        def run():
+            try:
+                self.prerender(texts)
+            except Exception as e:
+                log('failed to prerender speech: {}'.format(e))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get(self, text):
+        '''get returns a path to the WAV file of text, rendering it
+        if it is not cached.'''
+        with self._lock:
+            path = self._static.get(text)
+        if path is not None:
+            return path
+
+        path = self._dynamic.get(text)
+        if path is None:
+            path = self._render(text)
+            self._dynamic.put(text, path)
+        return path
+
+    def path_of(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return os.path.join(
+            self._cache_dir, hashlib.sha1(text).hexdigest() + '.wav')
+
+    def _render(self, text):
+        path = self.path_of(text)
+        if os.path.exists(path):
+            return path
+
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self._cache_dir)
+        os.close(fd)
+        try:
+            self._synthesize(text, tmp_path)
+            os.rename(tmp_path, path)
+        except:
+            self._remove(tmp_path)
+            raise
+        return path
+
+    def _evict(self, text, path):
+        with self._lock:
+            if text in self._static:
+                return
+        self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,160 @@
+'''Stocktaking: the books on the shelves are scanned in a row and checked
+against the book app.'''
+from collections import Counter, defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+from console import log
+import kintone
+
+
+# missing is None if the expected books could not be fetched
+Report = namedtuple('Report', ['on_shelf', 'missing', 'unexpected'])
+# book is the BookView found on the shelf, or None
+Unexpected = namedtuple('Unexpected', ['isbn', 'reason', 'book'])
+
+REASON_NOT_REGISTERED = 'not registered'
+REASON_BORROWED = 'recorded as borrowed'
+REASON_EXTRA_COPY = 'more copies than registered'
+REASON_UNRESOLVED = 'lookup failed'
+
+
+class Stocktaker(object):
+    '''Stocktaker looks up scanned ISBNs in batches while scanning goes on.
+
+    lookup(isbns) must return the BookViews of isbns. It is called with
+    up to batch_size ISBNs in up to max_in_flight threads at a time.
+    fetch_expected() must return the BookViews expected on the shelves.
+    '''
+    def __init__(self, lookup, fetch_expected, batch_size=50,
+            max_in_flight=4):
+        self._lookup = lookup
+        self._fetch_expected = fetch_expected
+        self._batch_size = batch_size
+        self._pool = ThreadPool(max_in_flight)
+        self._scanned = Counter()
+        self._batch = []
+        self._lookups = []
+
+    def __len__(self):
+        '''len returns the number of scanned books.'''
+        return sum(self._scanned.itervalues())
+
+    def scan(self, isbn):
+        '''scan counts a copy of isbn, and returns False if isbn is not
+        an ISBN.'''
+        if not kintone.ISBN_PATTERN.match(isbn):
+            return False
+        if isbn not in self._scanned:
+            self._batch.append(isbn)
+            if len(self._batch) >= self._batch_size:
+                self._flush()
+        self._scanned[isbn] += 1
+        return True
+
+    def scanned(self):
+        '''scanned returns a dict from the scanned ISBNs to the number of
+        copies.'''
+        return dict(self._scanned)
+
+    def finish(self):
+        '''finish waits for the lookups and returns the Report.
+
+        A failed lookup is retried once. The books of a batch which fails
+        again are reported as unexpected with REASON_UNRESOLVED, and not
+        as missing, and the missing books are None if the expected books
+        cannot be fetched, so that the scans are not lost.'''
+        self._flush()
+        expected = self._pool.apply_async(self._fetch_expected)
+        books = {}
+        unresolved = Counter()
+        for isbns, result in self._lookups:
+            found = _get_or_retry(result, self._lookup, isbns)
+            if found is None:
+                for isbn in isbns:
+                    unresolved[isbn] = self._scanned[isbn]
+                continue
+            for b in found:
+                books[b.id] = b
+        expected = _get_or_retry(expected, self._fetch_expected)
+        self._pool.close()
+        self._pool.join()
+
+        scanned = Counter(dict((isbn, count)
+            for isbn, count in self._scanned.iteritems()
+            if isbn not in unresolved))
+        report = reconcile(scanned, books.values(), expected, unresolved)
+        for isbn, count in sorted(unresolved.iteritems()):
+            report.unexpected.extend(
+                [Unexpected(isbn, REASON_UNRESOLVED, None)] * count)
+        return report
+
+    def _flush(self):
+        if self._batch:
+            self._lookups.append((self._batch,
+                self._pool.apply_async(self._lookup, (self._batch,))))
+            self._batch = []
+
+
+def _get_or_retry(result, fn, *args):
+    '''_get_or_retry returns the value of the AsyncResult, or of fn(*args)
+    if it has failed, or None if both fail.'''
+    try:
+        return result.get()
+    except Exception as e:
+        log('failed to look up books, retrying: {}'.format(e))
+    try:
+        return fn(*args)
+    except Exception as e:
+        log('failed to look up books: {}'.format(e))
+        return None
+
+
+def reconcile(scanned, books, expected, unresolved=()):
+    '''reconcile matches scanned, a Counter of ISBNs, with books, the
+    BookViews of the ISBNs, and returns the Report. Free books are
+    matched first, and the expected books not matched are missing,
+    except those of the ISBNs in unresolved, which were scanned but
+    could not be looked up. If expected is None, missing is None.'''
+    by_isbn = defaultdict(list)
+    for b in books:
+        for isbn in b.isbns():
+            by_isbn[isbn].append(b)
+
+    on_shelf = []
+    unexpected = []
+    matched = set()
+    for isbn, count in sorted(scanned.iteritems()):
+        copies = sorted(
+            (b for b in by_isbn.get(isbn, ()) if b.id not in matched),
+            key=lambda b: (not b.is_free(), int(b.id)))
+        if not copies and not by_isbn.get(isbn):
+            unexpected.append(Unexpected(isbn, REASON_NOT_REGISTERED, None))
+            continue
+        for b in copies[:count]:
+            matched.add(b.id)
+            if b.is_free():
+                on_shelf.append(b)
+            else:
+                unexpected.append(Unexpected(isbn, REASON_BORROWED, b))
+        for i in range(count - len(copies)):
+            unexpected.append(Unexpected(isbn, REASON_EXTRA_COPY, None))
+
+    missing = None
+    if expected is not None:
+        unresolved = set(unresolved)
+        missing = sorted((b for b in expected if b.id not in matched
+                          and unresolved.isdisjoint(b.isbns())),
+            key=lambda b: (b.genre, int(b.id)))
+    return Report(on_shelf, missing, unexpected)
+
+
+def report_to_dict(report):
+    return {
+        'on_shelf': [b.to_dict() for b in report.on_shelf],
+        'missing': (None if report.missing is None
+                    else [b.to_dict() for b in report.missing]),
+        'unexpected': [
+            {'isbn': u.isbn, 'reason': u.reason,
+             'book': u.book.to_dict() if u.book is not None else None}
+            for u in report.unexpected],
+    }
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import threading
+import wave
+
+from audio import AudioScheduler, PRIORITY_HIGH
+
+
+class FakeSink(object):
+    rate = 8000
+    channels = 1
+    width = 2
+
+    def __init__(self):
+        self.written = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write(self, data):
+        self.gate.wait()
+        self.written.append(data)
+
+    def close(self):
+        pass
+
+
+def write_wav(path, nframes, rate=16000, channels=2):
+    w = wave.open(path, 'wb')
+    w.setnchannels(channels)
+    w.setsampwidth(2)
+    w.setframerate(rate)
+    w.writeframes('\x01\x00' * channels * nframes)
+    w.close()
+
+
+def test_AudioScheduler_converts_and_plays():
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'a.wav')
+        write_wav(path, 1600)
+        sink = FakeSink()
+        scheduler = AudioScheduler(sink)
+        scheduler.start()
+        assert scheduler.play(path).wait(5)
+        assert scheduler.wait_idle(5)
+        scheduler.stop()
+    finally:
+        shutil.rmtree(tempdir)
+
+    # 0.1 sec of 16kHz stereo is 800 frames of 8kHz mono
+    assert sum(len(d) for d in sink.written) == 800 * 2
+
+
+def test_AudioScheduler_flush_drops_stale_clips():
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'a.wav')
+        write_wav(path, 16000)
+        sink = FakeSink()
+        sink.gate.clear()
+        scheduler = AudioScheduler(sink)
+        scheduler.start()
+        playing = scheduler.play(path)
+        queued = scheduler.play(path)
+
+        scheduler.flush()
+        se = scheduler.play(path, PRIORITY_HIGH)
+        sink.gate.set()
+
+        assert queued.wait(5) and queued.cancelled
+        assert playing.wait(5) and playing.cancelled
+        assert se.wait(5) and not se.cancelled
+        scheduler.stop()
+    finally:
+        shutil.rmtree(tempdir)
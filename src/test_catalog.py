@@ -0,0 +1,139 @@
+# vim: set encoding=utf-8
+from pykintone.account import Account
+
+import catalog as catalog_module
+from catalog import BookCatalog
+from fakekintone import FakeKintoneServer
+from httpsession import KintoneSession, SessionService
+import kintone
+from kintone import KintoneEnv
+
+
+def create_book_record(record_id, revision, isbn, isbn13, status, updated):
+    return {
+        u'$id': {u'type': u'__ID__', u'value': unicode(record_id)},
+        u'$revision': {u'type': u'__REVISION__', u'value': unicode(revision)},
+        u'isbn': {u'type': u'SINGLE_LINE_TEXT', u'value': isbn},
+        u'isbn13': {u'type': u'SINGLE_LINE_TEXT', u'value': isbn13},
+        u'STATUS': {u'type': u'STATUS', u'value': status},
+        u'STATUS_ASSIGNEE': {u'type': u'STATUS_ASSIGNEE', u'value': []},
+        u'更新日時': {u'type': u'UPDATED_TIME', u'value': updated},
+    }
+
+
+def test_BookCatalog_sync_incrementally():
+    fetched = []
+    updates = [
+        [
+            create_book_record(1, 3, u'4789838072', u'9784789838078',
+                kintone.STATUS_FREE, u'2017-01-01T00:00:00Z'),
+            create_book_record(2, 5, u'', u'9784774142043',
+                kintone.STATUS_FREE, u'2017-01-02T00:00:00Z'),
+        ],
+        [
+            create_book_record(2, 6, u'', u'9784774142043',
+                kintone.STATUS_BORROWED, u'2017-01-03T00:00:00Z'),
+        ],
+    ]
+    def fetch_updated(since):
+        fetched.append(since)
+        return updates.pop(0)
+
+    catalog = BookCatalog(fetch_updated)
+    assert catalog.find('9784789838078') is None
+
+    assert catalog.sync() == 2
+    assert catalog.find('4789838072') == catalog.find('9784789838078')
+    assert len(catalog.find('9784789838078')) == 1
+    assert catalog.find('9780000000000') == []
+
+    assert catalog.sync() == 1
+    assert fetched == [None, u'2017-01-02T00:00:00Z']
+    assert len(catalog) == 2
+    r = catalog.find('9784774142043')[0]
+    assert r.status == kintone.STATUS_BORROWED
+    assert r.revision == 6
+
+
+def test_BookCatalog_put_keeps_newer_revision():
+    catalog = BookCatalog(lambda since: [])
+    catalog.sync()
+
+    record = create_book_record(1, 3, u'4789838072', u'9784789838078',
+        kintone.STATUS_FREE, u'2017-01-01T00:00:00Z')
+    catalog.put(kintone.BookView.from_record(kintone.updated_record(
+        record, 5, kintone.STATUS_BORROWED, [u'hoge-user'])))
+    catalog.put(kintone.BookView.from_record(record))
+
+    r = catalog.find('9784789838078')[0]
+    assert r.is_borrowed_by(u'hoge-user')
+    assert catalog.find_borrowed_by(u'hoge-user') == [r]
+
+    catalog.put(kintone.BookView.from_record(kintone.updated_record(
+        record, 7, kintone.STATUS_FREE, [])))
+    assert catalog.find_borrowed_by(u'hoge-user') == []
+
+
+def test_BookCatalog_full_sync_drops_deleted_records():
+    updates = [
+        [
+            create_book_record(1, 3, u'4789838072', u'9784789838078',
+                kintone.STATUS_FREE, u'2017-01-01T00:00:00Z'),
+            create_book_record(2, 5, u'', u'9784774142043',
+                kintone.STATUS_FREE, u'2017-01-02T00:00:00Z'),
+        ],
+        [
+            create_book_record(2, 5, u'', u'9784774142043',
+                kintone.STATUS_FREE, u'2017-01-02T00:00:00Z'),
+        ],
+    ]
+    catalog = BookCatalog(lambda since: updates.pop(0))
+    catalog.sync()
+    assert catalog.sync(full=True) == 1
+    assert len(catalog) == 1
+    assert catalog.find('9784789838078') == []
+
+
+def test_BookCatalog_is_not_trusted_when_stale(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(catalog_module.time, 'time', lambda: now[0])
+    catalog = BookCatalog(lambda since: [
+        create_book_record(1, 3, u'4789838072', u'9784789838078',
+            kintone.STATUS_FREE, u'2017-01-01T00:00:00Z')], max_age=600)
+    catalog.sync()
+    assert len(catalog.find('9784789838078')) == 1
+
+    now[0] += 600
+    assert catalog.find('9784789838078') is None
+    assert catalog.find_borrowed_by(u'hoge-user') is None
+
+
+def test_BookCatalog_syncs_from_kintone():
+    server = FakeKintoneServer()
+    server.add_app(2, [{
+        u'isbn': {u'type': u'SINGLE_LINE_TEXT', u'value': u'4789838072'},
+        u'isbn13': {u'type': u'SINGLE_LINE_TEXT', u'value': u''},
+        u'ステータス': {u'type': u'STATUS', u'value': kintone.STATUS_FREE},
+        u'作業者': {u'type': u'STATUS_ASSIGNEE', u'value': []},
+        u'更新日時': {u'type': u'UPDATED_TIME', u'value': u'2017-01-01T00:00:00Z'},
+    }])
+    server.start()
+    session = KintoneSession()
+    env = KintoneEnv(SessionService(Account('fake'), session, server.api_root),
+        1, 2, 3, False, session)
+    try:
+        fetched = []
+        def fetch_updated(since):
+            fetched.append(since)
+            return kintone.fetch_book_records_updated_since(env, since)
+        catalog = BookCatalog(fetch_updated)
+        assert catalog.sync() == 1
+
+        book_record, = kintone.find_book_records(env, '4789838072')
+        kintone.borrow_book(env, book_record, u'hoge-user')
+        assert catalog.sync() == 1
+        assert fetched[1] == u'2017-01-01T00:00:00Z'
+        assert catalog.find('4789838072')[0].is_borrowed_by(u'hoge-user')
+    finally:
+        session.close()
+        server.stop()
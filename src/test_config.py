@@ -0,0 +1,44 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import yaml
+
+import config
+
+
+def test_load_caches_by_mtime_and_size(monkeypatch):
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'kintone.yml')
+        cache_dir = os.path.join(tempdir, 'cache')
+        with open(path, 'w') as f:
+            f.write('apps:\n  book:\n    id: 2\n')
+        assert config.fetch_value_from_file('apps.book.id', path, cache_dir) == 2
+        assert os.stat(cache_dir).st_mode & 0777 == 0700
+
+        # a new process reads the parsed config from cache_dir
+        monkeypatch.setattr(config, '_parsed', {})
+        monkeypatch.setattr(yaml, 'load', None)
+        assert config.load(path, cache_dir) == {'apps': {'book': {'id': 2}}}
+        monkeypatch.undo()
+
+        with open(path, 'w') as f:
+            f.write('apps:\n  book:\n    id: 20\n')
+        assert config.fetch_value_from_file('apps.book.id', path, cache_dir) == 20
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_main_does_not_cache_without_cache_dir(tmpdir, monkeypatch, capsys):
+    conf = tmpdir.join('kintone.yml')
+    conf.write('login: {id: hoge, password: fuga}\n')
+    monkeypatch.setattr(config, 'DEFAULT_CACHE_DIR', str(tmpdir.join('cache')))
+    monkeypatch.setattr(config, '_parsed', {})
+    monkeypatch.setattr(sys, 'argv', ['config.py', 'login.id', str(conf)])
+
+    config.main()
+
+    assert capsys.readouterr()[0] == 'hoge\n'
+    assert tmpdir.listdir() == [conf]
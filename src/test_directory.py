@@ -0,0 +1,51 @@
+from cache import TTLCache
+from directory import UserDirectory
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_TTLCache_expires():
+    clock = FakeClock()
+    cache = TTLCache(10, ttl=5, clock=clock)
+    cache.put('a', 1)
+    clock.now = 5
+    assert cache.get('a') == 1
+    clock.now = 11
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_TTLCache_evicts_least_recently_used():
+    evicted = []
+    cache = TTLCache(2, on_evict=lambda k, v: evicted.append(k))
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+
+    assert evicted == ['b']
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_UserDirectory():
+    calls = []
+    def fetch_all():
+        calls.append(1)
+        return [(u'0123', u'hoge-user'), (u'4567', u'fuga-user')]
+
+    directory = UserDirectory(fetch_all)
+    assert directory.load() == 2
+    assert len(calls) == 1
+
+    assert directory.lookup('0123') == 'hoge-user'
+    assert directory.lookup('8901') is None
+
+    directory.put('8901', 'piyo-user')
+    assert directory.lookup('8901') == 'piyo-user'
@@ -0,0 +1,135 @@
+# vim: set encoding=utf-8
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import pytest
+from pykintone.account import Account
+
+import export
+from export import ReportStore
+from fakekintone import FakeKintoneServer
+from httpsession import KintoneSession, SessionService
+import kintone
+from kintone import KintoneEnv
+
+
+def create_book_record(isbn, updated_time):
+    return {
+        u'isbn': {u'type': u'SINGLE_LINE_TEXT', u'value': u''},
+        u'isbn13': {u'type': u'SINGLE_LINE_TEXT', u'value': isbn},
+        u'type': {u'type': u'DROP_DOWN', u'value': u'PGその他[棚6]'},
+        u'ステータス': {u'type': u'STATUS', u'value': kintone.STATUS_FREE},
+        u'作業者': {u'type': u'STATUS_ASSIGNEE', u'value': []},
+        kintone.BOOK_UPDATED_TIME_FIELD: {
+            u'type': u'UPDATED_TIME', u'value': updated_time},
+    }
+
+
+@pytest.fixture
+def server():
+    server = FakeKintoneServer()
+    server.add_app(2, [
+        create_book_record(u'9784789838078', u'2024-01-02T00:00:00Z'),
+        create_book_record(u'9784274068560', u'2024-01-01T00:00:00Z'),
+    ])
+    server.add_app(3)
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def env(server):
+    session = KintoneSession()
+    service = SessionService(Account('fake'), session, server.api_root)
+    yield KintoneEnv(service, 1, 2, 3, False, session)
+    session.close()
+
+
+@pytest.fixture
+def store_path():
+    temp_dir = tempfile.mkdtemp()
+    yield os.path.join(temp_dir, 'report.sqlite3')
+    shutil.rmtree(temp_dir)
+
+
+def test_export_logs(server, env, store_path):
+    kintone.add_logs(env, [
+        ('system1', json.dumps({'user_code': 'hoge-user',
+            'book_isbn': '9784789838078',
+            'message': 'successfully borrowed a book',
+            'timings_ms': {'borrow': 250}}), '2024-01-01T10:00:00Z'),
+        ('system1', 'not json', '2024-01-01T09:00:00Z'),
+        ('system2', json.dumps({'employee_id': '0123',
+            'user_code': 'hoge-user', 'message': 'nfc connected'}),
+            '2024-01-01T11:00:00Z'),
+    ])
+    store = ReportStore(store_path, page_size=2)
+    assert export.export_logs(env, store) == 3
+    assert store.high_water(export.HIGH_WATER_LOGS) == '2024-01-01T11:00:00Z'
+    assert store.high_water(export.HIGH_WATER_LOG_IDS) == '3'
+
+    kintone.add_logs(env, [
+        # shipped late, e.g. from the spool after an outage
+        ('system1', 'late', '2024-01-01T10:30:00Z'),
+        ('system1', 'old', '2024-01-01T08:00:00Z'),
+    ])
+    server.reset_counts()
+    assert export.export_logs(env, store) == 2
+    assert server.request_counts() == {
+        'POST records/cursor.json': 1, 'GET records/cursor.json': 1}
+    assert store.high_water(export.HIGH_WATER_LOGS) == '2024-01-01T11:00:00Z'
+    assert store.high_water(export.HIGH_WATER_LOG_IDS) == '5'
+    assert export.export_logs(env, store) == 0
+    store.close()
+
+    conn = sqlite3.connect(store_path)
+    rows = conn.execute('SELECT logged_at, system_id, event, user_code, '
+        'employee_id, book_isbn, timings_ms FROM logs ORDER BY logged_at')
+    assert rows.fetchall() == [
+        (u'2024-01-01T08:00:00Z', u'system1', u'old',
+         None, None, None, None),
+        (u'2024-01-01T09:00:00Z', u'system1', u'not json',
+         None, None, None, None),
+        (u'2024-01-01T10:00:00Z', u'system1', u'successfully borrowed a book',
+         u'hoge-user', None, u'9784789838078', u'{"borrow": 250}'),
+        (u'2024-01-01T10:30:00Z', u'system1', u'late',
+         None, None, None, None),
+        (u'2024-01-01T11:00:00Z', u'system2', u'nfc connected',
+         u'hoge-user', u'0123', None, None),
+    ]
+
+
+def test_export_books(server, env, store_path):
+    store = ReportStore(store_path)
+    assert export.export_books(env, store) == 2
+    assert store.high_water(export.HIGH_WATER_BOOKS) == '2024-01-02T00:00:00Z'
+
+    book_record = kintone.find_book_records(env, '9784274068560')[0]
+    kintone.borrow_book(env, book_record, 'hoge-user')
+    assert export.export_books(env, store) == 2
+    store.close()
+
+    conn = sqlite3.connect(store_path)
+    rows = conn.execute('SELECT id, isbn13, status, borrowers FROM books')
+    assert sorted(rows.fetchall()) == [
+        (1, u'9784789838078', kintone.STATUS_FREE, u'[]'),
+        (2, u'9784274068560', kintone.STATUS_BORROWED,
+         u'[{"code": "hoge-user", "name": "hoge-user"}]'),
+    ]
+
+
+def test_iter_records_deletes_unfinished_cursor(server, env):
+    server.add_app(4, [create_book_record(unicode(i), u'') for i in range(5)])
+    app = env.kintone.app(4)
+    assert len(list(kintone.iter_records(app, size=2))) == 5
+    assert server.open_cursors() == 0
+
+    records = kintone.iter_records(app, 'order by $id asc', ['$id'], size=2)
+    assert next(records)[u'$id'][u'value'] == u'1'
+    assert server.open_cursors() == 1
+    records.close()
+    assert server.open_cursors() == 0
@@ -0,0 +1,215 @@
+# vim: set encoding=utf-8
+import pytest
+from pykintone.account import Account
+import requests
+
+from fakekintone import FakeKintoneServer, parse_query
+from httpsession import KintoneSession, SessionService
+import kintone
+from kintone import KintoneEnv
+
+
+def create_book_record(isbn, status=kintone.STATUS_FREE, user_codes=()):
+    return {
+        u'isbn': {u'type': u'SINGLE_LINE_TEXT', u'value': isbn},
+        u'isbn13': {u'type': u'SINGLE_LINE_TEXT', u'value': u''},
+        u'ステータス': {u'type': u'STATUS', u'value': status},
+        u'作業者': {u'type': u'STATUS_ASSIGNEE',
+            u'value': [{u'code': c, u'name': c} for c in user_codes]},
+    }
+
+
+@pytest.fixture
+def server():
+    server = FakeKintoneServer()
+    server.add_app(1, [
+        {u'employeeNumber': {u'type': u'SINGLE_LINE_TEXT', u'value': u'0123'},
+         u'code': {u'type': u'SINGLE_LINE_TEXT', u'value': u'hoge-user'}}])
+    server.add_app(2, [create_book_record(u'4789838072')])
+    server.add_app(3)
+    server.add_user(u'hoge-user', u'ほげ')
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def env(server):
+    session = KintoneSession()
+    service = SessionService(Account('fake'), session, server.api_root)
+    yield KintoneEnv(service, 1, 2, 3, False, session)
+    session.close()
+
+
+def test_borrow_and_return(server, env):
+    assert kintone.fetch_user_code(env, '0123') == 'hoge-user'
+    book_record, = kintone.find_book_records(env, '4789838072')
+
+    record = kintone.borrow_book(env, book_record, 'hoge-user')
+    assert kintone.book_is_borrowed(record, 'hoge-user')
+    stored, = server.records(2)
+    assert kintone.book_is_borrowed(stored, 'hoge-user')
+    assert kintone.get_borrowing_users([stored]) == ['ほげ']
+
+    # a stale revision is rejected
+    with pytest.raises(kintone.RevisionConflictError):
+        kintone.proceed(env, book_record, u'system_borrow', 'hoge-user')
+
+    record = kintone.return_book(env, record, 'hoge-user')
+    assert kintone.book_is_free(record)
+    assert server.request_counts() == {
+        'GET records.json': 2,
+        'PUT record/status.json': 3,
+        'PUT record/assignees.json': 2,
+    }
+
+
+def test_fetch_book_schema(server, env):
+    schema = kintone.fetch_book_schema(env)
+    assert schema == kintone.BookSchema(
+        u'ステータス', u'作業者', kintone.BOOK_UPDATED_TIME_FIELD)
+
+    view = kintone.BookView.from_record(
+        kintone.find_book_records(env, '4789838072')[0], schema)
+    record = kintone.borrow_book(env, view.to_record(), 'hoge-user')
+    assert kintone.BookView.from_record(record, schema).is_borrowed_by(
+        'hoge-user')
+
+
+def test_book_fields_are_projected(server, env):
+    book_record = create_book_record(u'4774142042')
+    book_record[u'type'] = {u'type': u'DROP_DOWN', u'value': u'PGその他[棚6]'}
+    book_record[u'memo'] = {u'type': u'MULTI_LINE_TEXT', u'value': u'long text'}
+    server.add_app(2, [book_record])
+
+    fields = kintone.book_fields(kintone.fetch_book_schema(env))
+    record, = kintone.find_book_records(env, '4774142042', fields)
+    assert sorted(record) == sorted(fields)
+
+
+def test_compressed_responses(server):
+    server.add_app(4, [create_book_record(unicode(i)) for i in range(100)])
+    stats = {}
+    for compress in (True, False):
+        session = KintoneSession(compress=compress)
+        service = SessionService(Account('fake'), session, server.api_root)
+        assert len(kintone.select_all(service.app(4))) == 100
+        session.close()
+        stats[compress] = session.stats()
+
+    assert stats[False]['bytes_received'] == stats[False]['bytes_decoded']
+    assert stats[True]['bytes_decoded'] == stats[False]['bytes_decoded']
+    assert stats[True]['bytes_received'] * 4 < stats[False]['bytes_received']
+    assert 'function="select_all"' in kintone.CALL_BYTES.render()
+
+
+def test_find_book_records_by_isbns(server, env):
+    server.add_app(2, [
+        create_book_record(u'4774142042', kintone.STATUS_BORROWED, [u'hoge-user']),
+        create_book_record(u'4774142042'),
+    ])
+    records = kintone.find_book_records_by_isbns(
+        env, ['4789838072', '4774142042', '9784000000000'])
+    assert sorted(r[u'$id'][u'value'] for r in records) == [u'1', u'2', u'3']
+    assert server.request_counts() == {'GET records.json': 1}
+
+    schema = kintone.fetch_book_schema(env)
+    records = kintone.find_free_book_records(env, schema)
+    assert sorted(r[u'$id'][u'value'] for r in records) == [u'1', u'3']
+
+    with pytest.raises(RuntimeError):
+        kintone.find_book_records_by_isbns(env, ['97840") or ("1'])
+
+
+def test_borrow_and_return_books(server, env):
+    server.add_app(2, [
+        create_book_record(u'4774142042'),
+        create_book_record(u'4873115655', kintone.STATUS_BORROWED, [u'fuga-user']),
+    ])
+    book_records = kintone.find_book_records_by_isbns(
+        env, ['4789838072', '4774142042', '4873115655'])
+    server.reset_counts()
+
+    borrowed = kintone.borrow_books(env, book_records, 'hoge-user')
+    assert [r is not None for r in borrowed] == [True, True, False]
+    assert [kintone.book_is_borrowed(r, 'hoge-user')
+            for r in server.records(2)] == [True, True, False]
+    assert [r[u'$revision'][u'value'] for r in borrowed[:2]] == [
+        r[u'$revision'][u'value'] for r in server.records(2)[:2]]
+
+    returned = kintone.return_books(
+        env, borrowed[:2] + book_records[2:], 'hoge-user')
+    assert [r is not None for r in returned] == [True, True, False]
+    assert [kintone.book_is_free(r) for r in server.records(2)] == [
+        True, True, False]
+    assert server.request_counts() == {'POST bulkRequest.json': 2}
+
+    # the stale revisions fail the bulk request, and the books are
+    # borrowed one by one
+    server.reset_counts()
+    borrowed = kintone.borrow_books(env, book_records[:2], 'hoge-user')
+    assert all(kintone.book_is_borrowed(r, 'hoge-user') for r in borrowed)
+    assert server.request_counts()['POST bulkRequest.json'] == 1
+    assert server.request_counts()['PUT record/status.json'] == 4
+
+    # a bulk request is applied all or nothing
+    stored = server.records(2)
+    with pytest.raises(RuntimeError):
+        kintone._bulk_request(env, [
+            kintone._assignees_request(env, stored[0], []),
+            kintone._status_request(
+                env, stored[:1], u'system_borrow', check_revision=False),
+        ])
+    assert server.records(2) == stored
+
+
+def test_borrow_books_survives_connection_error(server, env, monkeypatch):
+    server.add_app(2, [create_book_record(u'4774142042')])
+    book_records = kintone.find_book_records_by_isbns(
+        env, ['4789838072', '4774142042'])
+    # a book per bulk request
+    monkeypatch.setattr(kintone, 'BULK_REQUEST_LIMIT', 2)
+    bulk_request = kintone._bulk_request
+    calls = []
+    def flaky_bulk_request(env, requests_):
+        calls.append(requests_)
+        if len(calls) == 1:
+            raise requests.ConnectionError('connection reset')
+        return bulk_request(env, requests_)
+    monkeypatch.setattr(kintone, '_bulk_request', flaky_bulk_request)
+
+    borrowed = kintone.borrow_books(env, book_records, 'hoge-user')
+    assert borrowed[0] is None
+    assert kintone.book_is_borrowed(borrowed[1], 'hoge-user')
+    assert len(calls) == 2
+
+
+def test_select_all_pages_by_id(server, env, monkeypatch):
+    monkeypatch.setattr(kintone, 'SELECT_LIMIT', 2)
+    server.add_app(4, [create_book_record(unicode(i)) for i in range(5)])
+    records = kintone.select_all(env.kintone.app(4), 'isbn != "3"', ['$id'])
+    assert [r[u'$id'][u'value'] for r in records] == [u'1', u'2', u'3', u'5']
+    assert server.request_counts() == {'GET records.json': 3}
+
+
+def test_injected_error(server, env):
+    server.inject_error()
+    with pytest.raises(RuntimeError):
+        kintone.add_log(env, 'system1', 'msg')
+    kintone.add_log(env, 'system1', 'msg')
+    assert server.records(3)[0][u'message'][u'value'] == u'msg'
+
+
+def test_parse_query():
+    cond, order, limit, offset = parse_query(
+        u'(isbn in ("1", "2") or $id > 10) and 更新日時 >= "2020-01-01" '
+        u'order by $id asc limit 500 offset 3')
+    record = {
+        u'$id': {u'value': u'2'},
+        u'isbn': {u'value': u'2'},
+        u'更新日時': {u'value': u'2020-01-02T00:00:00Z'},
+    }
+    assert cond(record)
+    record[u'isbn'][u'value'] = u'3'
+    assert not cond(record)
+    assert (order, limit, offset) == ([(u'$id', False)], 500, 3)
@@ -0,0 +1,38 @@
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import threading
+
+from httpsession import KintoneSession
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = '{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_KintoneSession_reuses_connections():
+    server = HTTPServer(('127.0.0.1', 0), OkHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        session = KintoneSession()
+        for i in range(3):
+            assert session.request('GET', url).ok
+        session.close()
+    finally:
+        server.shutdown()
+        thread.join()
+
+    assert session.stats() == {
+        'requests': 3, 'new_connections': 1, 'reused_connections': 2,
+        'bytes_received': 6, 'bytes_decoded': 6}
@@ -0,0 +1,29 @@
+import os
+import shutil
+import tempfile
+
+from inputsource import EvdevSource
+
+
+def key_events(codes):
+    data = ''
+    for code in codes:
+        for value in (1, 0):
+            data += EvdevSource.EVENT.pack(0, 0, EvdevSource.EV_KEY, code, value)
+            data += EvdevSource.EVENT.pack(0, 0, 0, 0, 0) # EV_SYN
+    return data
+
+
+def test_EvdevSource():
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'event0')
+        with open(path, 'wb') as f:
+            # 9, 7, 8, Enter
+            f.write(key_events([10, 8, 9, 28]))
+        source = EvdevSource(path, grab=False)
+        assert source.read() == '978\n'
+        assert source.read() == ''
+        source.close()
+    finally:
+        shutil.rmtree(tempdir)
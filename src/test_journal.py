@@ -0,0 +1,93 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import pytest
+
+import kintone
+from journal import Journal, Reconciler
+
+
+def create_book_record(book_id, status):
+    return {
+        u'$id': {u'type': u'__ID__', u'value': book_id},
+        u'$revision': {u'type': u'__REVISION__', u'value': u'1'},
+        u'STATUS': {u'type': u'STATUS', u'value': status},
+    }
+
+
+@pytest.fixture
+def journal_path():
+    tempdir = tempfile.mkdtemp()
+    yield os.path.join(tempdir, 'journal.sqlite3')
+    shutil.rmtree(tempdir)
+
+
+def test_Journal_survives_reopen(journal_path):
+    journal = Journal(journal_path)
+    key = journal.record(kintone.INTENT_BORROW,
+        create_book_record(u'1', kintone.STATUS_BORROWED), 'hoge-user')
+    journal.record(kintone.INTENT_BORROW,
+        create_book_record(u'1', kintone.STATUS_BORROWED), 'hoge-user', key)
+    journal.record(kintone.INTENT_RETURN,
+        create_book_record(u'1', kintone.STATUS_FREE), 'hoge-user')
+    journal.close()
+
+    journal = Journal(journal_path)
+    intents = journal.pending()
+    assert [(i.action, i.book_id) for i in intents] == [
+        (kintone.INTENT_BORROW, u'1'), (kintone.INTENT_RETURN, u'1')]
+    assert intents[0].key == key
+    records = journal.pending_records()
+    assert records[u'1'][u'STATUS'][u'value'] == kintone.STATUS_FREE
+
+    journal.mark_applied(key)
+    journal.mark_conflict(intents[1].key, u'already borrowed')
+    assert journal.pending() == []
+    assert journal.pending_records() == {}
+    assert journal.conflicts() == [(intents[1], u'already borrowed')]
+    journal.close()
+
+
+def test_Journal_records_station(journal_path):
+    # a journal created before intents had their station
+    conn = sqlite3.connect(journal_path)
+    conn.execute(Journal.SCHEMA.replace(',\n            system_id TEXT', ''))
+    conn.close()
+
+    journal = Journal(journal_path)
+    journal.record(kintone.INTENT_BORROW,
+        create_book_record(u'1', kintone.STATUS_BORROWED), 'hoge-user',
+        system_id='shelf-1')
+    journal.record(kintone.INTENT_BORROW,
+        create_book_record(u'2', kintone.STATUS_BORROWED), 'hoge-user')
+    assert [i.system_id for i in journal.pending()] == ['shelf-1', None]
+    journal.close()
+
+
+def test_Reconciler_keeps_order_per_book(journal_path):
+    journal = Journal(journal_path)
+    for book_id, action in [(u'1', kintone.INTENT_BORROW),
+                            (u'1', kintone.INTENT_RETURN),
+                            (u'2', kintone.INTENT_BORROW),
+                            (u'3', kintone.INTENT_BORROW)]:
+        journal.record(action, create_book_record(book_id, u''), 'hoge-user')
+
+    applied = []
+    conflicts = []
+    def apply(intent):
+        if intent.book_id == u'1':
+            raise RuntimeError('kintone is down')
+        if intent.book_id == u'3':
+            raise kintone.IntentConflictError(u'borrowed by fuga-user')
+        applied.append(intent.book_id)
+
+    reconciler = Reconciler(journal, apply,
+        lambda intent, reason: conflicts.append((intent.book_id, reason)))
+    assert reconciler.reconcile() == 2
+    assert applied == [u'2']
+    assert conflicts == [(u'3', u'borrowed by fuga-user')]
+    assert [i.action for i in journal.pending()] == [
+        kintone.INTENT_BORROW, kintone.INTENT_RETURN]
+    journal.close()
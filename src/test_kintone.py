@@ -0,0 +1,195 @@
+# vim: set encoding=utf-8
+import copy
+
+import pytest
+
+import config
+import kintone
+from kintone import KintoneEnv
+
+
+class Result(object):
+    def __init__(self, revision=-1, record=None, error=None):
+        self.ok = error is None
+        self.revision = revision
+        self.record = record
+        self.error = error
+
+
+class Error(object):
+    def __init__(self, code):
+        self.code = code
+
+
+class FakeBookApp(object):
+    '''FakeBookApp emulates the revision check of a single book record.'''
+    def __init__(self, record):
+        self.record = record
+        self.calls = []
+
+    def _revision(self):
+        return int(self.record[u'$revision'][u'value'])
+
+    def _update(self, record, status=None, user_codes=None):
+        if int(record[u'$revision'][u'value']) != self._revision():
+            return Result(error=Error(kintone.REVISION_CONFLICT))
+        self.record = kintone.updated_record(
+            self.record, self._revision() + 1, status, user_codes)
+        return Result(revision=self._revision())
+
+    def proceed(self, record, action, assignee=''):
+        self.calls.append(('proceed', action))
+        if action == u'返す':
+            return self._update(record, kintone.STATUS_FREE)
+        return self._update(record, kintone.STATUS_BORROWED, [assignee])
+
+    def get(self, record_id):
+        self.calls.append(('get', record_id))
+        return Result(record=copy.deepcopy(self.record))
+
+    def set_assignee(self, record, user_codes):
+        self.calls.append(('set_assignee', user_codes))
+        return self._update(record, user_codes=user_codes)
+
+
+def create_env(book_app, direct_assign=False):
+    class FakeKintone(object):
+        def app(self, app_id):
+            return book_app
+    return KintoneEnv(FakeKintone(), 1, 2, 3, direct_assign, None)
+
+
+def create_book_record(status, user_codes):
+    return {
+        u'$id': {u'type': u'__ID__', u'value': u'1'},
+        u'$revision': {u'type': u'__REVISION__', u'value': u'1'},
+        u'STATUS': {u'type': u'STATUS', u'value': status},
+        u'STATUS_ASSIGNEE': {u'type': u'STATUS_ASSIGNEE',
+            u'value': [{u'code': c, u'name': c} for c in user_codes]},
+    }
+
+
+def patch_set_assignee(monkeypatch, book_app):
+    monkeypatch.setattr(kintone, 'set_assignee',
+        lambda env, record, user_codes: book_app.set_assignee(record, user_codes))
+
+
+def test_borrow_book_chains_revisions(monkeypatch):
+    book_app = FakeBookApp(create_book_record(kintone.STATUS_FREE, []))
+    patch_set_assignee(monkeypatch, book_app)
+
+    record = kintone.borrow_book(
+        create_env(book_app), copy.deepcopy(book_app.record), 'hoge-user')
+
+    assert book_app.calls == [
+        ('proceed', u'system_borrow'), ('set_assignee', ['hoge-user'])]
+    assert kintone.book_is_borrowed(record, 'hoge-user')
+    assert record[u'$revision'] == book_app.record[u'$revision']
+
+
+def test_borrow_book_direct_assign(monkeypatch):
+    book_app = FakeBookApp(create_book_record(kintone.STATUS_FREE, []))
+    patch_set_assignee(monkeypatch, book_app)
+
+    record = kintone.borrow_book(
+        create_env(book_app, direct_assign=True),
+        copy.deepcopy(book_app.record), 'hoge-user')
+
+    assert book_app.calls == [('proceed', u'system_borrow')]
+    assert kintone.book_is_borrowed(record, 'hoge-user')
+
+
+def test_return_book_retries_on_conflict(monkeypatch):
+    book_app = FakeBookApp(create_book_record(
+        kintone.STATUS_BORROWED, ['hoge-user']))
+    patch_set_assignee(monkeypatch, book_app)
+    stale_record = copy.deepcopy(book_app.record)
+    book_app.record[u'$revision'][u'value'] = u'2'
+
+    record = kintone.return_book(create_env(book_app), stale_record, 'hoge-user')
+
+    assert book_app.calls == [
+        ('set_assignee', []), ('get', u'1'),
+        ('set_assignee', []), ('proceed', u'返す')]
+    assert kintone.book_is_free(record)
+    assert kintone.get_assignee_codes(record) == []
+
+
+def test_borrow_book_someone_else_won(monkeypatch):
+    book_app = FakeBookApp(create_book_record(
+        kintone.STATUS_BORROWED, ['fuga-user']))
+    patch_set_assignee(monkeypatch, book_app)
+    book_app.record[u'$revision'][u'value'] = u'2'
+
+    record = kintone.borrow_book(create_env(book_app),
+        create_book_record(kintone.STATUS_FREE, []), 'hoge-user')
+
+    assert record is None
+
+
+def test_replay_intent_is_idempotent(monkeypatch):
+    book_app = FakeBookApp(create_book_record(kintone.STATUS_FREE, []))
+    patch_set_assignee(monkeypatch, book_app)
+    env = create_env(book_app)
+
+    record = kintone.replay_intent(env, kintone.INTENT_BORROW, u'1', 'hoge-user')
+    assert kintone.book_is_borrowed(record, 'hoge-user')
+    calls = len(book_app.calls)
+
+    kintone.replay_intent(env, kintone.INTENT_BORROW, u'1', 'hoge-user')
+    assert book_app.calls[calls:] == [('get', u'1')]
+
+    with pytest.raises(kintone.IntentConflictError):
+        kintone.replay_intent(env, kintone.INTENT_BORROW, u'1', 'fuga-user')
+
+
+def test_init_parses_config_once(tmpdir, monkeypatch):
+    conf = tmpdir.join('kintone.yml')
+    conf.write('\n'.join([
+        'domain: example',
+        'login: {id: hoge, password: fuga}',
+        'apps:',
+        '  meibo: {id: 1}',
+        '  book: {id: 2, token: book-token, direct_assign: true}',
+        '  log: {id: 3}',
+    ]))
+    monkeypatch.setattr(config, 'DEFAULT_CACHE_DIR', str(tmpdir.join('cache')))
+
+    env = kintone.init(str(conf))
+
+    assert (env.meibo_app_id, env.book_app_id, env.log_app_id) == (1, 2, 3)
+    assert env.direct_assign
+    book_app = env.kintone.app(2)
+    assert book_app.account.domain == 'example'
+    assert book_app.account.login_id == 'hoge'
+    assert book_app.api_token == 'book-token'
+    env.session.close()
+
+
+def test_BookView():
+    record = {
+        u'$id': {u'type': u'__ID__', u'value': u'7'},
+        u'$revision': {u'type': u'__REVISION__', u'value': u'3'},
+        u'isbn': {u'type': u'SINGLE_LINE_TEXT', u'value': u''},
+        u'isbn13': {u'type': u'SINGLE_LINE_TEXT', u'value': u'9784789838078'},
+        u'type': {u'type': u'DROP_DOWN', u'value': u'PGその他[棚6]'},
+        u'memo': {u'type': u'MULTI_LINE_TEXT', u'value': u'long text'},
+        u'ステータス': {u'type': u'STATUS', u'value': kintone.STATUS_BORROWED},
+        u'作業者': {u'type': u'STATUS_ASSIGNEE',
+            u'value': [{u'code': u'hoge-user', u'name': u'佐藤 太郎'}]},
+    }
+    schema = kintone.resolve_book_schema(record)
+    assert schema == kintone.BookSchema(u'ステータス', u'作業者', None)
+
+    view = kintone.BookView.from_record(record, schema)
+    assert not hasattr(view, '__dict__')
+    assert (view.id, view.revision, view.isbns()) == (u'7', 3, [u'9784789838078'])
+    assert view.is_borrowed_by(u'hoge-user')
+    assert not view.is_borrowed_by(u'fuga-user')
+    assert not view.is_free()
+    assert view.user_names() == ['佐藤太郎']
+
+    # the fields not in the view are dropped
+    del record[u'memo']
+    assert view.to_record() == record
+    assert kintone.BookView.from_record(view.to_record(), schema) == view
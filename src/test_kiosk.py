@@ -0,0 +1,41 @@
+# vim: set encoding=utf-8
+import jinja2
+import pytest
+import socket
+import urllib2
+
+from kiosk import KioskServer
+from main import KioskReturnPositioner
+
+
+def test_KioskServer_pushes_genre():
+    template = jinja2.Template(
+        '{% if kiosk %}<script>EventSource</script>{% endif %}{{ genre }}')
+    server = KioskServer(('127.0.0.1', 0), template, '.')
+    server.start()
+    try:
+        positioner = KioskReturnPositioner(server)
+        positioner.show('infraA[棚3]')
+
+        page = urllib2.urlopen(server.url).read()
+        assert page == '<script>EventSource</script>infraa'
+
+        sock = socket.create_connection(('127.0.0.1', server.server_port))
+        sock.sendall('GET /events HTTP/1.0\r\n\r\n')
+        events = sock.makefile('rb', 0)
+        while events.readline() != '\r\n':
+            pass # skip headers
+        assert events.readline() == 'data: infraa\n'
+        assert events.readline() == '\n'
+
+        positioner.hide()
+        assert events.readline() == 'data: \n'
+        sock.close()
+
+        assert urllib2.urlopen(server.url + 'hondana.png').read()
+        for name in ['kiosk.py', 'hondana.html', '../src/kiosk.py']:
+            with pytest.raises(urllib2.HTTPError) as e:
+                urllib2.urlopen(server.url + name)
+            assert e.value.code == 404
+    finally:
+        server.stop()
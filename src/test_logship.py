@@ -0,0 +1,76 @@
+import shutil
+import tempfile
+import threading
+import time
+
+from logship import LogShipper
+
+
+def test_LogShipper_batches():
+    shipped = []
+    sent = threading.Event()
+    def ship(logs):
+        shipped.append(list(logs))
+        sent.set()
+
+    spool_dir = tempfile.mkdtemp()
+    try:
+        shipper = LogShipper(ship, spool_dir, batch_size=3, flush_interval=60)
+        shipper.start()
+        for i in range(3):
+            shipper.put('system1', 'msg{}'.format(i), 'now')
+        assert sent.wait(5)
+        shipper.stop()
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert shipped == [[
+        ('system1', 'msg0', 'now'),
+        ('system1', 'msg1', 'now'),
+        ('system1', 'msg2', 'now')]]
+
+
+def test_LogShipper_keeps_unsent_logs_in_spool():
+    def failing_ship(logs):
+        raise RuntimeError('kintone is down')
+
+    spool_dir = tempfile.mkdtemp()
+    try:
+        shipper = LogShipper(failing_ship, spool_dir)
+        shipper.start()
+        shipper.put('system1', 'msg0', 'now')
+        shipper.stop()
+
+        shipped = []
+        shipper = LogShipper(shipped.extend, spool_dir)
+        shipper.start()
+        shipper.stop()
+    finally:
+        shutil.rmtree(spool_dir)
+
+    assert shipped == [(u'system1', u'msg0', u'now')]
+
+
+def test_LogShipper_backs_off_full_batch():
+    attempts = []
+    def failing_ship(logs):
+        attempts.append(time.time())
+        raise RuntimeError('kintone is down')
+
+    spool_dir = tempfile.mkdtemp()
+    try:
+        shipper = LogShipper(failing_ship, spool_dir, batch_size=1,
+            flush_interval=0.1, max_backoff=0.4)
+        shipper.start()
+        for i in range(3):
+            shipper.put('system1', 'msg{}'.format(i), 'now')
+        time.sleep(1.5)
+        del attempts[:]
+        time.sleep(1)
+        retries = len(attempts)
+        shipper.stop()
+    finally:
+        shutil.rmtree(spool_dir)
+
+    # retried every max_backoff seconds, not on every pass of the loop
+    assert 1 <= retries <= 3
@@ -4,14 +4,28 @@ from datetime import datetime
 import jinja2
 import json
 import mock
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
+import signal
 import tempfile
-
+import threading
+
+from audio import AudioScheduler
+from cache import TTLCache
+from directory import UserDirectory
+from inputsource import FdSource
+from journal import Journal, Reconciler
+import kintone
+from kintone import BookView
+import metrics
 from main import (
         LineReader, ThreadLineReader, Messages,
         EpiphanyBrowser, BrowserReturnPositioner, EmployeeIDScanner,
-        Kintone, KintoneLogger, MessagePrinter, Sound, BookProcedure)
+        Kintone, KintoneLogger, MessagePrinter, Sound, BookProcedure,
+        StartupTimer, Station, StationWorker, load_stations, CMD_RETURN,
+        AsyncBookProcedure, run_async)
+from runtime import EventLoop, Future
 
 
 def test_LineReader():
@@ -27,6 +41,23 @@ def test_LineReader():
     assert reader.readline() is None
 
 
+def test_LineReader_flood():
+    reader = LineReader()
+    for i in range(1000):
+        reader.append('{}\n'.format(i))
+    reader.append('partial')
+
+    assert [reader.readline() for i in range(1000)] == \
+            [str(i) for i in range(1000)]
+    assert reader.readline() is None
+
+    reader.append(' line\nlast\n')
+    reader.skiplines()
+    assert reader.readline() is None
+    reader.append('next\n')
+    assert reader.readline() == 'next'
+
+
 def test_ThreadLineReader():
     def sync_write(data):
         reader.clear_processed()
@@ -48,6 +79,59 @@ def test_ThreadLineReader():
     reader.terminate()
 
 
+def test_ThreadLineReader_discards_stale_line():
+    def sync_write(data):
+        reader.clear_processed()
+        os.write(wp, data)
+        reader.wait_processed()
+
+    rp, wp = os.pipe()
+    reader = ThreadLineReader(rp)
+    reader.start()
+
+    # scanned for a procedure which has already given up
+    reader.set_next_flag()
+    sync_write('9784789838078\n')
+
+    reader.set_next_flag()
+    assert reader.readline(timeout=0.1) is None
+    sync_write('9784774142043\n')
+    assert reader.readline(timeout=5) == '9784774142043'
+
+    reader.terminate()
+
+
+def test_ThreadLineReader_stream():
+    rp, wp = os.pipe()
+    reader = ThreadLineReader(rp, stream=True)
+    reader.start()
+
+    os.write(wp, '9784789838078\n9784774142043\n97847')
+    assert reader.readline(timeout=5) == '9784789838078'
+    assert reader.readline(timeout=5) == '9784774142043'
+    os.write(wp, '74142043\n')
+    assert reader.readline(timeout=5) == '9784774142043'
+
+    os.close(wp)
+    reader.join(5)
+    assert not reader.is_alive()
+
+
+def test_ThreadLineReader_terminate_wakes_readline():
+    rp, wp = os.pipe()
+    reader = ThreadLineReader(rp)
+    reader.start()
+    reader.set_next_flag()
+
+    threading.Timer(0.1, reader.terminate).start()
+    begin_dt = datetime.utcnow()
+    assert reader.readline(timeout=20) is None
+    assert (datetime.utcnow() - begin_dt).total_seconds() < 5
+    reader.join(5)
+    assert not reader.is_alive()
+    assert reader.readline(timeout=20) is None
+
+
 def test_ThreadLineReader_must_stop():
     rp, wp = os.pipe()
     reader = ThreadLineReader(rp)
@@ -80,6 +164,185 @@ def test_BrowserReturnPositioner():
         shutil.rmtree(tempdir)
 
 
+def test_BrowserReturnPositioner_prerender():
+    fake_browser = mock.create_autospec(EpiphanyBrowser)
+    html_template = jinja2.Template('genre: {{ genre }}')
+    tempdir = tempfile.mkdtemp()
+    try:
+        stale_page = os.path.join(
+            tempdir, BrowserReturnPositioner.PAGE_PREFIX + 'stale.html')
+        open(stale_page, 'w').close()
+
+        positioner = BrowserReturnPositioner(
+            fake_browser, html_template, tempdir, max_other_pages=1)
+        positioner.prerender()
+        assert not os.path.exists(stale_page)
+        num_pages = len(os.listdir(tempdir))
+
+        positioner.show('技術書[棚3]')
+        positioner.show('技術書')
+        assert len(os.listdir(tempdir)) == num_pages
+        assert fake_browser.open.call_args_list[0] == \
+                fake_browser.open.call_args_list[1]
+        with open(fake_browser.open.call_args[0][0]) as f:
+            assert f.read() == 'genre: tech_book'
+
+        positioner.show('infraA[棚3]')
+        positioner.show('infraB[棚3]')
+        assert len(os.listdir(tempdir)) == num_pages + 1
+
+        positioner.close()
+        assert os.listdir(tempdir) == []
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_Kintone_fetch_user_code_uses_directory():
+    directory = UserDirectory(lambda: [('0123', 'hoge-user')])
+    directory.load()
+    kin = Kintone(None, directory)
+
+    with mock.patch('kintone.fetch_user_code') as fetch_user_code:
+        fetch_user_code.return_value = 'fuga-user'
+        assert kin.fetch_user_code('0123') == 'hoge-user'
+        assert not fetch_user_code.called
+
+        assert kin.fetch_user_code('4567') == 'fuga-user'
+        assert kin.fetch_user_code('4567') == 'fuga-user'
+        assert fetch_user_code.call_count == 1
+
+
+def test_Kintone_journals_borrow():
+    tempdir = tempfile.mkdtemp()
+    try:
+        journal = Journal(os.path.join(tempdir, 'journal.sqlite3'))
+        book_record = create_book_record('9784789838078', 'PGその他[棚6]', None)
+        book_record[u'$id'] = {u'type': u'__ID__', u'value': u'1'}
+        book_record[u'$revision'] = {u'type': u'__REVISION__', u'value': u'1'}
+        book_view = BookView.from_record(book_record)
+        kin = Kintone(None, journal=journal).for_station('shelf-1')
+
+        with mock.patch('kintone.find_book_records') as find_book_records, \
+                mock.patch('kintone.borrow_book') as borrow_book:
+            find_book_records.return_value = [book_record]
+            assert kin.borrow_book(book_view, 'hoge-user')
+            assert not borrow_book.called
+            assert journal.pending()[0].system_id == 'shelf-1'
+            records = kin.find_book_records('9784789838078')
+            assert records[0].is_borrowed_by('hoge-user')
+
+            with mock.patch('kintone.replay_intent') as replay_intent:
+                replay_intent.return_value = book_record
+                Reconciler(journal, kin.replay).reconcile()
+                replay_intent.assert_called_once_with(
+                    None, kintone.INTENT_BORROW, u'1', 'hoge-user')
+            assert kin.find_book_records('9784789838078') == [book_view]
+        journal.close()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_StartupTimer_runs_stages_in_parallel():
+    timer = StartupTimer()
+    barrier = threading.Event()
+    def wait():
+        return barrier.wait(5)
+    results = timer.run_all(
+        [('wait', wait), ('set', barrier.set)], parallel=True)
+
+    assert results == [True, None]
+    assert 'wait' in timer.report() and 'set' in timer.report()
+
+
+def test_EmployeeIDScanner_caches_idm():
+    tag = mock.Mock(identifier='\x01' * 8)
+    tag.polling.return_value = ('\x02' * 8, '\x03' * 8)
+    tag.read_without_encryption.return_value = (
+        '\x00' * 6 + 'CBZ' + '\x00' + '012345')
+    clf = mock.Mock()
+    clf.connect.side_effect = lambda rdwr, terminate: rdwr['on-connect'](tag)
+    scanner = EmployeeIDScanner(clf, TTLCache(16, 60))
+
+    assert scanner.scan() == '012345'
+    assert scanner.scan() == '012345'
+    assert tag.read_without_encryption.call_count == 1
+    assert tag.polling.call_count == 1
+
+
+def test_StationWorker_survives_failed_transaction():
+    processed = []
+    done = threading.Event()
+    def process_employee_id(employee_id):
+        processed.append(employee_id)
+        if len(processed) == 1:
+            raise RuntimeError('kintone is down')
+        done.set()
+    procedure = mock.create_autospec(BookProcedure)
+    procedure.scan_employee_id.side_effect = ['0123', '4567'] + [None] * 100
+    procedure.process_employee_id.side_effect = process_employee_id
+    line_reader = mock.create_autospec(ThreadLineReader)
+
+    worker = StationWorker('shelf-1', procedure, line_reader)
+    worker.start()
+    assert done.wait(5)
+    worker.stop()
+
+    assert processed[:2] == ['0123', '4567']
+    assert procedure.terminate.called
+    assert line_reader.terminate.called
+    assert 'station="shelf-1"' in metrics.REGISTRY.render()
+
+
+def test_StationWorkers_flush_only_their_own_prompts():
+    scheduler = AudioScheduler(mock.Mock(rate=8000, channels=1, width=2))
+    touched = threading.Event()
+    def create_worker(system_id, employee_ids):
+        sound = Sound(scheduler.channel(system_id))
+        stopped = threading.Event()
+        def scan_employee_id():
+            if employee_ids:
+                return employee_ids.pop()
+            stopped.wait()
+        def process_employee_id(employee_id):
+            sound.play_se()
+            touched.set()
+        procedure = mock.create_autospec(BookProcedure)
+        procedure.scan_employee_id.side_effect = scan_employee_id
+        procedure.process_employee_id.side_effect = process_employee_id
+        procedure.terminate.side_effect = stopped.set
+        line_reader = mock.create_autospec(ThreadLineReader)
+        return StationWorker(system_id, procedure, line_reader)
+
+    workers = [create_worker('shelf-1', ['0123']), create_worker('shelf-2', [])]
+    stale = scheduler.channel('shelf-1').play('prompt.wav')
+    prompt = scheduler.channel('shelf-2').play('prompt.wav')
+    for worker in workers:
+        worker.start()
+    assert touched.wait(5)
+    for worker in workers:
+        worker.stop()
+
+    assert stale.cancelled
+    assert not prompt.cancelled
+
+
+def test_load_stations():
+    tempdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tempdir, 'stations.yml')
+        with open(path, 'w') as f:
+            f.write('stations:\n'
+                    '  - {system_id: shelf-1, barcode_device: /dev/input/a}\n'
+                    '  - {system_id: shelf-2, nfc: "usb:001:004",'
+                    ' barcode_device: /dev/input/b}\n')
+        assert load_stations(path) == [
+            Station('shelf-1', 'usb', '/dev/input/a'),
+            Station('shelf-2', 'usb:001:004', '/dev/input/b'),
+        ]
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def test_KintoneLogger():
     kintone = mock.create_autospec(Kintone)
     logger = KintoneLogger('system1', kintone)
@@ -95,7 +358,21 @@ def test_KintoneLogger():
     assert json_obj['user_code'] == 'user-hoge'
 
 
-def create_book_procedure(id_user_map, book_records):
+def test_KintoneLogger_attaches_timings():
+    kintone = mock.create_autospec(Kintone)
+    logger = KintoneLogger('system1', kintone, attach_timings=True)
+    with metrics.trace() as timings:
+        timings['borrow'] = 0.25
+        logger.log_completed('user-hoge', '9784789838078', 'message')
+
+    system_id, json_msg = kintone.add_log.call_args[0]
+    assert json.loads(json_msg)['timings_ms'] == {'borrow': 250}
+
+
+def create_book_procedure(id_user_map, book_records, executor=None,
+        session_timeout=None):
+    book_records = [BookView.from_record(r) for r in book_records]
+
     class FakeKintone(object):
         def __init__(self):
             self.called_map = defaultdict(int)
@@ -106,21 +383,28 @@ def create_book_procedure(id_user_map, book_records):
 
         def find_book_records(self, barcode):
             self.called_map['find_book_records'] += 1
-            return [r for r in book_records
-                    if r[u'isbn'][u'value'] == barcode]
+            return [r for r in book_records if r.isbn == barcode]
 
         def borrow_book(self, book_record, user_code):
             self.called_map['borrow_book'] += 1
-            if book_record[u'STATUS'][u'value'] == u'本棚にあります':
+            if book_record.status == u'本棚にあります':
                 return True # success
             return False
 
         def return_book(self, book_record, user_code):
             self.called_map['return_book'] += 1
-            if book_record[u'STATUS'][u'value'] == u'レンタル中':
+            if book_record.status == u'レンタル中':
                 return True # success
             return False
 
+        def borrow_books(self, book_records, user_code):
+            self.called_map['borrow_books'] += 1
+            return [self.borrow_book(r, user_code) for r in book_records]
+
+        def return_books(self, book_records, user_code):
+            self.called_map['return_books'] += 1
+            return [self.return_book(r, user_code) for r in book_records]
+
         def add_log(self, system_id, json_msg):
             self.called_map['add_log'] += 1
             self._system_id = system_id
@@ -137,7 +421,7 @@ def create_book_procedure(id_user_map, book_records):
     return {
         'procedure': BookProcedure(
             msg_printer, kintone, logger, positioner,
-            id_scanner, sound, line_reader),
+            id_scanner, sound, line_reader, executor, session_timeout),
         'msg_printer': msg_printer,
         'kintone': kintone,
         'logger': logger,
@@ -187,6 +471,12 @@ def create_book_record(isbn, genre, borrowed_by):
     return record
 
 
+def with_ids(records):
+    for i, r in enumerate(records):
+        r[u'$id'] = {u'type': u'__ID__', u'value': unicode(i + 1)}
+    return records
+
+
 def test_BookProcedure_borrow():
     o = create_book_procedure(
         {
@@ -270,3 +560,313 @@ def test_BookProcedure_unknown_user():
 
     assert o['kintone'].called_map['find_book_records'] == 0
     assert not o['logger'].log_completed.called
+
+
+def test_BookProcedure_concurrent_return():
+    executor = ThreadPool(2)
+    o = create_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        [
+            create_book_record('9784789838078', 'PGその他[棚6]', 'hoge-user'),
+        ],
+        executor)
+
+    o['id_scanner'].scan.return_value = '0123'
+    o['line_reader'].readline.return_value = '9784789838078'
+
+    o['procedure'].process_once()
+    executor.close()
+    executor.join()
+
+    assert o['positioner'].hide.called
+    o['positioner'].show.assert_called_once_with('PGその他[棚6]')
+    o['logger'].log_nfc_connected.assert_called_once_with('0123', 'hoge-user')
+    o['logger'].log_completed.assert_called_once_with(
+        'hoge-user', '9784789838078', 'successfully returned a book')
+
+
+def test_BookProcedure_session_times_out():
+    o = create_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        with_ids([
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+            create_book_record('9784274068560', 'PG言語[棚2]', 'hoge-user'),
+            create_book_record('9784873115658', 'PG言語[棚2]', 'fuga-user'),
+        ]),
+        session_timeout=10)
+
+    o['id_scanner'].scan.return_value = '0123'
+    o['line_reader'].readline.side_effect = [
+        '9784789838078', '9784274068560', '9784873115658', None]
+
+    o['procedure'].process_once()
+
+    assert o['kintone'].called_map['borrow_books'] == 1
+    assert o['kintone'].called_map['return_books'] == 1
+    o['line_reader'].readline.assert_called_with(timeout=10)
+    o['positioner'].show.assert_called_once_with('PG言語[棚2]')
+    o['msg_printer'].put.assert_any_call(
+        Messages.SESSION_COMPLETED, borrowed=1, returned=1)
+    o['msg_printer'].put.assert_any_call(Messages.SESSION_FAILED, count=1)
+    assert sorted(c[0] for c in o['logger'].log_completed.call_args_list) == [
+        ('hoge-user', '9784274068560', 'successfully returned a book'),
+        ('hoge-user', '9784789838078', 'successfully borrowed a book'),
+        ('hoge-user', '9784873115658', 'book has already been borrowed'),
+    ]
+
+
+def test_BookProcedure_session_return_command():
+    o = create_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        with_ids([
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+            create_book_record('9784274068560', 'PG言語[棚2]', 'hoge-user'),
+            create_book_record('9784274068560', 'PG言語[棚2]', 'hoge-user'),
+        ]),
+        session_timeout=10)
+
+    o['id_scanner'].scan.return_value = '0123'
+    o['line_reader'].readline.side_effect = [
+        '9784274068560', '9784789838078', '9784274068560', CMD_RETURN]
+
+    o['procedure'].process_once()
+
+    assert o['kintone'].called_map['return_book'] == 2
+    assert o['kintone'].called_map['borrow_book'] == 0
+    o['msg_printer'].put.assert_any_call(
+        Messages.NOT_BORROWED_BY_YOU, isbn='9784789838078')
+    o['msg_printer'].put.assert_any_call(
+        Messages.SESSION_COMPLETED, borrowed=0, returned=2)
+
+
+def test_BookProcedure_session_logs_borrows_when_returns_fail():
+    o = create_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        with_ids([
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+            create_book_record('9784274068560', 'PG言語[棚2]', 'hoge-user'),
+        ]),
+        session_timeout=10)
+    def return_books(book_records, user_code):
+        raise IOError('connection reset')
+    o['kintone'].return_books = return_books
+
+    o['id_scanner'].scan.return_value = '0123'
+    o['line_reader'].readline.side_effect = [
+        '9784789838078', '9784274068560', None]
+
+    o['procedure'].process_once()
+
+    assert [c[0] for c in o['logger'].log_completed.call_args_list] == [
+        ('hoge-user', '9784789838078', 'successfully borrowed a book'),
+        ('hoge-user', '9784274068560', 'kintone returned an error'),
+    ]
+    o['msg_printer'].put.assert_any_call(
+        Messages.SESSION_COMPLETED, borrowed=1, returned=0)
+    o['msg_printer'].put.assert_any_call(Messages.SESSION_FAILED, count=1)
+
+
+def test_BookProcedure_concurrent_unknown_user():
+    executor = ThreadPool(2)
+    o = create_book_procedure({}, [], executor)
+
+    o['id_scanner'].scan.return_value = '4567'
+
+    o['procedure'].process_once()
+    executor.close()
+    executor.join()
+
+    o['msg_printer'].put.assert_any_call(Messages.PLEASE_SCAN_BARCODE)
+    o['msg_printer'].put.assert_called_with(Messages.FAILED_TO_FETCH_USERCODE)
+    o['logger'].log_nfc_connected.assert_called_once_with('4567', None)
+    assert not o['line_reader'].readline.called
+
+
+class FakeLineStream(object):
+    '''FakeLineStream is runtime.AsyncLineStream inputting lines in order,
+    and nothing after them.'''
+    def __init__(self, loop, lines):
+        self._loop = loop
+        self._lines = list(lines)
+
+    def readline(self):
+        future = Future(self._loop)
+        if self._lines:
+            self._loop.call_soon(future.set_result, self._lines.pop(0))
+        return future
+
+
+def create_async_book_procedure(id_user_map, book_records, lines):
+    o = create_book_procedure(id_user_map, book_records)
+    executor = ThreadPool(4)
+    loop = EventLoop(executor)
+    o['procedure'] = AsyncBookProcedure(loop,
+        o['msg_printer'], o['kintone'], o['logger'], o['positioner'],
+        o['id_scanner'], o['sound'], FakeLineStream(loop, lines))
+    o['loop'] = loop
+    o['executor'] = executor
+    return o
+
+
+def run_async_once(o):
+    o['loop'].run_until_complete(o['procedure'].process_once())
+    # wait for the logs, which are not waited for
+    o['loop'].close()
+    o['executor'].join()
+
+
+def test_AsyncBookProcedure_borrow():
+    o = create_async_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        [
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+        ],
+        ['9784789838078'])
+
+    o['id_scanner'].scan.return_value = '0123'
+
+    run_async_once(o)
+
+    assert o['kintone'].called_map['borrow_book'] == 1
+    assert o['sound'].play_se.called
+    assert o['positioner'].hide.called
+    assert not o['positioner'].show.called
+    o['logger'].log_nfc_connected.assert_called_once_with('0123', 'hoge-user')
+    o['logger'].log_completed.assert_called_once_with(
+        'hoge-user', '9784789838078', 'successfully borrowed a book')
+
+
+def test_AsyncBookProcedure_return():
+    o = create_async_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        [
+            create_book_record('9784789838078', 'PGその他[棚6]', 'hoge-user'),
+        ],
+        ['9784789838078'])
+
+    o['id_scanner'].scan.return_value = '0123'
+
+    run_async_once(o)
+
+    assert o['kintone'].called_map['return_book'] == 1
+    o['msg_printer'].put.assert_any_call(Messages.BOOK_RETURNED)
+    o['positioner'].show.assert_called_once_with('PGその他[棚6]')
+    o['logger'].log_completed.assert_called_once_with(
+        'hoge-user', '9784789838078', 'successfully returned a book')
+
+
+def test_AsyncBookProcedure_unknown_user():
+    o = create_async_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        [
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+        ],
+        ['9784789838078'])
+
+    o['id_scanner'].scan.return_value = '4567' # unknown employee
+
+    run_async_once(o)
+
+    o['msg_printer'].put.assert_called_with(Messages.FAILED_TO_FETCH_USERCODE)
+    o['logger'].log_nfc_connected.assert_called_once_with('4567', None)
+    assert o['kintone'].called_map['find_book_records'] == 0
+    assert not o['logger'].log_completed.called
+
+
+def test_AsyncBookProcedure_barcode_timeout():
+    o = create_async_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        [
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+        ],
+        [])
+    o['procedure'].BARCODE_TIMEOUT = 0.01
+
+    o['id_scanner'].scan.return_value = '0123'
+
+    run_async_once(o)
+
+    o['msg_printer'].put.assert_called_with(Messages.TIMED_OUT)
+    assert o['kintone'].called_map['find_book_records'] == 0
+    assert not o['logger'].log_completed.called
+
+
+def test_AsyncBookProcedure_retries_non_isbn():
+    o = create_async_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        [
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+        ],
+        ['1920055014008', '9784789838078'])
+
+    o['id_scanner'].scan.return_value = '0123'
+
+    run_async_once(o)
+
+    o['msg_printer'].put.assert_any_call(Messages.BARCODE_IS_NOT_ISBN)
+    assert o['kintone'].called_map['find_book_records'] == 1
+    o['logger'].log_completed.assert_called_once_with(
+        'hoge-user', '9784789838078', 'successfully borrowed a book')
+
+
+def test_run_async_stops_on_sigterm():
+    o = create_book_procedure(
+        {
+            '0123': 'hoge-user'
+        },
+        [
+            create_book_record('9784789838078', 'PGその他[棚6]', None),
+        ])
+    r, w = os.pipe()
+    def put(msg_pair, **kwargs):
+        # a barcode is read only if inputted after the prompt
+        if msg_pair == Messages.PLEASE_SCAN_BARCODE:
+            os.write(w, '9784789838078\n')
+    o['msg_printer'].put.side_effect = put
+    completed = threading.Event()
+    o['logger'].log_completed.side_effect = lambda *args: completed.set()
+    terminated = threading.Event()
+    employee_ids = ['0123']
+    def scan():
+        if employee_ids:
+            return employee_ids.pop()
+        # stop while the next card is awaited
+        completed.wait(5)
+        os.kill(os.getpid(), signal.SIGTERM)
+        terminated.wait(5)
+    o['id_scanner'].scan.side_effect = scan
+    o['id_scanner'].terminate.side_effect = terminated.set
+
+    handlers = [(s, signal.getsignal(s))
+                for s in (signal.SIGINT, signal.SIGTERM)]
+    try:
+        run_async((o['msg_printer'], o['kintone'], o['logger'],
+            o['positioner'], o['id_scanner']), o['sound'], FdSource(r))
+    finally:
+        for s, handler in handlers:
+            signal.signal(s, handler)
+        os.close(r)
+        os.close(w)
+
+    assert terminated.is_set()
+    assert o['kintone'].called_map['borrow_book'] == 1
+    o['logger'].log_completed.assert_called_once_with(
+        'hoge-user', '9784789838078', 'successfully borrowed a book')
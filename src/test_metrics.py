@@ -0,0 +1,53 @@
+import threading
+import urllib2
+
+import metrics
+from metrics import MetricsServer, Registry
+
+
+def test_HistogramFamily_render():
+    registry = Registry()
+    family = registry.histogram('test_seconds', 'Test.', 'stage', (0.1, 1))
+    family.observe('lookup', 0.05)
+    family.observe('lookup', 0.5)
+    family.observe('lookup', 2)
+
+    assert registry.render() == (
+        '# HELP test_seconds Test.\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{stage="lookup",le="0.1"} 1\n'
+        'test_seconds_bucket{stage="lookup",le="1.0"} 2\n'
+        'test_seconds_bucket{stage="lookup",le="+Inf"} 3\n'
+        'test_seconds_sum{stage="lookup"} 2.55\n'
+        'test_seconds_count{stage="lookup"} 3\n')
+
+
+def test_trace_is_carried_to_worker_thread():
+    family = Registry().histogram('test_seconds', 'Test.', 'function')
+    @family.timed
+    def lookup():
+        pass
+
+    with metrics.trace() as timings:
+        with family.time('stage'):
+            pass
+        worker = threading.Thread(target=metrics.traced(lookup))
+        worker.start()
+        worker.join()
+    lookup()
+
+    assert sorted(timings) == ['lookup', 'stage']
+    assert metrics.current_trace() is None
+
+
+def test_MetricsServer():
+    registry = Registry()
+    registry.histogram('test_seconds', 'Test.', 'stage').observe('nfc', 0.01)
+    server = MetricsServer(('127.0.0.1', 0), registry)
+    server.start()
+    try:
+        body = urllib2.urlopen(
+            'http://127.0.0.1:{}/metrics'.format(server.server_port)).read()
+    finally:
+        server.stop()
+    assert body == registry.render()
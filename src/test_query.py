@@ -0,0 +1,93 @@
+# vim: set encoding=utf-8
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+
+import pytest
+
+from catalog import BookCatalog
+import kintone
+from main import Kintone
+from query import QueryServer
+
+
+def create_book_record(record_id, isbn13, user_codes):
+    return {
+        u'$id': {u'type': u'__ID__', u'value': unicode(record_id)},
+        u'$revision': {u'type': u'__REVISION__', u'value': u'1'},
+        u'isbn13': {u'type': u'SINGLE_LINE_TEXT', u'value': isbn13},
+        u'type': {u'type': u'DROP_DOWN', u'value': u'PGその他[棚6]'},
+        u'STATUS': {u'type': u'STATUS', u'value': kintone.STATUS_BORROWED
+            if user_codes else kintone.STATUS_FREE},
+        u'STATUS_ASSIGNEE': {u'type': u'STATUS_ASSIGNEE',
+            u'value': [{u'code': c, u'name': u'佐藤'} for c in user_codes]},
+        u'更新日時': {u'type': u'UPDATED_TIME', u'value': u'2017-01-01T00:00:00Z'},
+    }
+
+
+def test_QueryServer():
+    catalog = BookCatalog(lambda since: [
+        create_book_record(1, u'9784789838078', [u'hoge-user']),
+        create_book_record(2, u'9784789838078', []),
+        create_book_record(3, u'9784774142043', [u'hoge-user']),
+    ])
+    catalog.sync()
+
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'hondana.sock')
+    server = QueryServer(path, Kintone(None, catalog=catalog),
+        lambda: {'books': len(catalog)})
+    server.start()
+    try:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(path)
+        f = sock.makefile('rb+', 0)
+        def query(line):
+            f.write(line + '\n')
+            return json.loads(f.readline())
+
+        books = query('book 9784789838078')['books']
+        assert [b['id'] for b in books] == ['2', '1']
+        assert books[1]['borrowers'] == [{'code': 'hoge-user', 'name': u'佐藤'}]
+        assert books[1]['status'] == kintone.STATUS_BORROWED
+
+        books = query('user hoge-user')['books']
+        assert [b['isbn13'] for b in books] == ['9784789838078', '9784774142043']
+        assert query('user fuga-user')['books'] == []
+        assert query('status') == {'ok': True, 'status': {'books': 3}}
+        assert not query('borrow 9784789838078')['ok']
+        # not UTF-8
+        assert not query('bogus \xff\xfe')['ok']
+        assert query('status')['ok']
+        sock.close()
+    finally:
+        server.stop()
+        shutil.rmtree(tempdir)
+    assert not os.path.exists(path)
+
+
+def test_QueryServer_takes_over_only_stale_sockets():
+    tempdir = tempfile.mkdtemp()
+    path = os.path.join(tempdir, 'hondana.sock')
+    try:
+        # a socket left by a process which has died
+        stale = socket.socket(socket.AF_UNIX)
+        stale.bind(path)
+        stale.close()
+
+        server = QueryServer(path, Kintone(None))
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0660
+        server.start()
+        try:
+            with pytest.raises(RuntimeError):
+                QueryServer(path, Kintone(None))
+            sock = socket.socket(socket.AF_UNIX)
+            sock.connect(path)
+            sock.close()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(tempdir)
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from inputsource import FdSource
+from main import LineReader
+from runtime import AsyncLineStream, CancelledError, EventLoop, Return, \
+    TimeoutError, sleep, wait_for
+
+
+def test_task_return():
+    loop = EventLoop()
+    def double(x):
+        value = yield loop.run_in_executor(lambda: x * 2)
+        raise Return(value)
+    def coro():
+        a = yield double(1)
+        b = yield double(a)
+        raise Return(a + b)
+    assert loop.run_until_complete(coro()) == 6
+    loop.close()
+
+
+def test_wait_for_timeout():
+    loop = EventLoop()
+    def coro():
+        try:
+            yield wait_for(loop, sleep(loop, 10), 0.01)
+        except TimeoutError:
+            raise Return('timeout')
+    assert loop.run_until_complete(coro()) == 'timeout'
+    loop.close()
+
+
+def test_task_cancel():
+    loop = EventLoop()
+    def coro():
+        yield sleep(loop, 10)
+    task = loop.create_task(coro())
+    loop.call_later(0.01, task.cancel)
+    with pytest.raises(CancelledError):
+        loop.run_until_complete(task)
+    assert task.cancelled()
+    loop.close()
+
+
+def test_AsyncLineStream():
+    loop = EventLoop()
+    r, w = os.pipe()
+    stream = AsyncLineStream(loop, FdSource(r), LineReader())
+    def coro():
+        future = stream.readline()
+        os.write(w, '9784789800001\n9784789800002\n')
+        first = yield future
+        future = stream.readline()
+        os.write(w, '9784789800003\n')
+        second = yield future
+        future = stream.readline()
+        os.close(w)
+        eof = yield future
+        raise Return((first, second, eof))
+    assert loop.run_until_complete(coro()) == (
+        '9784789800001', '9784789800003', None)
+    os.close(r)
+    loop.close()
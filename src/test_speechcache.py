@@ -0,0 +1,49 @@
+# vim: set encoding=utf-8
+import os
+import shutil
+import tempfile
+
+from main import Messages
+from speechcache import SpeechCache
+
+
+def create_speech_cache(cache_dir, max_dynamic=32):
+    rendered = []
+    def synthesize(text, wav_path):
+        rendered.append(text)
+        with open(wav_path, 'w') as f:
+            f.write(text)
+    return SpeechCache(cache_dir, max_dynamic, synthesize), rendered
+
+
+def test_SpeechCache_prerender():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        open(os.path.join(cache_dir, 'stale.wav'), 'w').close()
+        cache, rendered = create_speech_cache(cache_dir)
+        cache.prerender(Messages.static_speeches())
+
+        assert Messages.TIMED_OUT.speech in rendered
+        assert Messages.ALREADY_BORROWED.speech not in rendered
+        assert not os.path.exists(os.path.join(cache_dir, 'stale.wav'))
+
+        path = cache.get(Messages.BOOK_BORROWED.speech)
+        with open(path) as f:
+            assert f.read() == Messages.BOOK_BORROWED.speech
+        assert len(rendered) == len(Messages.static_speeches())
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_SpeechCache_evicts_dynamic_speech():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache, rendered = create_speech_cache(cache_dir, max_dynamic=1)
+        first = cache.get('佐藤さんがすでに借りています')
+        assert cache.get('佐藤さんがすでに借りています') == first
+        assert len(rendered) == 1
+
+        cache.get('鈴木さんがすでに借りています')
+        assert not os.path.exists(first)
+    finally:
+        shutil.rmtree(cache_dir)
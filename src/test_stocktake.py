@@ -0,0 +1,90 @@
+# vim: set encoding=utf-8
+import threading
+
+import kintone
+from main import CMD_BORROW
+from stocktake import (
+        REASON_BORROWED, REASON_EXTRA_COPY, REASON_NOT_REGISTERED,
+        REASON_UNRESOLVED, Stocktaker, report_to_dict)
+
+
+def create_book_view(record_id, isbn13, status=kintone.STATUS_FREE):
+    return kintone.BookView.from_record({
+        u'$id': {u'type': u'__ID__', u'value': unicode(record_id)},
+        u'$revision': {u'type': u'__REVISION__', u'value': u'1'},
+        u'isbn13': {u'type': u'SINGLE_LINE_TEXT', u'value': isbn13},
+        u'type': {u'type': u'DROP_DOWN', u'value': u'PGその他[棚6]'},
+        u'STATUS': {u'type': u'STATUS', u'value': status},
+        u'STATUS_ASSIGNEE': {u'type': u'STATUS_ASSIGNEE', u'value': []},
+    })
+
+
+def test_Stocktaker():
+    books = [
+        create_book_view(1, u'9784789838078'),
+        create_book_view(2, u'9784789838078', kintone.STATUS_BORROWED),
+        create_book_view(3, u'9784774142043'),
+        create_book_view(4, u'9784000000001', kintone.STATUS_BORROWED),
+        create_book_view(5, u'9784000000002'),
+    ]
+    batches = []
+    lock = threading.Lock()
+    def lookup(isbns):
+        with lock:
+            batches.append(list(isbns))
+        return [b for b in books if b.isbn13 in isbns]
+
+    stocktaker = Stocktaker(lookup,
+        lambda: [b for b in books if b.is_free()], batch_size=2)
+    for barcode in ['9784789838078', '9784789838078', '9784774142043',
+            '9784774142043', 'not-isbn', '9784000000001', '9784999999999']:
+        stocktaker.scan(barcode)
+    # the price code next to the ISBN and a command barcode
+    assert not stocktaker.scan('1920055014008')
+    assert not stocktaker.scan(CMD_BORROW)
+    assert len(stocktaker) == 6
+    report = stocktaker.finish()
+
+    assert sorted(len(b) for b in batches) == [2, 2]
+    assert [b.id for b in report.on_shelf] == [u'3', u'1']
+    assert [b.id for b in report.missing] == [u'5']
+    assert [(u.isbn, u.reason) for u in report.unexpected] == [
+        ('9784000000001', REASON_BORROWED),
+        ('9784774142043', REASON_EXTRA_COPY),
+        ('9784789838078', REASON_BORROWED),
+        ('9784999999999', REASON_NOT_REGISTERED),
+    ]
+    assert report_to_dict(report)['unexpected'][0]['book']['id'] == u'4'
+
+
+def test_Stocktaker_keeps_scans_of_failed_lookups():
+    books = [
+        create_book_view(1, u'9784789838078'),
+        create_book_view(2, u'9784774142043'),
+        create_book_view(3, u'9784000000002'),
+    ]
+    def lookup(isbns):
+        if '9784774142043' in isbns:
+            raise RuntimeError('kintone is down')
+        return [b for b in books if b.isbn13 in isbns]
+    def scan_all(fetch_expected):
+        stocktaker = Stocktaker(lookup, fetch_expected, batch_size=1)
+        for barcode in ['9784789838078', '9784774142043', '9784774142043']:
+            stocktaker.scan(barcode)
+        return stocktaker.finish()
+    def fetch_expected():
+        raise RuntimeError('kintone is down')
+
+    report = scan_all(fetch_expected)
+    assert [b.id for b in report.on_shelf] == [u'1']
+    assert report.missing is None
+    assert [(u.isbn, u.reason) for u in report.unexpected] == [
+        ('9784774142043', REASON_UNRESOLVED)] * 2
+    assert report_to_dict(report)['missing'] is None
+
+    # a book of an unresolved ISBN is not reported as missing too
+    report = scan_all(lambda: books)
+    assert [b.id for b in report.on_shelf] == [u'1']
+    assert [b.id for b in report.missing] == [u'3']
+    assert [(u.isbn, u.reason) for u in report.unexpected] == [
+        ('9784774142043', REASON_UNRESOLVED)] * 2